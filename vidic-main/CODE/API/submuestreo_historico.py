@@ -0,0 +1,76 @@
+''' Submuestreo en el servidor de los datos históricos de un dispositivo (parámetro "resolucion" de /dispositivo).
+
+Se usa "Largest Triangle Three Buckets" (LTTB), que conserva los picos y la forma de la curva mucho mejor que
+tomar una de cada N muestras, con un coste lineal en el número de filas.
+'''
+
+
+def _lttb(momentos: list, valores: list, puntos: int) -> list:
+    '''
+    Submuestreo "Largest Triangle Three Buckets" de una serie temporal.
+    Devuelve los índices (en orden) de los "puntos" elementos que mejor conservan la forma de la curva:
+    el primero, el último y, de cada cubo intermedio, el que forma el triángulo de mayor área con el
+    punto elegido en el cubo anterior y la media del cubo siguiente.
+    '''
+    n = len(valores)
+    if n <= puntos:
+        return list(range(n))
+    if puntos < 3:
+        # Sin cubos intermedios solo se conservan los extremos
+        return [0, n - 1][:max(puntos, 0)]
+
+    elegidos = [0]
+    ancho_cubo = (n - 2) / (puntos - 2)
+    a = 0
+    for i in range(puntos - 2):
+        # Media del cubo siguiente (en el último cubo es el último punto)
+        inicio_siguiente = int((i + 1) * ancho_cubo) + 1
+        fin_siguiente = min(int((i + 2) * ancho_cubo) + 1, n)
+        media_x = sum(momentos[inicio_siguiente:fin_siguiente]) / (fin_siguiente - inicio_siguiente)
+        media_y = sum(valores[inicio_siguiente:fin_siguiente]) / (fin_siguiente - inicio_siguiente)
+
+        # Punto del cubo actual con mayor área
+        x_a, y_a = momentos[a], valores[a]
+        area_maxima = -1.0
+        for j in range(int(i * ancho_cubo) + 1, int((i + 1) * ancho_cubo) + 1):
+            area = abs((x_a - media_x) * (valores[j] - y_a) - (x_a - momentos[j]) * (media_y - y_a))
+            if area > area_maxima:
+                area_maxima = area
+                siguiente_a = j
+        elegidos.append(siguiente_a)
+        a = siguiente_a
+
+    elegidos.append(n - 1)
+    return elegidos
+
+def _submuestrear_filas(colnames: list, filas: list, resolucion: int) -> list:
+    '''
+    Reduce las filas recuperadas de un dispositivo a, como mucho, "resolucion" filas.
+    El submuestreo (LTTB) se hace por separado para cada variable y se devuelve la unión de las filas
+    elegidas, en orden temporal, para mantener el mismo formato de respuesta que sin submuestreo.
+    Si la unión pasa de "resolucion" filas, se repite con menos puntos por variable; si ni con el mínimo
+    (3 puntos por variable) cabe, se toman filas equiespaciadas de la unión.
+    '''
+    indice_momento = colnames.index('variable_momento')
+    series = []
+    for indice_variable, nombre in enumerate(colnames):
+        if indice_variable == indice_momento or not nombre.startswith('variable_'):
+            continue
+        # Los valores nulos (variable no enviada en esa muestra) no participan en el submuestreo
+        indices = [i for i, fila in enumerate(filas) if fila[indice_variable] is not None]
+        momentos = [float(filas[i][indice_momento]) for i in indices]
+        valores = [float(filas[i][indice_variable]) for i in indices]
+        series.append((indices, momentos, valores))
+
+    puntos = resolucion
+    while True:
+        filas_elegidas = set()
+        for indices, momentos, valores in series:
+            filas_elegidas.update(indices[j] for j in _lttb(momentos, valores, puntos))
+        if len(filas_elegidas) <= resolucion or puntos <= 3:
+            break
+        puntos = max(3, min(puntos - 1, puntos * resolucion // len(filas_elegidas)))
+    filas_elegidas = sorted(filas_elegidas)
+    if len(filas_elegidas) > resolucion:
+        filas_elegidas = [filas_elegidas[round(k * (len(filas_elegidas) - 1) / (resolucion - 1))] for k in range(resolucion)]
+    return [filas[i] for i in filas_elegidas]
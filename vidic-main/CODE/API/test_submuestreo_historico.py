@@ -0,0 +1,57 @@
+import math
+import random
+
+import pytest
+
+from submuestreo_historico import _lttb, _submuestrear_filas
+
+
+def test_lttb_devuelve_puntos_pedidos_en_orden_con_extremos():
+    momentos = list(range(1000))
+    valores = [math.sin(t / 20) for t in momentos]
+    elegidos = _lttb(momentos, valores, 50)
+    assert len(elegidos) == 50
+    assert elegidos[0] == 0 and elegidos[-1] == 999
+    assert elegidos == sorted(set(elegidos))
+
+
+def test_lttb_conserva_picos():
+    momentos = list(range(500))
+    valores = [0.0] * 500
+    valores[123] = 100.0
+    valores[321] = -100.0
+    elegidos = _lttb(momentos, valores, 10)
+    assert 123 in elegidos and 321 in elegidos
+
+
+@pytest.mark.parametrize('puntos, esperado', [(0, []), (1, [0]), (2, [0, 9])])
+def test_lttb_con_menos_de_tres_puntos_solo_extremos(puntos, esperado):
+    assert _lttb(list(range(10)), [1.0] * 10, puntos) == esperado
+
+
+def test_lttb_serie_corta_sin_cambios():
+    assert _lttb([1, 2, 3], [1.0, 2.0, 3.0], 10) == [0, 1, 2]
+
+
+@pytest.mark.parametrize('num_variables', [1, 3, 20, 60])
+@pytest.mark.parametrize('resolucion', [3, 10, 100])
+def test_submuestrear_filas_no_pasa_de_resolucion(num_variables, resolucion):
+    aleatorio = random.Random(num_variables * 1000 + resolucion)
+    colnames = ['variable_v{}'.format(i) for i in range(num_variables)] + ['variable_momento']
+    filas = [
+        tuple(aleatorio.random() if aleatorio.random() < 0.9 else None for _ in range(num_variables)) + (t * 1000,)
+        for t in range(3000)
+    ]
+    elegidas = _submuestrear_filas(colnames, filas, resolucion)
+    assert 0 < len(elegidas) <= resolucion
+    momentos = [fila[-1] for fila in elegidas]
+    assert momentos == sorted(set(momentos))
+    assert all(fila in filas for fila in elegidas)
+
+
+def test_submuestrear_filas_ignora_nulos_y_columnas_que_no_son_variables():
+    colnames = ['id', 'variable_a', 'variable_momento']
+    filas = [(i, None if i % 2 else float(i), i) for i in range(100)]
+    elegidas = _submuestrear_filas(colnames, filas, 10)
+    assert len(elegidas) == 10
+    assert all(fila[1] is not None for fila in elegidas)
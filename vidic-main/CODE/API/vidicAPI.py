@@ -1,17 +1,29 @@
 # Para correr la API: uvicorn vidicAPI:app --host 0.0.0.0 --port 8000 --reload
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from time import sleep
-from typing import Union
+from functools import partial
+from threading import BoundedSemaphore
+from time import monotonic, sleep
+from typing import List, Union
+import re
+import msgpack
 import psycopg2
+from psycopg2 import errors, pool, sql
 from configobj import ConfigObj
 import logging
 
 from pydantic import BaseModel
-from fastapi import FastAPI, Depends, HTTPException, status, Header
+from fastapi import FastAPI, Depends, HTTPException, status, Header, Query
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm 
 from fastapi.middleware.cors import CORSMiddleware
+from autobahn.asyncio.component import Component
+
+from submuestreo_historico import _submuestrear_filas
 
 
 logging.basicConfig(filename="vidicAPI.log", level=logging.DEBUG)
@@ -30,34 +42,88 @@ SECRET_KEY = "fbf575814bd08c5c9ab6c97dfc8e02c956bd573099042268d3a3c502b9ccf826"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 20
 
-def _iniciar_conexion_db():
+# Valores por defecto del pool de conexiones con la base de datos (se pueden cambiar en APIconfig.ini)
+POOL_CONEXIONES_MINIMAS = 2
+POOL_CONEXIONES_MAXIMAS = 10
+POOL_SEGUNDOS_COMPROBACION = 30
+INTENTOS_CONEXION_BD = 30
+
+# Tablas de agregados por dispositivo (dispositivo_N_<sufijo>) y ancho de sus cubos en ms. Las mantiene el módulo de
+# entrada (AGREGADOS_HISTORICOS de almacenamiento_historico.py): si allí se cambian, hay que indicarlas también en la
+# sección AGREGADOS_HISTORICOS de APIconfig.ini (sufijo = ancho en ms).
+AGREGADOS_HISTORICOS_POR_DEFECTO = OrderedDict([('1m', 60 * 1000), ('1h', 60 * 60 * 1000), ('1d', 24 * 60 * 60 * 1000)])
+
+# Conexiones del pool -> momento en el que se devolvieron al pool por última vez.
+ultimo_uso_conexion = {}
+
+# Excepción si no se puede usar la base de datos:
+error_bd_no_disponible = HTTPException(
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE,
+    detail='Problema con la base de datos. Conexion no establecida.',
+)
+
+# Procedimiento WAMP del publicador del módulo de entrada con el último payload de cada dispositivo.
+PROCEDIMIENTO_ULTIMO_VALOR = 'vidic.ultimo_valor'
+# Sesión WAMP con el Crossbar (None mientras no está establecida).
+sesion_crossbar = None
+
+# Excepción si no se puede consultar el Crossbar:
+error_crossbar_no_disponible = HTTPException(
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE,
+    detail='Problema con el Crossbar. Sesion no establecida.',
+)
+
+def _iniciar_pool_db() -> pool.ThreadedConnectionPool:
     '''
-    Método de inicialización de los parámetros necesarios para conectarse e interactuar con la base de datos.
+    Método de inicialización del pool de conexiones con la base de datos.
+    Además de los parámetros de conexión, en APIconfig.ini se pueden indicar (opcionales):
+        - conexiones_minimas: conexiones que se abren al arrancar y se mantienen abiertas.
+        - conexiones_maximas: límite de conexiones simultáneas con la base de datos.
+        - segundos_comprobacion: tiempo de inactividad a partir del cual se comprueba la conexión antes de usarla.
     '''
     try:
         logging.debug('{} => Inicializando datos de la conexion con la base de datos...'.format(datetime.utcnow()))
         config = ConfigObj('APIconfig.ini')
         parametros_conexion_bd = config['CONEXION_BASE_DATOS']
         for clave in parametros_conexion_bd:
-            if(clave not in ('host', 'database', 'user', 'password')):
+            if(clave not in ('host', 'database', 'user', 'password', 'conexiones_minimas', 'conexiones_maximas', 'segundos_comprobacion')):
                 raise Exception('[ERROR]: Error al indicar los parámetros de la conexión a la base de datos')
+        global conexiones_maximas, segundos_comprobacion
+        conexiones_minimas = int(parametros_conexion_bd.get('conexiones_minimas', POOL_CONEXIONES_MINIMAS))
+        conexiones_maximas = int(parametros_conexion_bd.get('conexiones_maximas', POOL_CONEXIONES_MAXIMAS))
+        segundos_comprobacion = float(parametros_conexion_bd.get('segundos_comprobacion', POOL_SEGUNDOS_COMPROBACION))
         logging.debug('{} => Intentando conectar con la base de datos...'.format(datetime.utcnow()))
-        conexion_db = psycopg2.connect(host=parametros_conexion_bd['host'], database=parametros_conexion_bd['database'],
+        pool_db = pool.ThreadedConnectionPool(conexiones_minimas, conexiones_maximas,
+            host=parametros_conexion_bd['host'], database=parametros_conexion_bd['database'],
             user=parametros_conexion_bd['user'], password=parametros_conexion_bd['password'])
-        
-        cur = conexion_db.cursor()
-        logging.info('{} => Conexion con la base de datos establecida correctamente.'.format(datetime.utcnow()))
-        return conexion_db, cur
+        logging.info('{} => Pool de conexiones con la base de datos creado ({}-{} conexiones).'.format(datetime.utcnow(), conexiones_minimas, conexiones_maximas))
+        return pool_db
 
     except Exception as err:
         raise err
 
+def _leer_agregados_historicos() -> OrderedDict:
+    '''
+    Tablas de agregados por dispositivo de APIconfig.ini (o las de por defecto si no se indican), de más fina a más gruesa.
+    '''
+    parametros_agregados = ConfigObj('APIconfig.ini').get('AGREGADOS_HISTORICOS')
+    if not parametros_agregados:
+        return AGREGADOS_HISTORICOS_POR_DEFECTO
+    return OrderedDict(sorted(((sufijo, int(ancho)) for sufijo, ancho in parametros_agregados.items()), key=lambda agregado: agregado[1]))
+
 def conectarConBD():
+    '''
+    Crea el pool de conexiones al arrancar la API. Solo se reintenta aquí: una vez creado el pool,
+    las conexiones rotas se descartan y se sustituyen por otras nuevas al sacarlas del pool.
+    '''
     intentos = 0
-    while intentos < 30:
+    while intentos < INTENTOS_CONEXION_BD:
         try:
-            global conexion_db, cursor
-            conexion_db, cursor = _iniciar_conexion_db()
+            global pool_db, semaforo_pool, ejecutor_bd
+            pool_db = _iniciar_pool_db()
+            semaforo_pool = BoundedSemaphore(conexiones_maximas)
+            # Un hilo por conexión del pool: las rutas async delegan en ellos el acceso a la base de datos.
+            ejecutor_bd = ThreadPoolExecutor(max_workers=conexiones_maximas, thread_name_prefix='vidicAPI-bd')
             break
 
         except psycopg2.OperationalError as err:
@@ -69,14 +135,113 @@ def conectarConBD():
             logging.error('{} => [ERROR] Ha ocurrido un error desconocido en la conexión con la base de datos: {}'.format(datetime.utcnow(), err))
             sleep(2)
             intentos += 1
-    if intentos == 10:
-        logging.error('{} => [ERROR] Intentos de conectar con la base de datos agotados: {}'.format(datetime.utcnow(), err))
-        raise HTTPException(
-            status_code = status.HTTP_503_SERVICE_UNAVAILABLE,
-            detail='Problema con la base de datos. Conexion no establecida.',
-        )
+    if intentos == INTENTOS_CONEXION_BD:
+        logging.error('{} => [ERROR] Intentos de conectar con la base de datos agotados.'.format(datetime.utcnow()))
+        raise error_bd_no_disponible
+
+def _obtener_conexion_sana():
+    '''
+    Saca una conexión del pool comprobando antes que sigue viva. Las conexiones cerradas, o que
+    no responden tras estar inactivas más de "segundos_comprobacion", se cierran y se sustituyen.
+    '''
+    for _ in range(conexiones_maximas + 1):
+        conexion = pool_db.getconn()
+        if conexion.closed:
+            pool_db.putconn(conexion, close=True)
+            continue
+        if monotonic() - ultimo_uso_conexion.get(id(conexion), 0) > segundos_comprobacion:
+            try:
+                with conexion.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+                conexion.rollback()
+            except psycopg2.Error as err:
+                logging.warning('{} => Conexion con la base de datos rota, se sustituye: {}'.format(datetime.utcnow(), err))
+                ultimo_uso_conexion.pop(id(conexion), None)
+                pool_db.putconn(conexion, close=True)
+                continue
+        return conexion
+    raise psycopg2.OperationalError('No se ha podido obtener una conexión válida del pool')
+
+@contextmanager
+def _cursor_bd():
+    '''
+    Presta a la petición en curso una conexión del pool y devuelve su cursor.
+    Si no hay conexiones libres espera a que se devuelva alguna. Al terminar hace commit
+    (o rollback si hay error) y devuelve la conexión al pool; si la conexión se ha roto, se descarta.
+    '''
+    semaforo_pool.acquire()
+    conexion = None
+    descartar = False
+    try:
+        conexion = _obtener_conexion_sana()
+        with conexion.cursor() as cursor:
+            yield cursor
+        conexion.commit()
+
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        descartar = True
+        raise
+
+    except Exception:
+        try:
+            conexion.rollback()
+        except (psycopg2.Error, AttributeError):
+            descartar = True
+        raise
+
+    finally:
+        if conexion is not None:
+            if descartar:
+                ultimo_uso_conexion.pop(id(conexion), None)
+            else:
+                ultimo_uso_conexion[id(conexion)] = monotonic()
+            pool_db.putconn(conexion, close=descartar)
+        semaforo_pool.release()
+
+async def _en_bd(funcion, *args, **kwargs):
+    '''
+    Ejecuta un método bloqueante de acceso a la base de datos en el ejecutor de la API y espera
+    su resultado sin bloquear el bucle de eventos, de forma que el resto de peticiones siguen
+    atendiéndose mientras dura la consulta.
+    '''
+    bucle = asyncio.get_running_loop()
+    return await bucle.run_in_executor(ejecutor_bd, partial(funcion, *args, **kwargs))
 
 conectarConBD()
+AGREGADOS_HISTORICOS = _leer_agregados_historicos()
+
+def _iniciar_componente_crossbar() -> Union[Component, None]:
+    '''
+    Componente WAMP con el que la API consulta los últimos valores de los dispositivos al publicador del
+    módulo de entrada. Es opcional: sin la sección CONEXION_BROKER_CROSSBAR en APIconfig.ini no se crea.
+    Se reconecta solo si se pierde la conexión con el Crossbar.
+    '''
+    config = ConfigObj('APIconfig.ini')
+    parametros_conexion_crossbar = config.get('CONEXION_BROKER_CROSSBAR')
+    if not parametros_conexion_crossbar:
+        return None
+    for clave in parametros_conexion_crossbar:
+        if(clave not in ('url', 'realm')):
+            raise Exception('[ERROR]: Error al indicar los parámetros de la conexión al Crossbar')
+    componente = Component(
+        transports=[{'type': 'websocket', 'url': parametros_conexion_crossbar['url'], 'serializers': ['msgpack'], 'max_retries': -1}],
+        realm=parametros_conexion_crossbar['realm'])
+
+    @componente.on_join
+    def _sesionCrossbarAbierta(session, details):
+        global sesion_crossbar
+        sesion_crossbar = session
+        logging.info('{} => Sesion con el Crossbar abierta.'.format(datetime.utcnow()))
+
+    @componente.on_leave
+    def _sesionCrossbarCerrada(session, details):
+        global sesion_crossbar
+        sesion_crossbar = None
+        logging.error('{} => [ERROR] Sesion con el Crossbar cerrada: {}'.format(datetime.utcnow(), details.reason))
+
+    return componente
+
+componente_crossbar = _iniciar_componente_crossbar()
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
@@ -84,6 +249,11 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 app = FastAPI()
 
+@app.on_event('startup')
+async def _arrancarComponenteCrossbar():
+    if componente_crossbar is not None:
+        componente_crossbar.start(loop=asyncio.get_running_loop())
+
 # Hablilitar la política CORS.
 app.add_middleware(
     CORSMiddleware,
@@ -138,14 +308,15 @@ def _verificarContrasenya(nombre_usuario: str, plain_password: str) -> bool:
         - False en caso contrario.
     '''
     try:
-        cursor.execute("SELECT U.hash FROM usuario AS U WHERE U.nombre_usuario = '"+nombre_usuario+"'")
-        contra_hashed = cursor.fetchall()[0][0] #primer elemento
+        with _cursor_bd() as cursor:
+            cursor.execute("SELECT U.hash FROM usuario AS U WHERE U.nombre_usuario = '"+nombre_usuario+"'")
+            contra_hashed = cursor.fetchall()[0][0] #primer elemento
         return pwd_context.verify(plain_password, contra_hashed)
 
 
     except psycopg2.OperationalError as err:
         logging.error('{} => [ERROR] Ha ocurrido un error en la conexión con la base de datos: {}'.format(datetime.utcnow(), err))
-        conectarConBD()
+        raise error_bd_no_disponible
 
     except Exception as err:
         logging.error('{} => [ERROR] Error al verificar la contraseña del usuario: {}'.format(datetime.utcnow(), err))
@@ -169,8 +340,9 @@ def _getUsuario(nombre_usuario:str) -> Usuario:
     '''
     if (not _alfanumérico(nombre_usuario)): raise HTTPException(status_code = status.HTTP_401_UNAUTHORIZED, detail='Usuario no válido',)
     try:
-        cursor.execute("SELECT U.nombre_usuario, U.nombre FROM usuario AS U WHERE EXISTS(SELECT * FROM usuario AS U2 WHERE U2.nombre_usuario = '"+nombre_usuario+"') AND EXISTS (SELECT * FROM permiso_usuario AS PU WHERE PU.usuario_id = U.id AND PU.habilitado=true AND PU.permiso_id = (SELECT id FROM permiso WHERE nombre='iniciar sesion'))")
-        usuario = cursor.fetchall()
+        with _cursor_bd() as cursor:
+            cursor.execute("SELECT U.nombre_usuario, U.nombre FROM usuario AS U WHERE EXISTS(SELECT * FROM usuario AS U2 WHERE U2.nombre_usuario = '"+nombre_usuario+"') AND EXISTS (SELECT * FROM permiso_usuario AS PU WHERE PU.usuario_id = U.id AND PU.habilitado=true AND PU.permiso_id = (SELECT id FROM permiso WHERE nombre='iniciar sesion'))")
+            usuario = cursor.fetchall()
         try:
             usuario = Usuario(nombre_usuario=usuario[0][0], nombre=usuario[0][1])
             return usuario
@@ -178,9 +350,9 @@ def _getUsuario(nombre_usuario:str) -> Usuario:
         except IndexError:
             return None
 
-        except psycopg2.OperationalError as err:
-            logging.error('{} => [ERROR] Ha ocurrido un error en la conexión con la base de datos: {}'.format(datetime.utcnow(), err))
-            conectarConBD()
+    except psycopg2.OperationalError as err:
+        logging.error('{} => [ERROR] Ha ocurrido un error en la conexión con la base de datos: {}'.format(datetime.utcnow(), err))
+        raise error_bd_no_disponible
 
     except Exception as err:
         logging.error('{} => [ERROR] Error al obtener el usuario de la base de datos: {}'.format(datetime.utcnow(), err))
@@ -233,7 +405,7 @@ async def getUsuarioActual(token: str = Depends(oauth2_scheme)) -> Usuario:
         token_data = TokenData(nombre_usuario)
     except JWTError:
         raise credenciales_exception
-    usuario = _getUsuario(nombre_usuario=token_data.nombre_usuario)
+    usuario = await _en_bd(_getUsuario, nombre_usuario=token_data.nombre_usuario)
     if usuario is None:
         raise credenciales_exception
     else: 
@@ -253,13 +425,14 @@ def _contarDashboards(nombre_usuario: str) -> int:
     Devuelve el número de dashboards que tiene el usuario dado.
     '''
     try:
-        cursor.execute("SELECT COUNT(*) FROM dashboard AS D WHERE D.instalacion_id IN (SELECT IU.instalacion_id FROM instalacion_usuario AS IU WHERE IU.usuario_id = (SELECT U.id FROM usuario AS U WHERE U.nombre_usuario = '"+nombre_usuario+"'))")
-        contador = cursor.fetchall()[0][0] #primer elemento
+        with _cursor_bd() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM dashboard AS D WHERE D.instalacion_id IN (SELECT IU.instalacion_id FROM instalacion_usuario AS IU WHERE IU.usuario_id = (SELECT U.id FROM usuario AS U WHERE U.nombre_usuario = '"+nombre_usuario+"'))")
+            contador = cursor.fetchall()[0][0] #primer elemento
         return contador
 
     except psycopg2.OperationalError as err:
         logging.error('{} => [ERROR] Ha ocurrido un error en la conexión con la base de datos: {}'.format(datetime.utcnow(), err))
-        conectarConBD()
+        raise error_bd_no_disponible
 
     except Exception as err:
         logging.error('{} => [ERROR] Error al contar en número de dashboards del usuario: {}'.format(datetime.utcnow(), err))
@@ -271,8 +444,9 @@ def _obtenerDashboardsUsuario(nombre_usuario: str) -> dict:
         -> {'dashboards' : [nombre_dashboard_1, nombre_dashboard_2, ...]
     '''
     try:
-        cursor.execute("SELECT D.nombre FROM dashboard AS D WHERE D.instalacion_id IN (SELECT IU.instalacion_id FROM instalacion_usuario AS IU WHERE IU.usuario_id = (SELECT U.id FROM usuario AS U WHERE U.nombre_usuario = '"+nombre_usuario+"'))")
-        dashboards = cursor.fetchall()
+        with _cursor_bd() as cursor:
+            cursor.execute("SELECT D.nombre FROM dashboard AS D WHERE D.instalacion_id IN (SELECT IU.instalacion_id FROM instalacion_usuario AS IU WHERE IU.usuario_id = (SELECT U.id FROM usuario AS U WHERE U.nombre_usuario = '"+nombre_usuario+"'))")
+            dashboards = cursor.fetchall()
         nombre_dashboards = []
         for dashboard in dashboards:
             nombre_dashboards.append(dashboard[0])
@@ -280,42 +454,181 @@ def _obtenerDashboardsUsuario(nombre_usuario: str) -> dict:
     
     except psycopg2.OperationalError as err:
         logging.error('{} => [ERROR] Ha ocurrido un error en la conexión con la base de datos: {}'.format(datetime.utcnow(), err))
-        conectarConBD()
+        raise error_bd_no_disponible
     
     except Exception as err:
         logging.error('{} => [ERROR] Ha ocurrido un error al recuperar los dashboards del usuario: {}'.format(datetime.utcnow(), err))
         raise error_desconocido
 
-def _recuperar_datos_historicos(id_dispositivo:int, fecha_inicio: int, fecha_fin: int) -> dict:
+def _tabla_agregado(cursor, id_dispositivo: int, ancho_maximo: float, multiplo_de: Union[int, None] = None):
+    '''
+    Devuelve (nombre_tabla, ancho_cubo) de la tabla de agregados más gruesa del dispositivo cuyos cubos no son
+    más anchos que "ancho_maximo" (y, si se indica, dividen exactamente a "multiplo_de").
+    Devuelve None si no hay ninguna que sirva, en cuyo caso hay que consultar los datos sin agregar.
+    '''
+    for sufijo, ancho in reversed(AGREGADOS_HISTORICOS.items()):
+        if ancho > ancho_maximo or (multiplo_de and multiplo_de % ancho):
+            continue
+        nombre_tabla = 'dispositivo_{}_{}'.format(id_dispositivo, sufijo)
+        cursor.execute('SELECT to_regclass(%s) IS NOT NULL', (nombre_tabla,))
+        if cursor.fetchall()[0][0]:
+            return nombre_tabla, ancho
+    return None
+
+def _leer_tabla_agregado(cursor, nombre_tabla: str, ancho: int, fecha_inicio: int, fecha_fin: int):
+    '''
+    Lee la media de cada variable por cubo de una tabla de agregados, con el mismo formato que la tabla
+    de datos del dispositivo (columnas "variable_X" y "variable_momento" = inicio del cubo).
+    Solo se leen los cubos que caen enteros dentro de [fecha_inicio, fecha_fin]: los de los extremos incluirían
+    muestras de fuera del intervalo, así que esos tramos se leen sin agregar de la tabla de datos.
+    Devuelve (filas, nombres_columnas).
+    '''
+    cursor.execute(sql.SQL('SELECT * FROM {} LIMIT 0').format(sql.Identifier(nombre_tabla)))
+    variables = [desc[0][:-len('_cuenta')] for desc in cursor.description if desc[0].endswith('_cuenta')]
+    tabla_datos = nombre_tabla.rsplit('_', 1)[0]
+    # Cubos completos [primer_cubo, fin_cubos); fecha_fin está incluida en el intervalo
+    primer_cubo = -(-fecha_inicio // ancho) * ancho
+    fin_cubos = max(primer_cubo, (fecha_fin + 1) // ancho * ancho)
+
+    def leer_datos(desde, hasta):
+        if desde >= hasta:
+            return []
+        cursor.execute(sql.SQL('SELECT {}, variable_momento FROM {} WHERE variable_momento >= %s AND variable_momento < %s ORDER BY variable_momento').format(
+            sql.SQL(', ').join(map(sql.Identifier, variables)), sql.Identifier(tabla_datos)), (desde, hasta))
+        return cursor.fetchall()
+
+    filas = leer_datos(fecha_inicio, min(primer_cubo, fecha_fin + 1))
+    if primer_cubo < fin_cubos:
+        columnas = [sql.SQL('{} / NULLIF({}, 0) AS {}').format(sql.Identifier(variable + '_suma'), sql.Identifier(variable + '_cuenta'),
+            sql.Identifier(variable)) for variable in variables]
+        cursor.execute(sql.SQL('SELECT {}, cubo AS variable_momento FROM {} WHERE cubo >= %s AND cubo < %s ORDER BY cubo').format(
+            sql.SQL(', ').join(columnas), sql.Identifier(nombre_tabla)), (primer_cubo, fin_cubos))
+        filas += cursor.fetchall()
+        filas += leer_datos(fin_cubos, fecha_fin + 1)
+    return filas, variables + ['variable_momento']
+
+def _recuperar_datos_historicos(id_dispositivo:int, fecha_inicio: int, fecha_fin: int, resolucion: Union[int, None] = None) -> dict:
     '''
     Devuelve un diccionario con:
         - el nombre de las variables.
         - el valor de las variables en orden correspondiente al nombre.
+    Si se indica "resolucion", los datos se submuestrean en el servidor a ese número de filas como máximo
+    (por ejemplo, el ancho en píxeles de la gráfica), de forma que el tamaño de la respuesta no depende del
+    intervalo de tiempo pedido. Si además hay una tabla de agregados cuyos cubos son más finos que la resolución
+    pedida, se lee de la más gruesa de ellas en vez de recorrer todos los datos.
     '''
     try:
-        cursor.execute("SELECT * FROM dispositivo_{id_dispositivo} WHERE variable_momento BETWEEN {fecha_inicio} AND {fecha_fin}".format(id_dispositivo=str(id_dispositivo), fecha_inicio=fecha_inicio, fecha_fin=fecha_fin))
-        datos_recuperados = cursor.fetchall()
-        colnames = [desc[0] for desc in cursor.description]
+        with _cursor_bd() as cursor:
+            agregado = _tabla_agregado(cursor, id_dispositivo, (fecha_fin - fecha_inicio) / resolucion) if resolucion else None
+            if agregado:
+                datos_recuperados, colnames = _leer_tabla_agregado(cursor, *agregado, fecha_inicio, fecha_fin)
+            else:
+                # El filtro por variable_momento con valores constantes permite a PostgreSQL recorrer solo las
+                # particiones de la tabla que cubren el intervalo (si la tabla del dispositivo está particionada).
+                cursor.execute("SELECT * FROM dispositivo_{id_dispositivo} WHERE variable_momento BETWEEN {fecha_inicio} AND {fecha_fin} ORDER BY variable_momento".format(id_dispositivo=str(id_dispositivo), fecha_inicio=fecha_inicio, fecha_fin=fecha_fin))
+                datos_recuperados = cursor.fetchall()
+                colnames = [desc[0] for desc in cursor.description]
+        if resolucion and len(datos_recuperados) > resolucion:
+            datos_recuperados = _submuestrear_filas(colnames, datos_recuperados, resolucion)
         return {'variables':colnames,'datos':datos_recuperados}
 
     except psycopg2.OperationalError as err:
         logging.error('{} => [ERROR] Ha ocurrido un error en la conexión con la base de datos: {}'.format(datetime.utcnow(), err))
-        conectarConBD()
+        raise error_bd_no_disponible
     
     except Exception as err:
         logging.error('{} => [ERROR] Ha ocurrido un error al recuperar los datos historicos del dispositivo {}: {}'.format(datetime.utcnow(), id_dispositivo, err))
         raise error_desconocido
 
+# Funciones de agregación por cubo de tiempo -> (expresión SQL sobre los datos del dispositivo,
+#                                                 expresión SQL sobre una de sus tablas de agregados)
+FUNCIONES_AGREGADO = {
+    'media': ('avg({col})', 'sum({col_suma}) / NULLIF(sum({col_cuenta}), 0)'),
+    'minimo': ('min({col})', 'min({col_minimo})'),
+    'maximo': ('max({col})', 'max({col_maximo})'),
+    'primero': ('(array_agg({col} ORDER BY {ts}) FILTER (WHERE {col} IS NOT NULL))[1]',
+        '(array_agg({col_primero} ORDER BY {ts}) FILTER (WHERE {col_primero} IS NOT NULL))[1]'),
+    'ultimo': ('(array_agg({col} ORDER BY {ts} DESC) FILTER (WHERE {col} IS NOT NULL))[1]',
+        '(array_agg({col_ultimo} ORDER BY {ts} DESC) FILTER (WHERE {col_ultimo} IS NOT NULL))[1]'),
+    'cuenta': ('count({col})', 'sum({col_cuenta})'),
+}
+
+def _agregar_datos_historicos(id_dispositivo: int, fecha_inicio: int, fecha_fin: int, intervalo: int, variables: List[str]) -> dict:
+    '''
+    Agrega en la base de datos las variables indicadas del dispositivo en cubos de "intervalo" segundos.
+    Los cubos están alineados a múltiplos del intervalo (desde epoch) y se devuelven enteros: el primero es el que
+    contiene fecha_inicio y el último el que contiene fecha_fin, aunque sobresalgan del intervalo pedido.
+    Si el intervalo es múltiplo del cubo de alguna tabla de agregados del dispositivo, se parte de la más gruesa
+    de ellas en vez de los datos sin agregar (el resultado es el mismo).
+    Devuelve un diccionario con arrays compactos (un elemento por cubo):
+        -> {'intervalo': ms, 'momentos': [inicio_cubo_1, ...],
+            'variables': {nombre_variable: {'media': [...], 'minimo': [...], 'maximo': [...],
+                                            'primero': [...], 'ultimo': [...], 'cuenta': [...]}}}
+    '''
+    for nombre_variable in variables:
+        if not re.fullmatch(r'[a-z0-9_]+', nombre_variable):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Variable no válida: {}'.format(nombre_variable))
+    if intervalo <= 0 or not variables:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Hay que indicar un intervalo positivo y al menos una variable')
+    ancho_cubo = intervalo * 1000
+    try:
+        with _cursor_bd() as cursor:
+            # Cubos enteros [inicio, fin): como el cubo de la tabla de agregados divide al intervalo, sus cubos
+            # caen enteros dentro de los pedidos y el resultado no depende de si existe la tabla de agregados
+            inicio = fecha_inicio - fecha_inicio % ancho_cubo
+            fin = fecha_fin - fecha_fin % ancho_cubo + ancho_cubo
+            agregado = _tabla_agregado(cursor, id_dispositivo, ancho_cubo, multiplo_de=ancho_cubo)
+            if agregado:
+                nombre_tabla, _ = agregado
+                columna_momento, indice_expresion = 'cubo', 1
+            else:
+                nombre_tabla = 'dispositivo_{}'.format(id_dispositivo)
+                columna_momento, indice_expresion = 'variable_momento', 0
+            columnas = []
+            for nombre_variable in variables:
+                nombre_columna = 'variable_' + nombre_variable
+                identificadores = {'col': sql.Identifier(nombre_columna), 'ts': sql.Identifier(columna_momento)}
+                for funcion in ('suma', 'cuenta', 'minimo', 'maximo', 'primero', 'ultimo'):
+                    identificadores['col_' + funcion] = sql.Identifier('{}_{}'.format(nombre_columna, funcion))
+                for expresiones in FUNCIONES_AGREGADO.values():
+                    columnas.append(sql.SQL(expresiones[indice_expresion]).format(**identificadores))
+            consulta = sql.SQL('SELECT floor({ts} / %(ancho)s) * %(ancho)s, {columnas} FROM {tabla} '
+                'WHERE {ts} >= %(inicio)s AND {ts} < %(fin)s GROUP BY 1 ORDER BY 1').format(
+                    ts=sql.Identifier(columna_momento), columnas=sql.SQL(', ').join(columnas), tabla=sql.Identifier(nombre_tabla))
+            cursor.execute(consulta, {'ancho': ancho_cubo, 'inicio': inicio, 'fin': fin})
+            filas = cursor.fetchall()
+
+    except (errors.UndefinedTable, errors.UndefinedColumn) as err:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Dispositivo o variable inexistente: {}'.format(err.pgerror))
+
+    except psycopg2.OperationalError as err:
+        logging.error('{} => [ERROR] Ha ocurrido un error en la conexión con la base de datos: {}'.format(datetime.utcnow(), err))
+        raise error_bd_no_disponible
+
+    except Exception as err:
+        logging.error('{} => [ERROR] Ha ocurrido un error al agregar los datos historicos del dispositivo {}: {}'.format(datetime.utcnow(), id_dispositivo, err))
+        raise error_desconocido
+
+    resultado = {'intervalo': ancho_cubo, 'momentos': [int(fila[0]) for fila in filas], 'variables': {}}
+    columna = 1
+    for nombre_variable in variables:
+        resultado['variables'][nombre_variable] = {}
+        for funcion in FUNCIONES_AGREGADO:
+            resultado['variables'][nombre_variable][funcion] = [fila[columna] for fila in filas]
+            columna += 1
+    return resultado
+
 def _getColor(nombre_usuario: str) -> str:
     '''Método que devuelve el color corporativo asociado al usuario.'''
     try:
-        cursor.execute("SELECT color FROM usuario WHERE nombre_usuario = '"+nombre_usuario+"')")
-        color = cursor.fetchall()[0][0]
+        with _cursor_bd() as cursor:
+            cursor.execute("SELECT color FROM usuario WHERE nombre_usuario = '"+nombre_usuario+"')")
+            color = cursor.fetchall()[0][0]
         return (color if color else None)
 
     except psycopg2.OperationalError as err:
         logging.error('{} => [ERROR] Ha ocurrido un error en la conexión con la base de datos: {}'.format(datetime.utcnow(), err))
-        conectarConBD()
+        raise error_bd_no_disponible
     
     except Exception as err:
         logging.error('{} => [ERROR] Ha ocurrido un error al recuperar el color corporativo del usuario: {}.'.format(datetime.utcnow(), err))
@@ -331,19 +644,45 @@ async def usuario(Authorization: str | None = Header(default=None)):
 
 @app.get("/contar-dashboards")
 async def contarDashboards(nombre_usuario: str):
-    return {'count': _contarDashboards(nombre_usuario)}
+    return {'count': await _en_bd(_contarDashboards, nombre_usuario)}
 
 @app.get("/dashboards")
 async def dashboards(nombre_usuario: str):
-    return _obtenerDashboardsUsuario(nombre_usuario)
+    return await _en_bd(_obtenerDashboardsUsuario, nombre_usuario)
 
 @app.get("/dispositivo")
-async def dispositivo(id_dispositivo:int, fecha_inicio:int, fecha_fin:int):
-    return _recuperar_datos_historicos(id_dispositivo, fecha_inicio, fecha_fin)
+async def dispositivo(id_dispositivo:int, fecha_inicio:int, fecha_fin:int, resolucion: int | None = Query(default=None, ge=3)):
+    return await _en_bd(_recuperar_datos_historicos, id_dispositivo, fecha_inicio, fecha_fin, resolucion)
+
+@app.get("/dispositivo/agregado")
+async def dispositivoAgregado(id_dispositivo:int, fecha_inicio:int, fecha_fin:int, intervalo:int, variables: List[str] = Query()):
+    '''
+    Ejemplo: /dispositivo/agregado?id_dispositivo=1234&fecha_inicio=...&fecha_fin=...&intervalo=3600&variables=medida_ph&variables=medida_o2
+    Los cubos se alinean a múltiplos de "intervalo": se devuelven enteros desde el que contiene fecha_inicio hasta
+    el que contiene fecha_fin, con todas sus muestras aunque queden fuera de [fecha_inicio, fecha_fin].
+    '''
+    return await _en_bd(_agregar_datos_historicos, id_dispositivo, fecha_inicio, fecha_fin, intervalo, variables)
+
+@app.get("/dispositivo/ultimo")
+async def dispositivoUltimo(id_instalacion:str, id_dispositivo:str):
+    '''Último dato recibido del dispositivo ({'timestamp': ms, 'datos': {...}}), sin consultar la base de datos.'''
+    if sesion_crossbar is None:
+        raise error_crossbar_no_disponible
+    try:
+        payload = await sesion_crossbar.call(PROCEDIMIENTO_ULTIMO_VALOR, id_instalacion, id_dispositivo)
+    except Exception as err:
+        logging.error('{} => [ERROR] Error al consultar el ultimo valor de {}.{}: {}'.format(datetime.utcnow(), id_instalacion, id_dispositivo, err))
+        raise error_crossbar_no_disponible
+    if payload is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail='No se ha recibido ningun dato del dispositivo.',
+        )
+    return msgpack.unpackb(payload)
 
 @app.post("/token", response_model=Token)
 async def token(nombre_usuario:str, contrasenya:str):
-    usuario = _autenticarUsuario(nombre_usuario, contrasenya)
+    usuario = await _en_bd(_autenticarUsuario, nombre_usuario, contrasenya)
     if not usuario:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -361,4 +700,4 @@ async def token(nombre_usuario:str, contrasenya:str):
 
 @app.get("/color")
 async def getcolor(nombre_usuario:str):
-    return _getColor(nombre_usuario)
\ No newline at end of file
+    return await _en_bd(_getColor, nombre_usuario)
\ No newline at end of file
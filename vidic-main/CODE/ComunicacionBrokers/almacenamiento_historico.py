@@ -0,0 +1,598 @@
+''' Almacenamiento de los datos históricos de los dispositivos en PostgreSQL.
+
+Lo usa el módulo de entrada (moduloMqtt-tr.py). Cada dispositivo tiene su tabla de datos
+(dispositivo_N) y sus tablas de agregados (dispositivo_N_1m, dispositivo_N_1h y dispositivo_N_1d).
+
+Las muestras no se escriben de una en una: EscritorHistorico las acumula en lotes por tabla
+y las vuelca con COPY, actualizando los agregados y haciendo un único commit por volcado.
+Si la base de datos no está disponible, los lotes se guardan en un spool en disco (spool_ingesta.py)
+y se reenvían cuando se recupera la conexión.
+'''
+import datetime
+import io
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import psycopg2
+from configobj import ConfigObj
+
+from spool_ingesta import MB_SEGMENTO_SPOOL, SpoolIngesta
+
+comunicacion_mosquitto_log = logging.getLogger('com_mosquitto.log')
+
+# Tablas de agregados que se mantienen por dispositivo (dispositivo_N_<sufijo>) y ancho de sus cubos en ms.
+# vidicAPI.py elige entre ellas la tabla más gruesa que sirve para cada consulta: si se cambian, hay que indicarlas
+# también en la sección AGREGADOS_HISTORICOS de APIconfig.ini.
+AGREGADOS_HISTORICOS = OrderedDict([('1m', 60 * 1000), ('1h', 60 * 60 * 1000), ('1d', 24 * 60 * 60 * 1000)])
+# Columnas de las tablas de agregados por cada variable: (sufijo, tipo, expresión para agregar los datos en SQL)
+COLUMNAS_AGREGADO = (
+    ('cuenta', 'INTEGER', 'count({v})'),
+    ('suma', 'DOUBLE PRECISION', 'sum({v})'),
+    ('minimo', 'REAL', 'min({v})'),
+    ('maximo', 'REAL', 'max({v})'),
+    ('primero', 'REAL', '(array_agg({v} ORDER BY {ts}) FILTER (WHERE {v} IS NOT NULL))[1]'),
+    ('ultimo', 'REAL', '(array_agg({v} ORDER BY {ts} DESC) FILTER (WHERE {v} IS NOT NULL))[1]'),
+)
+# Tablas de agregados creadas para una tabla de dispositivo que ya tenía datos: el histórico anterior a "hasta"
+# lo consolida por tramos retencion_historico.py, fuera de la transacción de ingesta ("desde" = hasta dónde va;
+# NULL si todavía no ha empezado). Las muestras de [desde, hasta) que llegan mientras tanto (otro proceso de ingesta,
+# el spool, datos atrasados) no se suman en la ingesta: ya las contará la consolidación.
+TABLA_AGREGADOS_PENDIENTES = 'agregados_pendientes'
+
+# Valores por defecto de la escritura por lotes (se pueden cambiar en la sección HISTORICO de inMQTT.ini)
+TAMANYO_LOTE = 500
+SEGUNDOS_LOTE = 1.0
+# Particionado de las tablas nuevas de dispositivo: 'ninguno', 'diario' o 'mensual'; y cuántas particiones
+# se crean por adelantado además de la del periodo actual.
+PARTICIONADO = 'ninguno'
+PARTICIONES_ADELANTADAS = 2
+# Longitud del sufijo de fecha de cada tipo de partición (dispositivo_N_pAAAAMMDD / dispositivo_N_pAAAAMM)
+FORMATO_PARTICION = {'diario': '%Y%m%d', 'mensual': '%Y%m'}
+# Índice sobre variable_momento (BIGINT, ms desde epoch) de las tablas nuevas: 'btree' o 'brin'.
+# Como las muestras llegan en orden de tiempo, un BRIN ocupa unos pocos KB frente a los MB de un btree
+# y basta para las consultas por intervalo; el btree es mejor si se consultan intervalos muy cortos.
+INDICE_MOMENTO = 'btree'
+# Segundos entre dos intentos de reconexión con la base de datos, y entre dos avisos en el log del
+# tamaño del spool mientras no hay conexión
+SEGUNDOS_REINTENTO_CONEXION = 5
+SEGUNDOS_AVISO_SPOOL = 60
+
+def _iniciar_conexion_db():
+    try:
+        config = ConfigObj('inMQTT.ini')
+        parametros_conexion_bd = config['CONEXION_BASE_DATOS']
+        for clave in parametros_conexion_bd:
+            if(clave not in ('host', 'database', 'user', 'password')):
+                raise Exception('[ERROR]: Error al indicar los parámetros de la conexión a la base de datos')
+
+        conexion_db = psycopg2.connect(host=parametros_conexion_bd['host'], database=parametros_conexion_bd['database'],
+            user=parametros_conexion_bd['user'], password=parametros_conexion_bd['password'])
+
+        cur = conexion_db.cursor()
+        return conexion_db, cur
+
+    except Exception as err:
+        raise err
+
+def _sql_indice_momento(nombre_tabla, indice_momento, variable_ts='variable_momento'):
+    ''' Devuelve el SQL que crea el índice de tipo "indice_momento" ('btree' o 'brin') sobre el timestamp de la tabla. '''
+    if indice_momento == 'brin':
+        return 'CREATE INDEX IF NOT EXISTS {tabla}_{campo}_idx ON {tabla} USING brin ({campo});'.format(tabla=nombre_tabla, campo=variable_ts)
+    return 'CREATE INDEX IF NOT EXISTS {tabla}_{campo}_idx ON {tabla}({campo} ASC);'.format(tabla=nombre_tabla, campo=variable_ts)
+
+def _sql_combinar_agregado(variables):
+    '''
+    Devuelve las asignaciones del "ON CONFLICT (cubo) DO UPDATE" que suman a un cubo existente ("t") los
+    valores de un cubo nuevo de las mismas variables ("EXCLUDED").
+    '''
+    actualizar = ['momento_primero = LEAST(t.momento_primero, EXCLUDED.momento_primero)',
+        'momento_ultimo = GREATEST(t.momento_ultimo, EXCLUDED.momento_ultimo)']
+    for variable in variables:
+        actualizar += [
+            '{c}_cuenta = COALESCE(t.{c}_cuenta, 0) + EXCLUDED.{c}_cuenta'.format(c=variable),
+            '{c}_suma = COALESCE(t.{c}_suma + EXCLUDED.{c}_suma, t.{c}_suma, EXCLUDED.{c}_suma)'.format(c=variable),
+            '{c}_minimo = LEAST(t.{c}_minimo, EXCLUDED.{c}_minimo)'.format(c=variable),
+            '{c}_maximo = GREATEST(t.{c}_maximo, EXCLUDED.{c}_maximo)'.format(c=variable),
+            # Un cubo nuevo sin valores de la variable (p.ej. un tramo consolidado en el que no aparece) no la cambia
+            '{c}_primero = CASE WHEN EXCLUDED.{c}_primero IS NOT NULL AND (t.{c}_primero IS NULL OR EXCLUDED.momento_primero < t.momento_primero) '
+                'THEN EXCLUDED.{c}_primero ELSE t.{c}_primero END'.format(c=variable),
+            '{c}_ultimo = CASE WHEN EXCLUDED.{c}_ultimo IS NOT NULL AND (t.{c}_ultimo IS NULL OR EXCLUDED.momento_ultimo >= t.momento_ultimo) '
+                'THEN EXCLUDED.{c}_ultimo ELSE t.{c}_ultimo END'.format(c=variable),
+        ]
+    return actualizar
+
+def _sql_consolidar_agregado(nombre_tabla, sufijo, variables, variable_ts='variable_momento', desde=None, hasta=None, tabla_origen=None, combinar=False):
+    '''
+    Devuelve el SQL que agrega los datos de la tabla del dispositivo (opcionalmente solo los del intervalo
+    [desde, hasta) o los de una de sus particiones, "tabla_origen") en su tabla de agregados "sufijo".
+    Los cubos que ya existan no se modifican, salvo con "combinar", en cuyo caso se les suman los datos
+    (para consolidar por tramos un histórico cuyos cubos pueden estar ya empezados).
+    '''
+    ancho = AGREGADOS_HISTORICOS[sufijo]
+    columnas = ['cubo', 'momento_primero', 'momento_ultimo']
+    expresiones = ['floor({ts} / {ancho}) * {ancho}'.format(ts=variable_ts, ancho=ancho), 'min({})'.format(variable_ts), 'max({})'.format(variable_ts)]
+    for variable in variables:
+        for columna, _, expresion in COLUMNAS_AGREGADO:
+            columnas.append('{}_{}'.format(variable, columna))
+            expresiones.append(expresion.format(v=variable, ts=variable_ts))
+    condiciones = []
+    if desde is not None:
+        condiciones.append('{} >= {}'.format(variable_ts, int(desde)))
+    if hasta is not None:
+        condiciones.append('{} < {}'.format(variable_ts, int(hasta)))
+    return 'INSERT INTO {agregado} AS t ({columnas}) SELECT {expresiones} FROM {tabla}{donde} GROUP BY 1 ON CONFLICT (cubo) DO {accion};'.format(
+        agregado='{}_{}'.format(nombre_tabla, sufijo), columnas=', '.join(columnas), expresiones=', '.join(expresiones),
+        tabla=tabla_origen or nombre_tabla, donde=' WHERE ' + ' AND '.join(condiciones) if condiciones else '',
+        accion='UPDATE SET ' + ', '.join(_sql_combinar_agregado(variables)) if combinar else 'NOTHING')
+
+def _pendiente_de_consolidar(momento, consolidacion):
+    ''' True si la consolidación (desde, hasta) de TABLA_AGREGADOS_PENDIENTES todavía tiene que contar la muestra. '''
+    desde, hasta = consolidacion
+    return momento < hasta and (desde is None or momento >= desde)
+
+def _acumular_agregados(agregados, momento, datos, consolidaciones=None):
+    '''
+    Acumula una muestra en el cubo que le corresponde de cada tabla de agregados, salvo en las que la muestra
+    queda dentro de su consolidación pendiente ("consolidaciones" -> {sufijo: (desde, hasta)}).
+    agregados -> {sufijo: {cubo: {'momento_primero', 'momento_ultimo', 'variables': {id_variable: [cuenta, suma, minimo,
+                  maximo, momento_primero, primero, momento_ultimo, ultimo]}}}}
+    '''
+    for sufijo, ancho in AGREGADOS_HISTORICOS.items():
+        if consolidaciones and sufijo in consolidaciones and _pendiente_de_consolidar(momento, consolidaciones[sufijo]):
+            continue
+        cubo = momento - momento % ancho
+        acumulado = agregados.setdefault(sufijo, {}).setdefault(cubo, {'momento_primero': momento, 'momento_ultimo': momento, 'variables': {}})
+        acumulado['momento_primero'] = min(acumulado['momento_primero'], momento)
+        acumulado['momento_ultimo'] = max(acumulado['momento_ultimo'], momento)
+        for id_variable, valor in datos.items():
+            if id_variable == 'momento' or not isinstance(valor, (int, float)):
+                continue
+            if isinstance(valor, bool):
+                valor = int(valor)
+            variable = acumulado['variables'].get(id_variable)
+            if variable is None:
+                acumulado['variables'][id_variable] = [1, valor, valor, valor, momento, valor, momento, valor]
+                continue
+            variable[0] += 1
+            variable[1] += valor
+            variable[2] = min(variable[2], valor)
+            variable[3] = max(variable[3], valor)
+            if momento < variable[4]:
+                variable[4], variable[5] = momento, valor
+            if momento >= variable[6]:
+                variable[6], variable[7] = momento, valor
+
+def _limites_particion(momento, particionado):
+    '''
+    Devuelve (sufijo, inicio, fin) de la partición diaria o mensual (en UTC) que contiene el momento dado en ms.
+    La partición cubre el intervalo [inicio, fin) en ms.
+    '''
+    fecha = datetime.datetime.fromtimestamp(momento / 1000.0, tz=datetime.timezone.utc)
+    if particionado == 'diario':
+        inicio = datetime.datetime(fecha.year, fecha.month, fecha.day, tzinfo=datetime.timezone.utc)
+        fin = inicio + datetime.timedelta(days=1)
+    else:
+        inicio = datetime.datetime(fecha.year, fecha.month, 1, tzinfo=datetime.timezone.utc)
+        fin = datetime.datetime(fecha.year + fecha.month // 12, fecha.month % 12 + 1, 1, tzinfo=datetime.timezone.utc)
+    return inicio.strftime(FORMATO_PARTICION[particionado]), int(inicio.timestamp() * 1000), int(fin.timestamp() * 1000)
+
+def _valor_copy(valor) -> str:
+    ''' Representación de un valor en el formato de texto de COPY. '''
+    if valor is None:
+        return '\\N'
+    if isinstance(valor, bool):
+        return str(int(valor))
+    return str(valor)
+
+
+class EscritorHistorico:
+    '''
+    Escritura diferida ("write-behind") de los datos históricos en la base de datos.
+    Las muestras se acumulan en un lote por tabla y se vuelcan cuando un lote llega a "tamanyo_lote"
+    muestras o, como mucho, cada "segundos_lote" segundos. Cada volcado escribe con COPY todas las
+    tablas pendientes, actualiza sus agregados y hace un único commit.
+    Con "directorio_spool", los lotes que no se pueden escribir porque no hay conexión se guardan en disco y se
+    reenvían en orden (un segmento por volcado) al reconectar; los lotes nuevos esperan en el spool detrás de ellos.
+    '''
+
+    def __init__(self, tamanyo_lote: int = TAMANYO_LOTE, segundos_lote: float = SEGUNDOS_LOTE,
+            particionado: str = PARTICIONADO, particiones_adelantadas: int = PARTICIONES_ADELANTADAS,
+            indice_momento: str = INDICE_MOMENTO, directorio_spool: str = '', mb_segmento_spool: float = MB_SEGMENTO_SPOOL):
+        if particionado not in ('ninguno', 'diario', 'mensual'):
+            raise Exception('[ERROR]: Tipo de particionado no valido: {}'.format(particionado))
+        if indice_momento not in ('btree', 'brin'):
+            raise Exception('[ERROR]: Tipo de indice no valido: {}'.format(indice_momento))
+        self.conexion_db = self.cursor = None
+        self.ultimo_intento_conexion = float('-inf')
+        self.spool = SpoolIngesta(directorio_spool, mb_segmento_spool) if directorio_spool else None
+        self.ultimo_aviso_spool = float('-inf')
+        self.tamanyo_lote = int(tamanyo_lote)
+        self.segundos_lote = float(segundos_lote)
+        self.particionado = particionado
+        self.particiones_adelantadas = int(particiones_adelantadas)
+        self.indice_momento = indice_momento
+        # nombre_tabla -> lista de muestras pendientes de escribir ({id_variable: valor, ..., 'momento': ms})
+        self.lotes = {}
+        # Caché del esquema: tabla de dispositivo existente -> conjunto de sus columnas. Solo se invalida
+        # cuando este escritor crea o modifica una tabla (o si falla su escritura).
+        self.esquema = {}
+        # Caché de particiones: tabla de dispositivo -> {'particionado': 'diario'|'mensual', 'particiones': {nombres}},
+        # o None si la tabla no está particionada.
+        self.particiones = {}
+        # Tablas de dispositivo cuyas tablas de agregados ya se han comprobado en este proceso.
+        self.tablas_con_agregados = set()
+        # Tablas de dispositivo sin consolidaciones pendientes: ya no pueden aparecer (solo se anotan al crear sus
+        # tablas de agregados), así que no hace falta volver a consultarlas.
+        self.tablas_consolidadas = set()
+        # "cerrojo_lotes" protege los lotes; "cerrojo_volcado" impide dos volcados a la vez sobre la misma conexión.
+        self.cerrojo_lotes = threading.Lock()
+        self.cerrojo_volcado = threading.Lock()
+        self._conectar()
+        self.detener = threading.Event()
+        self.hilo_volcado = threading.Thread(target=self._volcar_periodicamente, name='volcado-historico', daemon=True)
+        self.hilo_volcado.start()
+
+    def almacenar(self, payload):
+        '''
+        Añade al lote de su tabla la muestra recibida de un dispositivo:
+            payload -> {'timestamp': ms, 'datos': {'id_dispositivo': N, 'datos': {id_variable: valor, ...}, ...}}
+        '''
+        datos_generales = payload['datos']
+        nombre_tabla = 'dispositivo_{id_dispositivo}'.format(id_dispositivo=datos_generales['id_dispositivo'])
+        datos = dict(datos_generales['datos'])
+        datos['momento'] = int(payload['timestamp'])
+        with self.cerrojo_lotes:
+            lote = self.lotes.setdefault(nombre_tabla, [])
+            lote.append(datos)
+            lote_lleno = len(lote) >= self.tamanyo_lote
+        if lote_lleno:
+            self.volcar()
+
+    def volcar(self):
+        '''
+        Escribe en la base de datos todos los lotes pendientes con un único commit.
+        Si falla la escritura de una tabla, solo se pierden las muestras de esa tabla. Si no hay conexión o no se
+        puede confirmar la transacción, los lotes van al spool (o se pierden si no hay spool configurado).
+        '''
+        with self.cerrojo_volcado:
+            with self.cerrojo_lotes:
+                lotes, self.lotes = self.lotes, {}
+            if self.spool is not None:
+                if lotes and (self.spool.pendiente() or not self._conectar()):
+                    # Con datos en el spool, los lotes nuevos van detrás de ellos para conservar el orden.
+                    self._guardar_en_spool(lotes)
+                    lotes = {}
+                if self.spool.pendiente() and self._conectar():
+                    self._reenviar_spool()
+            if lotes and not self._escribir_lotes(lotes):
+                if self.spool is not None:
+                    self._guardar_en_spool(lotes)
+                else:
+                    comunicacion_mosquitto_log.error('[ERROR]: No se ha podido escribir en la base de datos: se pierden {} muestras.'.format(sum(len(muestras) for muestras in lotes.values())))
+
+    def cerrar(self):
+        ''' Detiene el volcado periódico, escribe (o guarda en el spool) lo pendiente y cierra la conexión. '''
+        self.detener.set()
+        self.volcar()
+        if self.spool is not None:
+            self.spool.cerrar()
+        if self.conexion_db is not None:
+            self.conexion_db.close()
+
+    def _conectar(self):
+        '''
+        Devuelve True si hay conexión con la base de datos. Si se ha perdido, intenta reconectar
+        (como mucho una vez cada SEGUNDOS_REINTENTO_CONEXION segundos).
+        '''
+        if self.conexion_db is not None and not self.conexion_db.closed:
+            return True
+        if time.monotonic() - self.ultimo_intento_conexion < SEGUNDOS_REINTENTO_CONEXION:
+            return False
+        self.ultimo_intento_conexion = time.monotonic()
+        try:
+            self.conexion_db, self.cursor = _iniciar_conexion_db()
+        except psycopg2.OperationalError as err:
+            comunicacion_mosquitto_log.error('[ERROR]: No se ha podido conectar con la base de datos: {}'.format(err))
+            return False
+        # Las tablas pueden haber cambiado mientras no había conexión: se vuelve a leer el esquema.
+        self._vaciar_caches()
+        comunicacion_mosquitto_log.info('Conexion con la base de datos establecida.')
+        return True
+
+    def _vaciar_caches(self):
+        self.esquema.clear()
+        self.particiones.clear()
+        self.tablas_con_agregados.clear()
+        self.tablas_consolidadas.clear()
+
+    def _escribir_lotes(self, lotes):
+        '''
+        Escribe los lotes en una transacción. Si falla una tabla, solo se descartan sus muestras (se deshace su
+        savepoint) y se confirma el resto. Devuelve False si no se ha podido confirmar la transacción, por falta
+        de conexión o por cualquier otro error: no se ha confirmado nada y los lotes se pueden volver a intentar.
+        '''
+        if not self._conectar():
+            return False
+        try:
+            # Siempre en el mismo orden, para que dos procesos que escriben en las mismas tablas de agregados
+            # no se bloqueen mutuamente (deadlock)
+            for nombre_tabla, muestras in sorted(lotes.items()):
+                self.cursor.execute('SAVEPOINT lote_tabla;')
+                try:
+                    self._preparar_tabla(nombre_tabla, muestras)
+                    self._copiar_muestras(nombre_tabla, muestras)
+                    consolidaciones = self._consolidaciones_pendientes(nombre_tabla)
+                    agregados = {}
+                    for datos in muestras:
+                        _acumular_agregados(agregados, datos['momento'], datos, consolidaciones)
+                    self._volcar_agregados(nombre_tabla, agregados)
+                    self.cursor.execute('RELEASE SAVEPOINT lote_tabla;')
+                except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                    raise
+                except Exception as err:
+                    self.cursor.execute('ROLLBACK TO SAVEPOINT lote_tabla;')
+                    self.esquema.pop(nombre_tabla, None)
+                    self.particiones.pop(nombre_tabla, None)
+                    self.tablas_con_agregados.discard(nombre_tabla)
+                    self.tablas_consolidadas.discard(nombre_tabla)
+                    comunicacion_mosquitto_log.error('[ERROR]: No se han podido almacenar {} muestras en {}: {}'.format(len(muestras), nombre_tabla, err))
+            self.conexion_db.commit()
+            comunicacion_mosquitto_log.debug('Lote de {} muestras almacenado en la base de datos.'.format(sum(len(muestras) for muestras in lotes.values())))
+
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as err:
+            comunicacion_mosquitto_log.error('[ERROR]: Se ha perdido la conexion con la base de datos: {}'.format(err))
+            try:
+                self.conexion_db.close()
+            except psycopg2.Error:
+                pass
+            return False
+
+        except Exception as err:
+            try:
+                self.conexion_db.rollback()
+            except psycopg2.Error:
+                pass
+            # Puede haberse deshecho la creación de alguna tabla: se vuelve a leer el esquema.
+            self._vaciar_caches()
+            comunicacion_mosquitto_log.error('[ERROR]: Error al volcar el lote de datos historicos: {}'.format(err))
+            return False
+        return True
+
+    def _guardar_en_spool(self, lotes):
+        try:
+            self.spool.guardar(lotes)
+        except OSError as err:
+            comunicacion_mosquitto_log.error('[ERROR]: No se ha podido guardar el lote en el spool: se pierden {} muestras. {}'.format(
+                sum(len(muestras) for muestras in lotes.values()), err))
+            return
+        if time.monotonic() - self.ultimo_aviso_spool >= SEGUNDOS_AVISO_SPOOL:
+            self.ultimo_aviso_spool = time.monotonic()
+            comunicacion_mosquitto_log.warning('Datos historicos pendientes en el spool {}: {:.1f} MB en {} segmentos.'.format(
+                self.spool.directorio, self.spool.pendiente() / 2**20, len(self.spool.segmentos)))
+
+    def _reenviar_spool(self):
+        ''' Reenvía el segmento más antiguo del spool en una única transacción y lo elimina si se ha confirmado. '''
+        ruta, registros = self.spool.primer_segmento()
+        lotes = {}
+        for registro in registros:
+            for nombre_tabla, muestras in registro.items():
+                lotes.setdefault(nombre_tabla, []).extend(muestras)
+        if lotes and not self._escribir_lotes(lotes):
+            return
+        self.spool.eliminar_segmento(ruta)
+        comunicacion_mosquitto_log.info('Reenviadas {} muestras del spool. Pendiente: {:.1f} MB en {} segmentos.'.format(
+            sum(len(muestras) for muestras in lotes.values()), self.spool.pendiente() / 2**20, len(self.spool.segmentos)))
+
+    def _volcar_periodicamente(self):
+        while not self.detener.wait(self.segundos_lote):
+            self.volcar()
+
+    def _preparar_tabla(self, nombre_tabla, muestras):
+        '''
+        Crea la tabla del dispositivo y sus tablas de agregados si todavía no existen, y les añade las
+        variables nuevas que aparezcan en las muestras (p.ej. si se configura una variable más en el dispositivo).
+        Con el esquema en caché, una tabla ya conocida y sin variables nuevas no necesita ninguna consulta.
+        '''
+        ids_variables = list(OrderedDict.fromkeys(id_variable for datos in muestras for id_variable in datos if id_variable != 'momento'))
+        columnas = self._esquema_tabla(nombre_tabla)
+        if not columnas or nombre_tabla not in self.tablas_con_agregados or any('variable_' + id_variable not in columnas for id_variable in ids_variables):
+            # Puede haber varios procesos de ingesta escribiendo en la misma tabla: los cambios de esquema se
+            # serializan con un bloqueo de la transacción y se vuelve a leer el esquema ya con el bloqueo.
+            self.cursor.execute('SELECT pg_advisory_xact_lock(hashtext(%s));', (nombre_tabla,))
+            self.esquema.pop(nombre_tabla, None)
+            columnas = self._esquema_tabla(nombre_tabla)
+        if (not columnas):
+            self._crear_tabla_sql(nombre_tabla, ids_variables, 'variable_momento')
+        else:
+            if (nombre_tabla not in self.tablas_con_agregados):
+                # La tabla ya existe, pero puede ser anterior a las tablas de agregados: los agregados se mantienen
+                # desde las muestras de este lote, y lo anterior se consolida fuera de la ingesta.
+                self._crear_tablas_agregados(nombre_tabla, consolidar_hasta=min(datos['momento'] for datos in muestras))
+            nuevas = [id_variable for id_variable in ids_variables if 'variable_' + id_variable not in columnas]
+            if nuevas:
+                self._anyadir_variables(nombre_tabla, nuevas)
+        self._asegurar_particiones(nombre_tabla, muestras)
+
+    def _particiones_tabla(self, nombre_tabla):
+        '''
+        Particiones de la tabla del dispositivo, leídas de la caché o, la primera vez, de la base de datos.
+        Devuelve None si la tabla no está particionada (p.ej. las tablas creadas antes de usar particiones).
+        '''
+        if nombre_tabla not in self.particiones:
+            self.cursor.execute("SELECT c.relkind, ARRAY(SELECT h.relname FROM pg_inherits AS i JOIN pg_class AS h ON h.oid = i.inhrelid WHERE i.inhparent = c.oid) "
+                "FROM pg_class AS c WHERE c.relname = %s AND c.relnamespace = 'public'::regnamespace;", (nombre_tabla,))
+            fila = self.cursor.fetchall()
+            if not fila or fila[0][0] != 'p':
+                self.particiones[nombre_tabla] = None
+            else:
+                nombres = set(fila[0][1])
+                # Cada tabla mantiene el tipo de partición con el que se creó, aunque se cambie la configuración.
+                particionado = self.particionado if self.particionado != 'ninguno' else 'mensual'
+                if nombres:
+                    sufijo = next(iter(nombres))[len(nombre_tabla) + len('_p'):]
+                    particionado = 'diario' if len(sufijo) == 8 else 'mensual'
+                self.particiones[nombre_tabla] = {'particionado': particionado, 'particiones': nombres}
+        return self.particiones[nombre_tabla]
+
+    def _asegurar_particiones(self, nombre_tabla, muestras):
+        '''
+        Crea las particiones que necesitan las muestras del lote y las de los próximos "particiones_adelantadas"
+        periodos, para que al cambiar de día o de mes la partición ya exista.
+        '''
+        particiones = self._particiones_tabla(nombre_tabla)
+        if particiones is None:
+            return
+        necesarias = {}
+        # Periodos que cubren las muestras del lote
+        momento = min(datos['momento'] for datos in muestras)
+        hasta = max(datos['momento'] for datos in muestras)
+        while momento <= hasta:
+            sufijo, inicio, fin = _limites_particion(momento, particiones['particionado'])
+            necesarias[sufijo] = (inicio, fin)
+            momento = fin
+        # Periodo actual y los siguientes
+        momento = int(time.time() * 1000)
+        for _ in range(self.particiones_adelantadas + 1):
+            sufijo, inicio, fin = _limites_particion(momento, particiones['particionado'])
+            necesarias[sufijo] = (inicio, fin)
+            momento = fin
+        for sufijo, (inicio, fin) in sorted(necesarias.items()):
+            nombre_particion = '{}_p{}'.format(nombre_tabla, sufijo)
+            if nombre_particion in particiones['particiones']:
+                continue
+            self.cursor.execute('SELECT pg_advisory_xact_lock(hashtext(%s));', (nombre_tabla,))
+            self.cursor.execute('CREATE TABLE IF NOT EXISTS {} PARTITION OF {} FOR VALUES FROM ({}) TO ({});'.format(nombre_particion, nombre_tabla, inicio, fin))
+            particiones['particiones'].add(nombre_particion)
+
+    def _esquema_tabla(self, nombre_tabla):
+        ''' Columnas de la tabla (conjunto vacío si no existe), leídas de la caché o, la primera vez, de la base de datos. '''
+        columnas = self.esquema.get(nombre_tabla)
+        if columnas is None:
+            columnas = set(self._columnas_tabla(nombre_tabla))
+            if columnas:
+                self.esquema[nombre_tabla] = columnas
+        return columnas
+
+    def _crear_tabla_sql(self, nombre_tabla, lista_variables_tabla, variable_ts, ts_registro=None):
+        '''
+        Crea la tabla del dispositivo y sus tablas de agregados. "variable_ts" se guarda como BIGINT en ms
+        (las comparaciones de enteros son mucho más baratas que las de NUMERIC). Si hay particionado configurado,
+        la tabla se particiona por rangos de "variable_ts" y las consultas por intervalo de tiempo solo recorren
+        las particiones que lo cubren.
+        '''
+        self.esquema.pop(nombre_tabla, None)
+        self.particiones.pop(nombre_tabla, None)
+        sql = 'CREATE TABLE IF NOT EXISTS {} ({}'.format(nombre_tabla, 'ts INTEGER,' if ts_registro else '')
+        for id_variable in lista_variables_tabla:
+            nombre_variable = 'variable_' + str(id_variable)
+            # Asumimos que todas las variables serán de tipo REAL excepto la de timestamp
+            sql += '{} {},'.format(nombre_variable, 'REAL')
+        sql += '{} {},'.format(variable_ts, 'BIGINT')
+        sql = sql[:-1] + ')'
+        if self.particionado != 'ninguno':
+            sql += ' PARTITION BY RANGE ({})'.format(variable_ts)
+        self.cursor.execute(sql + ';')
+
+        # Crear indice sobre el campo de timestamp (btree o BRIN según la configuración)
+        self.cursor.execute(_sql_indice_momento(nombre_tabla, self.indice_momento, variable_ts))
+
+        self._crear_tablas_agregados(nombre_tabla, variable_ts)
+
+    def _anyadir_variables(self, nombre_tabla, ids_variables):
+        '''
+        Añade las variables a la tabla del dispositivo y a sus tablas de agregados, con un único ALTER TABLE por tabla.
+        '''
+        self.esquema.pop(nombre_tabla, None)
+        sql = 'ALTER TABLE {} '.format(nombre_tabla) + ', '.join('ADD COLUMN IF NOT EXISTS variable_{} REAL'.format(id_variable) for id_variable in ids_variables) + ';'
+        self.cursor.execute(sql)
+        for sufijo in AGREGADOS_HISTORICOS:
+            sql = 'ALTER TABLE {}_{} '.format(nombre_tabla, sufijo) + ', '.join('ADD COLUMN IF NOT EXISTS variable_{}_{} {}'.format(id_variable, columna, tipo)
+                for id_variable in ids_variables for columna, tipo, _ in COLUMNAS_AGREGADO) + ';'
+            self.cursor.execute(sql)
+        comunicacion_mosquitto_log.info('Variables nuevas en {}: {}'.format(nombre_tabla, ', '.join(ids_variables)))
+
+    def _columnas_tabla(self, nombre_tabla):
+        self.cursor.execute("SELECT column_name FROM information_schema.columns WHERE table_schema='public' AND table_name=%s ORDER BY ordinal_position;", (nombre_tabla,))
+        return [fila[0] for fila in self.cursor.fetchall()]
+
+    def _crear_tablas_agregados(self, nombre_tabla, variable_ts='variable_momento', consolidar_hasta=None):
+        '''
+        Crea, si no existen, las tablas de agregados (1 minuto, 1 hora y 1 día) del dispositivo con las mismas
+        variables que su tabla de datos. Con "consolidar_hasta" (la tabla de datos ya existía), cada tabla de agregados
+        nueva se anota en TABLA_AGREGADOS_PENDIENTES para que retencion_historico.py la rellene con los datos anteriores
+        a ese momento: recorrer todo el histórico aquí bloquearía la ingesta mientras dure.
+        '''
+        variables = [columna for columna in self._esquema_tabla(nombre_tabla) if columna.startswith('variable_') and columna != variable_ts]
+        for sufijo in AGREGADOS_HISTORICOS:
+            tabla_agregado = '{}_{}'.format(nombre_tabla, sufijo)
+            self.cursor.execute('SELECT to_regclass(%s) IS NOT NULL;', (tabla_agregado,))
+            existia = self.cursor.fetchall()[0][0]
+            sql = 'CREATE TABLE IF NOT EXISTS {} (cubo BIGINT PRIMARY KEY, momento_primero BIGINT, momento_ultimo BIGINT'.format(tabla_agregado)
+            for variable in variables:
+                for columna, tipo, _ in COLUMNAS_AGREGADO:
+                    sql += ', {}_{} {}'.format(variable, columna, tipo)
+            self.cursor.execute(sql + ');')
+            if not existia and consolidar_hasta is not None:
+                self._anotar_consolidacion(tabla_agregado, consolidar_hasta)
+        self.tablas_con_agregados.add(nombre_tabla)
+
+    def _anotar_consolidacion(self, tabla_agregado, hasta):
+        self.cursor.execute('SELECT pg_advisory_xact_lock(hashtext(%s));', (TABLA_AGREGADOS_PENDIENTES,))
+        self.cursor.execute('CREATE TABLE IF NOT EXISTS {} (tabla_agregado TEXT PRIMARY KEY, desde BIGINT, hasta BIGINT NOT NULL);'.format(TABLA_AGREGADOS_PENDIENTES))
+        self.cursor.execute('INSERT INTO {} (tabla_agregado, hasta) VALUES (%s, %s) ON CONFLICT (tabla_agregado) DO NOTHING;'.format(TABLA_AGREGADOS_PENDIENTES),
+            (tabla_agregado, int(hasta)))
+        comunicacion_mosquitto_log.info('Tabla de agregados {} creada: el historico anterior se consolidara por tramos.'.format(tabla_agregado))
+
+    def _consolidaciones_pendientes(self, nombre_tabla):
+        '''
+        Devuelve {sufijo: (desde, hasta)} con las consolidaciones pendientes de las tablas de agregados del dispositivo.
+        Las filas se bloquean (FOR SHARE) hasta el commit: retencion_historico.py actualiza "desde" antes de consolidar
+        cada tramo, así que espera a que se confirmen estas muestras y las ve, o esta ingesta espera y ve el nuevo "desde".
+        '''
+        if nombre_tabla in self.tablas_consolidadas:
+            return {}
+        self.cursor.execute('SELECT to_regclass(%s) IS NOT NULL;', (TABLA_AGREGADOS_PENDIENTES,))
+        consolidaciones = {}
+        if self.cursor.fetchall()[0][0]:
+            self.cursor.execute('SELECT tabla_agregado, desde, hasta FROM {} WHERE tabla_agregado = ANY(%s) FOR SHARE;'.format(TABLA_AGREGADOS_PENDIENTES),
+                (['{}_{}'.format(nombre_tabla, sufijo) for sufijo in AGREGADOS_HISTORICOS],))
+            consolidaciones = {tabla_agregado.rsplit('_', 1)[1]: (desde, hasta) for tabla_agregado, desde, hasta in self.cursor.fetchall()}
+        if not consolidaciones:
+            self.tablas_consolidadas.add(nombre_tabla)
+        return consolidaciones
+
+    def _copiar_muestras(self, nombre_tabla, muestras):
+        '''
+        Escribe las muestras con COPY. Las muestras con las mismas variables se escriben en el mismo COPY
+        (normalmente todas las de un dispositivo).
+        '''
+        grupos = OrderedDict()
+        for datos in muestras:
+            grupos.setdefault(tuple(datos), []).append(datos)
+        for ids_variables, grupo in grupos.items():
+            buffer = io.StringIO()
+            for datos in grupo:
+                buffer.write('\t'.join(_valor_copy(datos[id_variable]) for id_variable in ids_variables) + '\n')
+            buffer.seek(0)
+            columnas = ', '.join('variable_' + id_variable for id_variable in ids_variables)
+            self.cursor.copy_expert('COPY {} ({}) FROM STDIN;'.format(nombre_tabla, columnas), buffer)
+
+    def _volcar_agregados(self, nombre_tabla, agregados):
+        '''
+        Suma los cubos acumulados con _acumular_agregados a las tablas de agregados del dispositivo (un upsert por cubo).
+        No hace commit: se confirma junto con la inserción de los datos.
+        '''
+        for sufijo, cubos in agregados.items():
+            for cubo, acumulado in cubos.items():
+                columnas = ['cubo', 'momento_primero', 'momento_ultimo']
+                valores = [cubo, acumulado['momento_primero'], acumulado['momento_ultimo']]
+                for id_variable, (cuenta, suma, minimo, maximo, _, primero, _, ultimo) in acumulado['variables'].items():
+                    columnas += ['variable_{}_{}'.format(id_variable, columna) for columna, _, _ in COLUMNAS_AGREGADO]
+                    valores += [cuenta, suma, minimo, maximo, primero, ultimo]
+                actualizar = _sql_combinar_agregado(['variable_' + id_variable for id_variable in acumulado['variables']])
+                sql = 'INSERT INTO {tabla} AS t ({columnas}) VALUES ({valores}) ON CONFLICT (cubo) DO UPDATE SET {actualizar};'.format(
+                    tabla='{}_{}'.format(nombre_tabla, sufijo), columnas=', '.join(columnas),
+                    valores=', '.join(['%s'] * len(valores)), actualizar=', '.join(actualizar))
+                self.cursor.execute(sql, valores)
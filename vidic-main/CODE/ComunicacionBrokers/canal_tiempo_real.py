@@ -0,0 +1,126 @@
+''' Canal de tiempo real entre los procesos de ingesta y el proceso publicador del Crossbar.
+
+El canal es una multiprocessing.Queue acotada ("lotes_en_cola") de lotes de mensajes [topic, payload]:
+cada proceso de ingesta agrupa los mensajes en lotes de hasta "mensajes_por_lote" o "segundos_lote"
+segundos, de forma que se serializa y se pasa entre procesos un lote en lugar de cada mensaje.
+Si el publicador no da abasto y la cola se llena, se aplica "politica_cola_llena":
+    conflacionar       -> el lote se queda en el proceso de ingesta conservando solo el último mensaje
+                          de cada topic y se reintenta el envío cada "segundos_lote" (política por defecto).
+    descartar_antiguos -> se descarta el lote más antiguo de la cola para hacer sitio al nuevo.
+    descartar_nuevos   -> se descarta el lote nuevo.
+En el publicador, con "publicaciones_por_segundo" > 0, los lotes recibidos se conflacionan (ConflacionTiempoReal):
+solo se guarda el último payload de cada topic (instalacion.dispositivo) y se publica como mucho
+"publicaciones_por_segundo" veces por segundo y topic. Los paneles muestran siempre el dato más reciente
+y lo pendiente de publicar nunca pasa de un mensaje por topic.
+
+Configuración (sección TIEMPO_REAL de inMQTT.ini): lotes_en_cola, mensajes_por_lote, segundos_lote, politica_cola_llena,
+publicaciones_por_segundo
+'''
+import logging
+import queue
+import time
+from collections import OrderedDict
+
+comunicacion_mosquitto_log = logging.getLogger('com_mosquitto.log')
+
+LOTES_EN_COLA = 100
+MENSAJES_POR_LOTE = 200
+SEGUNDOS_LOTE = 0.05
+POLITICA_COLA_LLENA = 'conflacionar'
+PUBLICACIONES_POR_SEGUNDO = 10
+SEGUNDOS_AVISO_DESCARTES = 10
+
+
+class EmisorTiempoReal:
+    '''
+    Lado de los procesos de ingesta del canal de tiempo real. Lo usa un único hilo (el de decodificación
+    de la tubería de ingesta), que debe llamar a vaciar() periódicamente aunque no lleguen mensajes.
+    '''
+
+    def __init__(self, cola, mensajes_por_lote: int = MENSAJES_POR_LOTE, segundos_lote: float = SEGUNDOS_LOTE,
+            politica_cola_llena: str = POLITICA_COLA_LLENA):
+        if politica_cola_llena not in ('conflacionar', 'descartar_antiguos', 'descartar_nuevos'):
+            raise Exception('[ERROR]: Politica de cola llena no valida: {}'.format(politica_cola_llena))
+        self.cola = cola
+        self.mensajes_por_lote = int(mensajes_por_lote)
+        self.segundos_lote = float(segundos_lote)
+        self.politica_cola_llena = politica_cola_llena
+        self.lote = []
+        # Con la cola llena y la política "conflacionar": topic -> último payload pendiente de enviar
+        self.conflacionado = None
+        self.inicio_lote = None
+        self.descartados = 0
+        self.descartados_avisados = 0
+        self.ultimo_aviso = float('-inf')
+
+    def enviar(self, topic, payload):
+        if self.conflacionado is not None:
+            if self.conflacionado.pop(topic, None) is not None:
+                self.descartados += 1
+            self.conflacionado[topic] = payload
+        else:
+            self.lote.append([topic, payload])
+        if self.inicio_lote is None:
+            self.inicio_lote = time.monotonic()
+        if len(self.lote) >= self.mensajes_por_lote or time.monotonic() - self.inicio_lote >= self.segundos_lote:
+            self.vaciar()
+
+    def vaciar(self):
+        ''' Pasa el lote pendiente al canal, aplicando la política de cola llena si no cabe. '''
+        lote = [[topic, payload] for topic, payload in self.conflacionado.items()] if self.conflacionado is not None else self.lote
+        if not lote:
+            return
+        try:
+            self.cola.put_nowait(lote)
+        except queue.Full:
+            if self.politica_cola_llena == 'conflacionar':
+                if self.conflacionado is None:
+                    self.conflacionado = OrderedDict()
+                    for topic, payload in self.lote:
+                        if self.conflacionado.pop(topic, None) is not None:
+                            self.descartados += 1
+                        self.conflacionado[topic] = payload
+                    self.lote = []
+                self.inicio_lote = time.monotonic()
+                self._avisar_descartes()
+                return
+            if self.politica_cola_llena == 'descartar_antiguos':
+                try:
+                    self.descartados += len(self.cola.get_nowait())
+                    self.cola.put_nowait(lote)
+                except (queue.Empty, queue.Full):
+                    self.descartados += len(lote)
+            else:
+                self.descartados += len(lote)
+            self._avisar_descartes()
+        self.lote = []
+        self.conflacionado = None
+        self.inicio_lote = None
+
+    def _avisar_descartes(self):
+        if self.descartados == self.descartados_avisados or time.monotonic() - self.ultimo_aviso < SEGUNDOS_AVISO_DESCARTES:
+            return
+        comunicacion_mosquitto_log.warning('Canal de tiempo real lleno ({}): {} mensajes descartados ({} en total).'.format(
+            self.politica_cola_llena, self.descartados - self.descartados_avisados, self.descartados))
+        self.descartados_avisados = self.descartados
+        self.ultimo_aviso = time.monotonic()
+
+
+class ConflacionTiempoReal:
+    ''' Lado del publicador: último payload de cada topic pendiente de publicar. '''
+
+    def __init__(self):
+        self.pendientes = OrderedDict()
+        # Mensajes sustituidos por otro más reciente del mismo topic antes de publicarse
+        self.conflacionados = 0
+
+    def actualizar(self, lote):
+        for topic, payload in lote:
+            if self.pendientes.pop(topic, None) is not None:
+                self.conflacionados += 1
+            self.pendientes[topic] = payload
+
+    def extraer(self):
+        ''' Devuelve los mensajes pendientes ([topic, payload], del topic actualizado hace más tiempo al más reciente) y los olvida. '''
+        pendientes, self.pendientes = self.pendientes, OrderedDict()
+        return [[topic, payload] for topic, payload in pendientes.items()]
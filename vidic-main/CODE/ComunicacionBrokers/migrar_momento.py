@@ -0,0 +1,124 @@
+''' Migración de las tablas de dispositivo a variable_momento BIGINT (ms desde epoch).
+
+Las tablas creadas con versiones anteriores del módulo de entrada guardan variable_momento como NUMERIC
+con un índice btree. Este script convierte variable_momento a BIGINT y rehace su índice con el tipo
+indicado (btree o brin), cada tabla en su propia transacción:
+    - Tablas sin particionar: ALTER COLUMN ... TYPE BIGINT (reescribe la tabla).
+    - Tablas particionadas: la columna es la clave de partición y no se puede cambiar su tipo, así que se
+      crea una tabla particionada nueva con BIGINT y se le pasan las particiones existentes una a una
+      (DETACH, ALTER COLUMN y ATTACH), sin copiar los datos a través de la tabla padre.
+Las tablas de agregados (dispositivo_N_1m/_1h/_1d) ya usan BIGINT y no se modifican.
+
+La conversión bloquea cada tabla mientras se reescribe: conviene ejecutarla con el módulo de entrada parado.
+
+Uso (desde este directorio, con la conexión de inMQTT.ini):
+    python migrar_momento.py [--indice btree|brin] [dispositivo_N ...]
+Sin "--indice" se usa el "indice_momento" de la sección HISTORICO; sin tablas se migran todas.
+'''
+import argparse
+import logging
+
+from configobj import ConfigObj
+
+from almacenamiento_historico import INDICE_MOMENTO, _iniciar_conexion_db, _sql_indice_momento
+
+logging.basicConfig(filename="com_mosquitto.log", level=logging.DEBUG)
+comunicacion_mosquitto_log = logging.getLogger('com_mosquitto.log')
+
+
+def _tamanyo_tabla(cursor, nombre_tabla):
+    ''' Devuelve (tamaño total, tamaño de los índices) en bytes de la tabla y todas sus particiones. '''
+    cursor.execute('SELECT COALESCE(sum(pg_total_relation_size(relid)), 0), COALESCE(sum(pg_indexes_size(relid)), 0) '
+        'FROM pg_partition_tree(%s::regclass);', (nombre_tabla,))
+    return cursor.fetchall()[0]
+
+
+def _tipo_indice(cursor, nombre_indice):
+    ''' Método de acceso del índice ('btree', 'brin', ...) o None si no existe. '''
+    cursor.execute('SELECT am.amname FROM pg_class AS c JOIN pg_am AS am ON am.oid = c.relam WHERE c.oid = to_regclass(%s);', (nombre_indice,))
+    fila = cursor.fetchall()
+    return fila[0][0] if fila else None
+
+
+def _migrar_particionada(cursor, nombre_tabla):
+    '''
+    Cambia el tipo de la clave de partición pasando las particiones a una tabla particionada nueva,
+    que sustituye a la original conservando su nombre.
+    '''
+    tabla_nueva = nombre_tabla + '__bigint'
+    cursor.execute("SELECT a.attname, CASE WHEN a.attname = 'variable_momento' THEN 'bigint' ELSE format_type(a.atttypid, a.atttypmod) END "
+        'FROM pg_attribute AS a WHERE a.attrelid = %s::regclass AND a.attnum > 0 AND NOT a.attisdropped ORDER BY a.attnum;', (nombre_tabla,))
+    columnas = ', '.join('{} {}'.format(nombre, tipo) for nombre, tipo in cursor.fetchall())
+    cursor.execute('CREATE TABLE {} ({}) PARTITION BY RANGE (variable_momento);'.format(tabla_nueva, columnas))
+
+    cursor.execute('SELECT h.relname, pg_get_expr(h.relpartbound, h.oid) FROM pg_inherits AS i JOIN pg_class AS h ON h.oid = i.inhrelid '
+        'WHERE i.inhparent = %s::regclass ORDER BY h.relname;', (nombre_tabla,))
+    for nombre_particion, limites in cursor.fetchall():
+        cursor.execute('ALTER TABLE {} DETACH PARTITION {};'.format(nombre_tabla, nombre_particion))
+        cursor.execute('ALTER TABLE {} ALTER COLUMN variable_momento TYPE BIGINT USING round(variable_momento)::bigint;'.format(nombre_particion))
+        cursor.execute('ALTER TABLE {} ATTACH PARTITION {} {};'.format(tabla_nueva, nombre_particion, limites))
+
+    cursor.execute('DROP TABLE {};'.format(nombre_tabla))
+    cursor.execute('ALTER TABLE {} RENAME TO {};'.format(tabla_nueva, nombre_tabla))
+
+
+def migrar_tabla(cursor, nombre_tabla, indice_momento):
+    ''' Convierte variable_momento a BIGINT y deja su índice del tipo indicado. Devuelve False si no había nada que hacer. '''
+    cursor.execute("SELECT c.relkind = 'p', (SELECT a.atttypid = 'numeric'::regtype FROM pg_attribute AS a "
+        "WHERE a.attrelid = c.oid AND a.attname = 'variable_momento' AND NOT a.attisdropped) "
+        "FROM pg_class AS c WHERE c.oid = %s::regclass;", (nombre_tabla,))
+    particionada, es_numeric = cursor.fetchall()[0]
+    nombre_indice = '{}_variable_momento_idx'.format(nombre_tabla)
+    if not es_numeric and _tipo_indice(cursor, nombre_indice) == indice_momento:
+        return False
+
+    # Se elimina el índice antes de reescribir la tabla (en las particionadas, también el de cada partición)
+    # y se crea al final con el tipo pedido.
+    cursor.execute('DROP INDEX IF EXISTS {};'.format(nombre_indice))
+    if es_numeric:
+        if particionada:
+            _migrar_particionada(cursor, nombre_tabla)
+        else:
+            cursor.execute('ALTER TABLE {} ALTER COLUMN variable_momento TYPE BIGINT USING round(variable_momento)::bigint;'.format(nombre_tabla))
+    cursor.execute(_sql_indice_momento(nombre_tabla, indice_momento))
+    cursor.execute('ANALYZE {};'.format(nombre_tabla))
+    return True
+
+
+def migrar(indice_momento, tablas=None):
+    conexion_db, cursor = _iniciar_conexion_db()
+    try:
+        cursor.execute("SELECT c.relname FROM pg_class AS c WHERE c.relnamespace = 'public'::regnamespace "
+            "AND c.relkind IN ('r', 'p') AND NOT c.relispartition AND c.relname ~ '^dispositivo_[A-Za-z0-9]+$' ORDER BY c.relname;")
+        existentes = [fila[0] for fila in cursor.fetchall()]
+        for nombre_tabla in tablas or existentes:
+            if nombre_tabla not in existentes:
+                print('{}: no es una tabla de dispositivo.'.format(nombre_tabla))
+                continue
+            try:
+                total_antes, indices_antes = _tamanyo_tabla(cursor, nombre_tabla)
+                if not migrar_tabla(cursor, nombre_tabla, indice_momento):
+                    conexion_db.rollback()
+                    print('{}: ya estaba migrada.'.format(nombre_tabla))
+                    continue
+                total_despues, indices_despues = _tamanyo_tabla(cursor, nombre_tabla)
+                conexion_db.commit()
+                mensaje = '{}: migrada ({:.1f} MB -> {:.1f} MB, indices {:.1f} MB -> {:.1f} MB).'.format(nombre_tabla,
+                    total_antes / 2**20, total_despues / 2**20, indices_antes / 2**20, indices_despues / 2**20)
+                comunicacion_mosquitto_log.info(mensaje)
+                print(mensaje)
+            except Exception as err:
+                conexion_db.rollback()
+                comunicacion_mosquitto_log.error('[ERROR]: Error al migrar {}: {}'.format(nombre_tabla, err))
+                print('[ERROR]: Error al migrar {}: {}'.format(nombre_tabla, err))
+    finally:
+        conexion_db.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convierte variable_momento de las tablas de dispositivo a BIGINT.')
+    parser.add_argument('--indice', choices=('btree', 'brin'), help='tipo de indice sobre variable_momento')
+    parser.add_argument('tablas', nargs='*', help='tablas dispositivo_N a migrar (todas si no se indica ninguna)')
+    argumentos = parser.parse_args()
+    indice_momento = argumentos.indice or ConfigObj('inMQTT.ini').get('HISTORICO', {}).get('indice_momento', INDICE_MOMENTO)
+    migrar(indice_momento, argumentos.tablas)
@@ -1,7 +1,7 @@
 import datetime as datetime
 import json
 import multiprocessing
-from queue import Queue
+from queue import Empty, Queue
 from sqlite3 import Timestamp
 import sys
 from typing import Dict, Optional
@@ -11,27 +11,58 @@ import logging
 import msgpack
 
 import os
+import asyncio
 from autobahn.asyncio.wamp import ApplicationSession, ApplicationRunner
+from autobahn.wamp.serializer import MsgPackSerializer
 import multiprocessing
 
-import psycopg2
+from canal_tiempo_real import LOTES_EN_COLA, PUBLICACIONES_POR_SEGUNDO, ConflacionTiempoReal, EmisorTiempoReal
+from retencion_historico import PoliticaRetencion
+from tuberia_ingesta import TuberiaIngesta
 
 logging.basicConfig(filename="com_mosquitto.log", level=logging.DEBUG)
 comunicacion_mosquitto_log = logging.getLogger('com_mosquitto.log')
 
+TOPIC_DISPOSITIVOS = 'VIDIC/#'
+# Espera máxima por un lote del canal de tiempo real en el publicador del Crossbar
+SEGUNDOS_ESPERA_LOTE = 1
+# Procedimiento WAMP que devuelve el último payload recibido de un dispositivo (lo usan los paneles y vidicAPI.py)
+PROCEDIMIENTO_ULTIMO_VALOR = 'vidic.ultimo_valor'
+
 def _inicializarDatos():
     try:
         config = ConfigObj('inMQTT.ini')
         parametros_conexion_mosquitto = config['CONEXION_BROKER_MOSQUITTO']
         parametros_conexion_crossbar = config['CONEXION_BROKER_CROSSBAR']
+        parametros_historico = config.get('HISTORICO', {})
+        parametros_retencion = config.get('RETENCION', {})
+        parametros_ingesta = config.get('INGESTA', {})
+        parametros_tiempo_real = config.get('TIEMPO_REAL', {})
+        parametros_pasarela = config.get('PASARELA_WEBSOCKET', {})
         for clave in parametros_conexion_mosquitto:
             if(clave not in ('broker_cn', 'puerto', 'usuario', 'contrasenya', 'ruta_ca', 'ruta_cert', 'ruta_key', 'tls_version')):
                 raise Exception('[ERROR]: Error al indicar los parametros de conexion al broker MOSQUITTO.')
         for clave in parametros_conexion_crossbar:
             if(clave not in ('url', 'realm')):
                 raise Exception('[ERROR]: Error al indicar los parametros de conexion al broker CROSSBAR.')
+        for clave in parametros_historico:
+            if(clave not in ('tamanyo_lote', 'segundos_lote', 'particionado', 'particiones_adelantadas', 'indice_momento',
+                    'directorio_spool', 'mb_segmento_spool')):
+                raise Exception('[ERROR]: Error al indicar los parametros de almacenamiento del historico.')
+        for clave in parametros_ingesta:
+            if(clave not in ('tamanyo_cola', 'trabajadores_persistencia', 'procesos_ingesta', 'modo_reparto', 'grupo_compartido')):
+                raise Exception('[ERROR]: Error al indicar los parametros de la tuberia de ingesta.')
+        for clave in parametros_tiempo_real:
+            if(clave not in ('lotes_en_cola', 'mensajes_por_lote', 'segundos_lote', 'politica_cola_llena', 'publicaciones_por_segundo', 'destino')):
+                raise Exception('[ERROR]: Error al indicar los parametros del canal de tiempo real.')
+        if parametros_tiempo_real.get('destino', 'crossbar') not in ('crossbar', 'websocket'):
+            raise Exception('[ERROR]: Error al indicar el destino de los datos en tiempo real.')
+        for clave in parametros_pasarela:
+            if(clave not in ('host', 'puerto', 'ruta_cert', 'ruta_key', 'clave_secreta', 'tamanyo_cola_cliente', 'segundos_envio_maximo',
+                    'maximo_por_segundo_cliente', 'segundos_keyframe')):
+                raise Exception('[ERROR]: Error al indicar los parametros de la pasarela WebSocket.')
         
-        return parametros_conexion_mosquitto, parametros_conexion_crossbar
+        return parametros_conexion_mosquitto, parametros_conexion_crossbar, parametros_historico, parametros_retencion, parametros_ingesta, parametros_tiempo_real, parametros_pasarela
     except KeyError as err:
         comunicacion_mosquitto_log.error('[ERROR]: Error al leer las claves del archivo de configuracion.\nClaves Incorrectas.')
         raise err
@@ -44,15 +75,52 @@ def _inicializarDatos():
 ##################################                    COMUNICACIÓN MOSQUITTO               ##################################################
 #############################################################################################################################################
 
+def _parametrosProcesosIngesta(parametros_conexion_mosquitto, parametros_ingesta):
+    '''
+    Devuelve los parámetros de cada proceso de ingesta. Con varios procesos (modo_reparto = compartida), todos usan
+    la suscripción compartida de MQTT v5 $share/<grupo_compartido>/VIDIC/#: el broker entrega cada mensaje a uno solo
+    de los suscriptores del grupo, estén en este equipo o en otros, así que el tráfico total no crece con los procesos.
+    (No hay reparto por hash del topic: con filtros MQTT no se puede suscribir a una parte de los topics, y que cada
+    proceso recibiera VIDIC/# y descartara lo ajeno multiplicaría por N el tráfico, el TLS y la recepción.)
+    La retención del histórico solo se ejecuta en el primer proceso.
+    '''
+    procesos_ingesta = int(parametros_ingesta.pop('procesos_ingesta', 1))
+    modo_reparto = parametros_ingesta.pop('modo_reparto', 'ninguno')
+    grupo_compartido = parametros_ingesta.pop('grupo_compartido', 'vidic')
+    if modo_reparto not in ('ninguno', 'compartida') or (modo_reparto == 'ninguno' and procesos_ingesta != 1):
+        raise Exception('[ERROR]: Error al indicar el reparto de la ingesta entre procesos.')
+
+    lista_parametros = []
+    for indice in range(procesos_ingesta):
+        parametros = dict(parametros_conexion_mosquitto)
+        parametros['ingesta'] = dict(parametros_ingesta)
+        parametros['topic'] = TOPIC_DISPOSITIVOS
+        if modo_reparto == 'compartida':
+            parametros['topic'] = '$share/{}/{}'.format(grupo_compartido, TOPIC_DISPOSITIVOS)
+        if indice > 0:
+            parametros['retencion'] = None
+        if parametros['historico'].get('directorio_spool'):
+            parametros['historico'] = dict(parametros['historico'], directorio_spool=os.path.join(parametros['historico']['directorio_spool'], 'proceso_{}'.format(indice)))
+        lista_parametros.append(parametros)
+    return lista_parametros
+
 def _iniciarClienteSuscriptorMosquitto(parametros_conexion):
     try:
-        client = mqtt.Client()
+        # Las suscripciones compartidas ($share/...) son de MQTT v5
+        if parametros_conexion['topic'].startswith('$share/'):
+            client = mqtt.Client(protocol=mqtt.MQTTv5)
+        else:
+            client = mqtt.Client()
         client.username_pw_set(parametros_conexion['usuario'],password=parametros_conexion['contrasenya'])
         client.tls_set(parametros_conexion['ruta_ca'], parametros_conexion['ruta_cert'], parametros_conexion['ruta_key'], tls_version=int(parametros_conexion['tls_version']))
         client.tls_insecure_set(True)
         client.on_connect = on_connect
         client.on_message = on_message
-        client.cola_mensajes = parametros_conexion['queue']
+        client.topic_suscripcion = parametros_conexion['topic']
+        emisor_tiempo_real = EmisorTiempoReal(parametros_conexion['queue'], **parametros_conexion['tiempo_real'])
+        client.tuberia_ingesta = TuberiaIngesta(emisor_tiempo_real, parametros_conexion['historico'], **parametros_conexion['ingesta'])
+        # Sin sección RETENCION no se borra nada, pero el planificador también consolida los agregados pendientes
+        client.retencion_historico = PoliticaRetencion(parametros_conexion['retencion']) if parametros_conexion['retencion'] is not None else None
         client.connect(parametros_conexion['broker_cn'], int(parametros_conexion['puerto']), 60)
         print('mosquitto conectado')
         return client
@@ -60,27 +128,15 @@ def _iniciarClienteSuscriptorMosquitto(parametros_conexion):
         comunicacion_mosquitto_log.error('[ERROR]: Error al iniciar la suscripcion con el broker')
         raise err
 
-def on_connect(client, userdata, flags, rc):
+def on_connect(client, userdata, flags, rc, properties=None):
     comunicacion_mosquitto_log.debug("Connected with result code "+str(rc))
-    client.subscribe("VIDIC/#") #topic al que suscribirse
+    client.subscribe(client.topic_suscripcion) #topic al que suscribirse
 
 def on_message(client, userdata, msg):
     try:
-        topic = msg.topic.split("/")    # [VIDIC, id_instalcion, id_dispositivo]
-        id_instalacion = topic[1]
-        id_dispositivo = topic[2]
-        # print(msg.topic + " " + str(msg.payload))
-        payload = msgpack.loads(msg.payload)
-        # print(payload)
-        new_payload = {'timestamp': datetime.datetime.now(datetime.timezone.utc).timestamp() * 1000.0, 'datos':payload}
-        # new_payload = {'timestamp': datetime.datetime.utcfromtimestamp(0).total_seconds() * 1000.0, 'datos':payload}
-        topic = id_instalacion + '.' + id_dispositivo
-        json_payload = [topic, json.dumps(new_payload)]
-        comunicacion_mosquitto_log.debug(json_payload)
-
-        comunicacion_mosquitto_log.debug('Encolando el payload.')
-        client.cola_mensajes.put(json_payload)
-        almacenarDatosHistoricos(new_payload)    
+        # Solo se encola: la decodificación, el envío al Crossbar y el almacenamiento se hacen
+        # en los hilos de la tubería de ingesta, para no bloquear el bucle de red de paho.
+        client.tuberia_ingesta.recibir(msg.topic, msg.payload)
 
     except Exception as err:
         comunicacion_mosquitto_log.error('[ERROR]: Error al recibir el payload de Mosquitto.')
@@ -92,6 +148,7 @@ def conectarConMosquitto(parametros_conexion_broker: Dict[str,str]):
         cliente_suscriptor.loop_forever()
     except Exception as err:
         cliente_suscriptor.disconnect()
+        cliente_suscriptor.tuberia_ingesta.cerrar()
         raise err
 
 
@@ -101,97 +158,85 @@ def conectarConMosquitto(parametros_conexion_broker: Dict[str,str]):
 
 class _socketCrossbarPublicador(ApplicationSession):
 
-    def __init__(self, config: Optional[str] = None, cola_compartida:Queue=None):
+    def __init__(self, config: Optional[str] = None, cola_compartida:Queue=None, publicaciones_por_segundo:float=PUBLICACIONES_POR_SEGUNDO):
         super().__init__()
         self.cola_compartida = cola_compartida
-
-    def onJoin(self, details):
+        self.publicaciones_por_segundo = float(publicaciones_por_segundo)
+        # Con publicaciones_por_segundo = 0 se publican todos los mensajes en orden, sin conflacionar
+        self.conflacion = ConflacionTiempoReal() if self.publicaciones_por_segundo > 0 else None
+        # Último payload recibido de cada dispositivo: 'id_instalacion.id_dispositivo' -> msgpack
+        self.ultimos_valores = {}
+        self.tareas = []
+
+    async def onJoin(self, details):
         print("Sesion con el Crossbar abierta.")
+        await self.register(self.ultimoValor, PROCEDIMIENTO_ULTIMO_VALOR)
+        # La publicación va en tareas aparte: onJoin vuelve y el bucle de eventos de la sesión sigue libre
+        self.tareas.append(asyncio.ensure_future(self._recibirLotes()))
+        if self.conflacion is not None:
+            self.tareas.append(asyncio.ensure_future(self._publicarConflacionado()))
+
+    def onLeave(self, details):
+        for tarea in self.tareas:
+            tarea.cancel()
+        self.tareas = []
+        super().onLeave(details)
+
+    async def _recibirLotes(self):
+        '''
+        Vacía el canal de tiempo real. La espera por cada lote se hace en un hilo del ejecutor, de forma
+        que no bloquea el bucle de eventos de autobahn.
+        '''
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                lote = await loop.run_in_executor(None, self.cola_compartida.get, True, SEGUNDOS_ESPERA_LOTE)
+            except Empty:
+                continue
+            for topic, payload in lote:
+                self.ultimos_valores[topic] = payload
+            if self.conflacion is not None:
+                self.conflacion.actualizar(lote)
+                continue
+            for topic, payload in lote:
+                self.enviarPayload(topic = topic, payload= payload)
+            # Se cede el bucle entre lotes para atender el resto de la sesión
+            await asyncio.sleep(0)
+
+    async def _publicarConflacionado(self):
+        ''' Publica el último payload de cada topic actualizado, como mucho publicaciones_por_segundo veces por segundo. '''
         while True:
-            payload_en_cola = cola_compartida.get()
-            # print('Desencolando el siguiente payload:')
-            # print('{}'.format(payload_en_cola))
-            self.enviarPayload(topic = payload_en_cola[0], payload= payload_en_cola[1])
+            await asyncio.sleep(1.0 / self.publicaciones_por_segundo)
+            for topic, payload in self.conflacion.extraer():
+                self.enviarPayload(topic = topic, payload= payload)
     
+    def ultimoValor(self, id_instalacion, id_dispositivo):
+        '''
+        Último payload (msgpack, el mismo que se publica en tiempo real) del dispositivo, o None si no se ha recibido
+        ninguno desde que arrancó el módulo. Permite a un panel mostrar datos en cuanto se abre, sin esperar a la
+        siguiente publicación del dispositivo ni consultar la base de datos.
+        '''
+        return self.ultimos_valores.get('{}.{}'.format(id_instalacion, id_dispositivo))
+
     def enviarPayload(self, topic, payload):
         self.publish(topic, payload)
 
 
-def conectarConCrossbar(publicador_crossbar, queue):
-    prueba = _socketCrossbarPublicador(cola_compartida=queue)
+def conectarConCrossbar(publicador_crossbar, queue, publicaciones_por_segundo=PUBLICACIONES_POR_SEGUNDO):
+    prueba = _socketCrossbarPublicador(cola_compartida=queue, publicaciones_por_segundo=publicaciones_por_segundo)
     publicador_crossbar.run(prueba)
 
 
 #############################################################################################################################################
-##################################                    COMUNICACIÓN BD                      ##################################################
+##################################                    PASARELA WEBSOCKET                   ##################################################
 #############################################################################################################################################
 
-def _iniciar_conexion_db():
-    try:
-        config = ConfigObj('inMQTT.ini')
-        parametros_conexion_bd = config['CONEXION_BASE_DATOS']
-        for clave in parametros_conexion_bd:
-            if(clave not in ('host', 'database', 'user', 'password')):
-                raise Exception('[ERROR]: Error al indicar los parámetros de la conexión a la base de datos')
-        
-        conexion_db = psycopg2.connect(host=parametros_conexion_bd['host'], database=parametros_conexion_bd['database'],
-            user=parametros_conexion_bd['user'], password=parametros_conexion_bd['password'])
-        
-        cur = conexion_db.cursor()
-        return conexion_db, cur
+def conectarConPasarela(queue, parametros_pasarela, publicaciones_por_segundo=PUBLICACIONES_POR_SEGUNDO):
+    # Se importa aquí: websockets y python-jose solo son necesarios si se usa la pasarela en lugar del Crossbar
+    from pasarela_websocket import PasarelaWebSocket
+    pasarela = PasarelaWebSocket(queue, publicaciones_por_segundo=publicaciones_por_segundo, **parametros_pasarela)
+    asyncio.run(pasarela.servir())
 
-    except Exception as err:
-        raise err
-
-conexion_db, cursor = _iniciar_conexion_db()
-
-def _crear_tabla_sql(nombre_tabla, lista_variables_tabla, variable_ts, ts_registro=None):
-    sql = 'CREATE TABLE IF NOT EXISTS {} ({}'.format(nombre_tabla, 'ts INTEGER,' if ts_registro else '')
-    for id_variable in lista_variables_tabla:
-        nombre_variable = 'variable_' + str(id_variable)
-        # Asumimos que todas las variables serán de tipo REAL excepto la de timestamp
-        sql += '{} {},'.format(nombre_variable, 'REAL')
-    sql += '{} {},'.format(variable_ts, 'NUMERIC')
-    sql = sql[:-1] + ');'
-    cursor.execute(sql)
-    conexion_db.commit()
-
-    # Crear indice sobre el campo de timestamp, si se ha especificado
-    sql = 'CREATE INDEX IF NOT EXISTS {tabla}_{campo}_idx ON {tabla}({campo} ASC)'.format(tabla=nombre_tabla, campo=variable_ts)
-    cursor.execute(sql)
-    conexion_db.commit()
-
-def almacenarDatosHistoricos(payload):
-    timestamp = int(payload['timestamp'])
-    datos_generales = payload['datos']
-    nombre_tabla = 'dispositivo_{id_dispositivo}'.format(id_dispositivo=datos_generales['id_dispositivo'])
-    try:
-        cursor.execute("SELECT EXISTS(SELECT 1 FROM information_schema.tables WHERE table_catalog='vidic' AND table_schema='public' AND table_name='{}');".format(nombre_tabla))
-        existe = cursor.fetchall()[0][0]
-        datos = datos_generales['datos']
-        if (not existe):
-            _crear_tabla_sql(nombre_tabla, datos, 'variable_momento')
-        else:
-            pass
-            # La tabla ya existe y por lo tanto no hay que crearla.
-
-        datos['momento'] = timestamp
-        sql='insert into {tabla} ('.format(tabla=nombre_tabla)
-        valores = '('
-        for id_variable in datos:
-            nombre_variable = 'variable_' + id_variable
-            sql += nombre_variable + ','
-            valores += str(datos[id_variable]) + ','
-        sql = sql[:-1] + ')'
-        valores = valores[:-1] + ')'
-        sql += ' VALUES ' + valores
-        cursor.execute(sql)
-        conexion_db.commit()
-        print('Datos almacenados en la base de datos')
-
-    except Exception as err:
-        conexion_db.rollback()
-        raise err
 
 #############################################################################################################################################
 ##################################                    CÓDIGO PRINCIPAL                     ##################################################
@@ -200,14 +245,24 @@ def almacenarDatosHistoricos(payload):
 if __name__ == '__main__':
     try:
         comunicacion_mosquitto_log.debug('Inicio del modulo de entrada')
-        parametros_conexion_mosquitto, parametros_conexion_crossbar = _inicializarDatos()
+        parametros_conexion_mosquitto, parametros_conexion_crossbar, parametros_historico, parametros_retencion, parametros_ingesta, parametros_tiempo_real, parametros_pasarela = _inicializarDatos()
         comunicacion_mosquitto_log.debug('Datos inicializados:\n\t{}'.format(parametros_conexion_mosquitto))
 
-        cola_compartida = multiprocessing.Queue()
+        # Canal de tiempo real: cola acotada de lotes de mensajes hacia el publicador del Crossbar (o la pasarela WebSocket)
+        cola_compartida = multiprocessing.Queue(maxsize=int(parametros_tiempo_real.pop('lotes_en_cola', LOTES_EN_COLA)))
+        publicaciones_por_segundo = float(parametros_tiempo_real.pop('publicaciones_por_segundo', PUBLICACIONES_POR_SEGUNDO))
+        destino_tiempo_real = parametros_tiempo_real.pop('destino', 'crossbar')
 
         parametros_conexion_mosquitto['queue'] = cola_compartida
+        parametros_conexion_mosquitto['historico'] = parametros_historico
+        parametros_conexion_mosquitto['retencion'] = parametros_retencion
+        parametros_conexion_mosquitto['tiempo_real'] = dict(parametros_tiempo_real)
+        parametros_procesos_ingesta = _parametrosProcesosIngesta(parametros_conexion_mosquitto, parametros_ingesta)
     
-        publicador_crossbar = ApplicationRunner(url= os.environ.get('CBURL', parametros_conexion_crossbar['url']), realm= os.environ.get('CBREALM', parametros_conexion_crossbar['realm']))
+        # Los payloads de tiempo real son msgpack (bytes): se publican con el serializador msgpack de WAMP
+        if destino_tiempo_real == 'crossbar':
+            publicador_crossbar = ApplicationRunner(url= os.environ.get('CBURL', parametros_conexion_crossbar['url']), realm= os.environ.get('CBREALM', parametros_conexion_crossbar['realm']),
+                serializers=[MsgPackSerializer()])
 
     except Exception as err:
         comunicacion_mosquitto_log.error('[ERROR]: El programa no ha podido arrancar correctamente.\n{}'.format(err))
@@ -216,15 +271,17 @@ if __name__ == '__main__':
     
     try:
         multiprocessing.set_start_method('fork', force=True)
-        procesos = [
-            multiprocessing.Process(target=conectarConCrossbar, args=([publicador_crossbar, cola_compartida])),
-            multiprocessing.Process(target=conectarConMosquitto, args=([parametros_conexion_mosquitto]))
-        ]
+        if destino_tiempo_real == 'crossbar':
+            procesos = [multiprocessing.Process(target=conectarConCrossbar, args=([publicador_crossbar, cola_compartida, publicaciones_por_segundo]))]
+        else:
+            procesos = [multiprocessing.Process(target=conectarConPasarela, args=([cola_compartida, parametros_pasarela, publicaciones_por_segundo]))]
+        # Un proceso de ingesta por cada parte del reparto, cada uno con su tubería y sus conexiones a la base de datos
+        for parametros_proceso in parametros_procesos_ingesta:
+            procesos.append(multiprocessing.Process(target=conectarConMosquitto, args=([parametros_proceso])))
         for proceso in procesos:
             proceso.start()
     
     except Exception as err:
         comunicacion_mosquitto_log.error('Ha ocurrido un error inesperado.\n{}'.format(err))
         comunicacion_mosquitto_log.info('Fin de la aplicacion.\n')
-        conexion_db.close()
         raise err
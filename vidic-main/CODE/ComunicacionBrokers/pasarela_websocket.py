@@ -0,0 +1,335 @@
+''' Pasarela WebSocket de tiempo real, alternativa al Crossbar para repartir los datos a los paneles.
+
+Se ejecuta en un proceso del módulo de entrada (moduloMqtt-tr.py, con destino = websocket en la sección TIEMPO_REAL)
+y consume el mismo canal de tiempo real que el publicador del Crossbar. Un único proceso asyncio atiende miles de
+conexiones: cada cliente tiene su cola de envío acotada y su tarea de envío, y el reparto de un mensaje solo encola.
+
+Protocolo (las peticiones del cliente son texto JSON; los datos se envían en binario):
+    1. El cliente se autentica en los primeros SEGUNDOS_AUTENTICACION segundos con el mismo token JWT de vidicAPI.py:
+       {"accion": "autenticar", "token": "...", "maximo_por_segundo": 2, "deltas": true} -> {"accion": "autenticado"}
+       "maximo_por_segundo" (opcional) limita los datos por segundo y topic que recibe el cliente; no puede superar
+       "maximo_por_segundo_cliente" (0 = sin límite). Los datos que llegan antes se conflacionan: se envía el último.
+       Al autenticarse se leen de instalacion_usuario las instalaciones del usuario (CONEXION_BASE_DATOS de inMQTT.ini).
+    2. {"accion": "suscribir", "topic": "id_instalacion.id_dispositivo"} / {"accion": "desuscribir", "topic": ...}
+       Al suscribirse recibe enseguida el último valor conocido del dispositivo. Si la instalación no es del usuario
+       se responde {"accion": "no_autorizado", "topic": ...} y no se suscribe.
+    3. Cada dato es un mensaje binario msgpack [topic, {'timestamp': ms, 'datos': {...}}] (fotograma completo).
+       Con "deltas", entre fotogramas completos se envía [topic, {'timestamp': ms, 'delta': {id_variable: valor}}]
+       solo con las variables que han cambiado respecto a lo último enviado a ese cliente. Se envía un fotograma
+       completo al suscribirse, cada "segundos_keyframe" segundos y si desaparece alguna variable.
+Se cierra la conexión (código CIERRE_NO_AUTORIZADO) si el token no es válido o cuando caduca, y (CIERRE_CLIENTE_LENTO)
+si el cliente no recibe al ritmo de los datos: su cola se llena o un envío tarda más de "segundos_envio_maximo".
+
+Configuración (sección PASARELA_WEBSOCKET de inMQTT.ini):
+    host, puerto, ruta_cert, ruta_key, clave_secreta (SECRET_KEY de vidicAPI.py), tamanyo_cola_cliente, segundos_envio_maximo,
+    maximo_por_segundo_cliente, segundos_keyframe
+'''
+import asyncio
+import json
+import logging
+import ssl
+import time
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty
+
+import msgpack
+import psycopg2
+import websockets
+from jose import JWTError, jwt
+
+from almacenamiento_historico import _iniciar_conexion_db
+from canal_tiempo_real import PUBLICACIONES_POR_SEGUNDO, ConflacionTiempoReal
+
+comunicacion_mosquitto_log = logging.getLogger('com_mosquitto.log')
+
+HOST = '0.0.0.0'
+PUERTO = 8765
+TAMANYO_COLA_CLIENTE = 100
+SEGUNDOS_ENVIO_MAXIMO = 10
+SEGUNDOS_AUTENTICACION = 10
+SEGUNDOS_ESPERA_LOTE = 1
+MAXIMO_POR_SEGUNDO_CLIENTE = 0
+SEGUNDOS_KEYFRAME = 30
+# Cada cuánto se revisan los datos retenidos por el límite de datos por segundo de los clientes
+SEGUNDOS_REVISION_PENDIENTES = 0.1
+# Algoritmo de los tokens de vidicAPI.py
+ALGORITMO_JWT = 'HS256'
+# Cabecera msgpack de un array de dos elementos: [topic, payload]
+CABECERA_MENSAJE = b'\x92'
+CIERRE_NO_AUTORIZADO = 4401
+CIERRE_CLIENTE_LENTO = 4408
+CIERRE_ERROR_INTERNO = 1011
+
+
+class _ClientePasarela:
+
+    def __init__(self, websocket, tamanyo_cola):
+        self.websocket = websocket
+        self.cola = asyncio.Queue(maxsize=tamanyo_cola)
+        self.topics = set()
+        self.usuario = None
+        # Instalaciones del usuario (id como texto): solo puede suscribirse a sus dispositivos
+        self.instalaciones = frozenset()
+        self.expulsado = False
+        self.deltas = False
+        # Segundos mínimos entre dos datos del mismo topic (0 = sin límite)
+        self.intervalo_minimo = 0.0
+        # topic -> {'datos': variables del último fotograma o delta enviado, 'keyframe': momento del último
+        #           fotograma completo, 'envio': momento del último envío} (time.monotonic())
+        self.enviados = {}
+        # topic -> último payload retenido por el límite de datos por segundo
+        self.pendientes = {}
+
+
+class PasarelaWebSocket:
+
+    def __init__(self, cola_compartida, clave_secreta, host: str = HOST, puerto: int = PUERTO, ruta_cert: str = '', ruta_key: str = '',
+            tamanyo_cola_cliente: int = TAMANYO_COLA_CLIENTE, segundos_envio_maximo: float = SEGUNDOS_ENVIO_MAXIMO,
+            maximo_por_segundo_cliente: float = MAXIMO_POR_SEGUNDO_CLIENTE, segundos_keyframe: float = SEGUNDOS_KEYFRAME,
+            publicaciones_por_segundo: float = PUBLICACIONES_POR_SEGUNDO):
+        self.cola_compartida = cola_compartida
+        self.clave_secreta = clave_secreta
+        self.host = host
+        self.puerto = int(puerto)
+        self.ruta_cert = ruta_cert
+        self.ruta_key = ruta_key
+        self.tamanyo_cola_cliente = int(tamanyo_cola_cliente)
+        self.segundos_envio_maximo = float(segundos_envio_maximo)
+        self.maximo_por_segundo_cliente = float(maximo_por_segundo_cliente)
+        self.segundos_keyframe = float(segundos_keyframe)
+        self.publicaciones_por_segundo = float(publicaciones_por_segundo)
+        self.conflacion = ConflacionTiempoReal() if self.publicaciones_por_segundo > 0 else None
+        # topic -> clientes suscritos
+        self.suscripciones = {}
+        # topic -> último payload recibido (msgpack)
+        self.ultimos_valores = {}
+        # Clientes con datos retenidos por su límite de datos por segundo
+        self.clientes_con_pendientes = set()
+        # Las consultas de instalaciones de los usuarios van por un único hilo con una conexión a la base de datos
+        # que se reutiliza: una reconexión masiva de paneles no abre una conexión por cliente
+        self.ejecutor_bd = ThreadPoolExecutor(max_workers=1)
+        self.conexion_db = None
+
+    async def servir(self):
+        contexto_ssl = None
+        if self.ruta_cert:
+            contexto_ssl = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            contexto_ssl.load_cert_chain(self.ruta_cert, self.ruta_key or None)
+        # Sin compresión: con miles de conexiones, comprimir cada mensaje por cliente cuesta más CPU de la que ahorra
+        async with websockets.serve(self._atenderCliente, self.host, self.puerto, ssl=contexto_ssl, compression=None, max_size=2**16):
+            comunicacion_mosquitto_log.info('Pasarela WebSocket escuchando en {}:{}.'.format(self.host, self.puerto))
+            tareas = [self._recibirLotes(), self._vaciarPendientes()]
+            if self.conflacion is not None:
+                tareas.append(self._publicarConflacionado())
+            await asyncio.gather(*tareas)
+
+    async def _recibirLotes(self):
+        ''' Vacía el canal de tiempo real esperando cada lote en un hilo del ejecutor, sin bloquear el bucle de eventos. '''
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                lote = await loop.run_in_executor(None, self.cola_compartida.get, True, SEGUNDOS_ESPERA_LOTE)
+            except Empty:
+                continue
+            for topic, payload in lote:
+                self.ultimos_valores[topic] = payload
+            if self.conflacion is not None:
+                self.conflacion.actualizar(lote)
+                continue
+            for topic, payload in lote:
+                self._repartir(topic, payload)
+            await asyncio.sleep(0)
+
+    async def _publicarConflacionado(self):
+        while True:
+            await asyncio.sleep(1.0 / self.publicaciones_por_segundo)
+            for topic, payload in self.conflacion.extraer():
+                self._repartir(topic, payload)
+
+    async def _vaciarPendientes(self):
+        ''' Envía los datos retenidos por el límite de datos por segundo de cada cliente cuando ya les toca. '''
+        while True:
+            await asyncio.sleep(SEGUNDOS_REVISION_PENDIENTES)
+            ahora = time.monotonic()
+            for cliente in list(self.clientes_con_pendientes):
+                for topic in list(cliente.pendientes):
+                    # Un envío puede expulsar al cliente (cola llena), que pierde sus suscripciones y pendientes
+                    if cliente.expulsado:
+                        break
+                    estado = cliente.enviados.get(topic)
+                    if estado is None:
+                        cliente.pendientes.pop(topic, None)
+                    elif ahora - estado['envio'] >= cliente.intervalo_minimo:
+                        self._enviarDato(cliente, topic, cliente.pendientes.pop(topic), ahora, {})
+                if not cliente.pendientes:
+                    self.clientes_con_pendientes.discard(cliente)
+
+    def _repartir(self, topic, payload):
+        clientes = self.suscripciones.get(topic)
+        if not clientes:
+            return
+        ahora = time.monotonic()
+        # Lo que se puede compartir entre clientes (el fotograma completo, el payload decodificado)
+        # se calcula una sola vez por mensaje
+        compartido = {}
+        for cliente in list(clientes):
+            estado = cliente.enviados.get(topic)
+            if estado is not None and ahora - estado['envio'] < cliente.intervalo_minimo:
+                cliente.pendientes[topic] = payload
+                self.clientes_con_pendientes.add(cliente)
+                continue
+            self._enviarDato(cliente, topic, payload, ahora, compartido)
+
+    def _enviarDato(self, cliente, topic, payload, ahora, compartido):
+        ''' Encola para el cliente el dato como delta o como fotograma completo. '''
+        # Un cliente expulsado durante el reparto de este mismo dato no vuelve a tener estado de envío
+        if cliente.expulsado:
+            return
+        estado = cliente.enviados.setdefault(topic, {'datos': None, 'keyframe': float('-inf'), 'envio': float('-inf')})
+        estado['envio'] = ahora
+        if cliente.deltas:
+            if 'decodificado' not in compartido:
+                compartido['decodificado'] = msgpack.unpackb(payload)
+            mensaje = compartido['decodificado']
+            datos = mensaje['datos'].get('datos') if isinstance(mensaje.get('datos'), dict) else None
+            anterior = estado['datos']
+            if isinstance(datos, dict) and anterior is not None and ahora - estado['keyframe'] < self.segundos_keyframe \
+                    and anterior.keys() <= datos.keys():
+                delta = {id_variable: valor for id_variable, valor in datos.items() if id_variable not in anterior or anterior[id_variable] != valor}
+                estado['datos'] = datos
+                self._encolar(cliente, msgpack.packb([topic, {'timestamp': mensaje['timestamp'], 'delta': delta}]))
+                return
+            estado['datos'] = datos if isinstance(datos, dict) else None
+            estado['keyframe'] = ahora
+        if 'completo' not in compartido:
+            # Sin decodificar el payload
+            compartido['completo'] = CABECERA_MENSAJE + msgpack.packb(topic) + payload
+        self._encolar(cliente, compartido['completo'])
+
+    def _encolar(self, cliente, mensaje):
+        try:
+            cliente.cola.put_nowait(mensaje)
+        except asyncio.QueueFull:
+            self._expulsar(cliente, CIERRE_CLIENTE_LENTO, 'Cliente lento')
+
+    def _expulsar(self, cliente, codigo, motivo):
+        if cliente.expulsado:
+            return
+        cliente.expulsado = True
+        self._desuscribirTodo(cliente)
+        self.clientes_con_pendientes.discard(cliente)
+        comunicacion_mosquitto_log.warning('Pasarela WebSocket: se cierra la conexion de {} ({}).'.format(cliente.usuario, motivo))
+        asyncio.ensure_future(cliente.websocket.close(codigo, motivo))
+
+    def _desuscribirTodo(self, cliente):
+        for topic in list(cliente.topics):
+            self._desuscribir(cliente, topic)
+
+    def _desuscribir(self, cliente, topic):
+        cliente.topics.discard(topic)
+        cliente.enviados.pop(topic, None)
+        cliente.pendientes.pop(topic, None)
+        clientes = self.suscripciones.get(topic)
+        if clientes is not None:
+            clientes.discard(cliente)
+            if not clientes:
+                del self.suscripciones[topic]
+
+    async def _atenderCliente(self, websocket, path=None):
+        cliente = _ClientePasarela(websocket, self.tamanyo_cola_cliente)
+        try:
+            cliente.usuario, caducidad = await self._autenticar(websocket, cliente)
+        except (asyncio.TimeoutError, websockets.ConnectionClosed, JWTError, ValueError, KeyError, TypeError):
+            await websocket.close(CIERRE_NO_AUTORIZADO, 'No autorizado')
+            return
+        try:
+            cliente.instalaciones = await asyncio.get_running_loop().run_in_executor(self.ejecutor_bd, self._instalacionesUsuario, cliente.usuario)
+        except Exception as err:
+            comunicacion_mosquitto_log.error('Pasarela WebSocket: no se han podido leer las instalaciones de {}.\n{}'.format(cliente.usuario, err))
+            await websocket.close(CIERRE_ERROR_INTERNO, 'Error interno')
+            return
+        await websocket.send(json.dumps({'accion': 'autenticado'}))
+        loop = asyncio.get_running_loop()
+        temporizador = loop.call_later(max(0, caducidad - time.time()), self._expulsar, cliente, CIERRE_NO_AUTORIZADO, 'Token caducado') if caducidad else None
+        tarea_envio = asyncio.ensure_future(self._enviar(cliente))
+        try:
+            async for peticion in websocket:
+                self._procesarPeticion(cliente, peticion)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            if temporizador is not None:
+                temporizador.cancel()
+            tarea_envio.cancel()
+            self._desuscribirTodo(cliente)
+            self.clientes_con_pendientes.discard(cliente)
+
+    async def _autenticar(self, websocket, cliente):
+        '''
+        Devuelve (usuario, caducidad del token en segundos desde epoch o None) y aplica al cliente sus opciones de
+        deltas y de datos por segundo. Lanza JWTError si el token no es válido.
+        '''
+        peticion = json.loads(await asyncio.wait_for(websocket.recv(), SEGUNDOS_AUTENTICACION))
+        if peticion['accion'] != 'autenticar':
+            raise JWTError('Se esperaba la autenticacion')
+        payload = jwt.decode(peticion['token'], self.clave_secreta, algorithms=[ALGORITMO_JWT])
+        if payload.get('sub') is None:
+            raise JWTError('Token sin usuario')
+        cliente.deltas = bool(peticion.get('deltas', False))
+        maximo_por_segundo = float(peticion.get('maximo_por_segundo') or 0)
+        if self.maximo_por_segundo_cliente > 0 and (maximo_por_segundo <= 0 or maximo_por_segundo > self.maximo_por_segundo_cliente):
+            maximo_por_segundo = self.maximo_por_segundo_cliente
+        cliente.intervalo_minimo = 1.0 / maximo_por_segundo if maximo_por_segundo > 0 else 0.0
+        return payload['sub'], payload.get('exp')
+
+    def _instalacionesUsuario(self, usuario):
+        ''' Devuelve los id (texto) de las instalaciones del usuario. Se ejecuta en el hilo de self.ejecutor_bd. '''
+        for intento in range(2):
+            try:
+                if self.conexion_db is None or self.conexion_db.closed:
+                    self.conexion_db, _ = _iniciar_conexion_db()
+                    self.conexion_db.autocommit = True
+                with self.conexion_db.cursor() as cursor:
+                    cursor.execute('SELECT IU.instalacion_id FROM instalacion_usuario AS IU JOIN usuario AS U ON U.id = IU.usuario_id '
+                        'WHERE U.nombre_usuario = %s', (usuario,))
+                    return frozenset(str(fila[0]) for fila in cursor.fetchall())
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                # Conexión perdida (reinicio de la base de datos...): se reintenta una vez con una conexión nueva
+                self.conexion_db = None
+                if intento:
+                    raise
+
+    async def _enviar(self, cliente):
+        while True:
+            mensaje = await cliente.cola.get()
+            try:
+                await asyncio.wait_for(cliente.websocket.send(mensaje), self.segundos_envio_maximo)
+            except asyncio.TimeoutError:
+                self._expulsar(cliente, CIERRE_CLIENTE_LENTO, 'Envio demasiado lento')
+                return
+            except websockets.ConnectionClosed:
+                return
+
+    def _procesarPeticion(self, cliente, peticion):
+        try:
+            peticion = json.loads(peticion)
+            accion, topic = peticion['accion'], str(peticion['topic'])
+        except (ValueError, KeyError, TypeError):
+            comunicacion_mosquitto_log.debug('Pasarela WebSocket: peticion no valida de {}.'.format(cliente.usuario))
+            return
+        if cliente.expulsado:
+            return
+        if accion == 'suscribir':
+            if topic.split('.', 1)[0] not in cliente.instalaciones:
+                comunicacion_mosquitto_log.warning('Pasarela WebSocket: {} no tiene acceso a {}.'.format(cliente.usuario, topic))
+                self._encolar(cliente, json.dumps({'accion': 'no_autorizado', 'topic': topic}))
+                return
+            # Al (re)suscribirse se empieza siempre por un fotograma completo
+            cliente.enviados.pop(topic, None)
+            cliente.pendientes.pop(topic, None)
+            cliente.topics.add(topic)
+            self.suscripciones.setdefault(topic, set()).add(cliente)
+            if topic in self.ultimos_valores:
+                self._enviarDato(cliente, topic, self.ultimos_valores[topic], time.monotonic(), {})
+        elif accion == 'desuscribir':
+            self._desuscribir(cliente, topic)
@@ -0,0 +1,210 @@
+''' Política de retención de los datos históricos.
+
+Se ejecuta periódicamente dentro del módulo de entrada (moduloMqtt-tr.py) con su propia conexión
+a la base de datos. Primero rellena las tablas de agregados creadas para tablas de dispositivo que ya tenían
+datos (anotadas en agregados_pendientes por almacenamiento_historico.py): del dato más antiguo en adelante, por
+tramos de "horas_tramo_consolidacion" horas, cada tramo en su propia transacción. Después, para cada tabla de dispositivo:
+    - Consolida en las tablas de agregados los datos que van a borrarse y que todavía no estén agregados.
+    - Borra los datos sin agregar más antiguos que "dias_datos". En las tablas particionadas se eliminan
+      particiones completas (DROP TABLE), sin recorrer filas; en las tablas sin particionar se hace un DELETE.
+      No se borra nada de una tabla cuyos agregados están todavía pendientes de consolidar.
+    - Borra los cubos de cada tabla de agregados más antiguos que "dias_<sufijo>".
+
+Configuración (sección RETENCION de inMQTT.ini; 0 o sin indicar = sin límite):
+    dias_datos, dias_1m, dias_1h, dias_1d, horas_entre_ejecuciones, horas_tramo_consolidacion
+    [[dispositivo_N]] o [[instalacion_N]]: los mismos "dias_*" para un dispositivo o instalación concretos.
+'''
+import datetime
+import logging
+import re
+import threading
+import time
+
+from almacenamiento_historico import (AGREGADOS_HISTORICOS, FORMATO_PARTICION, TABLA_AGREGADOS_PENDIENTES, _iniciar_conexion_db,
+    _limites_particion, _sql_consolidar_agregado)
+
+comunicacion_mosquitto_log = logging.getLogger('com_mosquitto.log')
+
+CLAVES_RETENCION = ('dias_datos',) + tuple('dias_' + sufijo for sufijo in AGREGADOS_HISTORICOS)
+HORAS_ENTRE_EJECUCIONES = 6
+HORAS_TRAMO_CONSOLIDACION = 24
+MS_DIA = 24 * 60 * 60 * 1000
+
+
+def _fin_particion(nombre_tabla, nombre_particion):
+    '''
+    Devuelve el final (en ms, excluido) del intervalo que cubre una partición dispositivo_N_pAAAAMMDD / _pAAAAMM,
+    o None si el nombre no corresponde a una partición creada por el módulo de entrada.
+    '''
+    sufijo = nombre_particion[len(nombre_tabla) + len('_p'):]
+    for particionado, formato in FORMATO_PARTICION.items():
+        if len(sufijo) != len(datetime.datetime(2000, 1, 1).strftime(formato)):
+            continue
+        try:
+            inicio = datetime.datetime.strptime(sufijo, formato).replace(tzinfo=datetime.timezone.utc)
+        except ValueError:
+            return None
+        return _limites_particion(int(inicio.timestamp() * 1000), particionado)[2]
+    return None
+
+
+class PoliticaRetencion:
+    '''
+    Planificador de la retención de los datos históricos. Se ejecuta al crearse y después cada
+    "horas_entre_ejecuciones" horas en un hilo propio.
+    '''
+
+    def __init__(self, parametros_retencion):
+        # 'dispositivo_N' / 'instalacion_N' -> días de retención que cambian respecto a los generales
+        self.retencion_particular = {}
+        for clave, valor in parametros_retencion.items():
+            if isinstance(valor, dict):
+                if not re.fullmatch(r'(dispositivo|instalacion)_\w+', clave) or any(clave_seccion not in CLAVES_RETENCION for clave_seccion in valor):
+                    raise Exception('[ERROR]: Error al indicar la retencion particular de {}.'.format(clave))
+                self.retencion_particular[clave] = {clave_seccion: float(dias) for clave_seccion, dias in valor.items()}
+            elif(clave not in CLAVES_RETENCION + ('horas_entre_ejecuciones', 'horas_tramo_consolidacion')):
+                raise Exception('[ERROR]: Error al indicar los parametros de retencion del historico.')
+        self.retencion_general = {clave: float(parametros_retencion.get(clave, 0)) for clave in CLAVES_RETENCION}
+        self.segundos_entre_ejecuciones = float(parametros_retencion.get('horas_entre_ejecuciones', HORAS_ENTRE_EJECUCIONES)) * 3600
+        self.ms_tramo_consolidacion = int(float(parametros_retencion.get('horas_tramo_consolidacion', HORAS_TRAMO_CONSOLIDACION)) * 3600 * 1000)
+        self.detener = threading.Event()
+        self.hilo = threading.Thread(target=self._ejecutar_periodicamente, name='retencion-historico', daemon=True)
+        self.hilo.start()
+
+    def detener_ejecucion(self):
+        self.detener.set()
+
+    def _ejecutar_periodicamente(self):
+        while not self.detener.is_set():
+            try:
+                self.aplicar()
+            except Exception as err:
+                comunicacion_mosquitto_log.error('[ERROR]: Error al aplicar la retencion del historico: {}'.format(err))
+            self.detener.wait(self.segundos_entre_ejecuciones)
+
+    def aplicar(self):
+        ''' Aplica la política de retención a todas las tablas de dispositivo, cada una en su propia transacción. '''
+        conexion_db, cursor = _iniciar_conexion_db()
+        try:
+            pendientes = self._consolidar_pendientes(conexion_db, cursor)
+            cursor.execute("SELECT c.relname, c.relkind = 'p' FROM pg_class AS c WHERE c.relnamespace = 'public'::regnamespace "
+                "AND c.relkind IN ('r', 'p') AND NOT c.relispartition AND c.relname ~ '^dispositivo_[A-Za-z0-9]+$';")
+            tablas = cursor.fetchall()
+            instalaciones = {}
+            if any(nombre.startswith('instalacion_') for nombre in self.retencion_particular):
+                cursor.execute('SELECT id, instalacion_id FROM dispositivo;')
+                instalaciones = {'dispositivo_{}'.format(id_dispositivo): 'instalacion_{}'.format(id_instalacion) for id_dispositivo, id_instalacion in cursor.fetchall()}
+            ahora = int(time.time() * 1000)
+            for nombre_tabla, particionada in tablas:
+                retencion = dict(self.retencion_general)
+                retencion.update(self.retencion_particular.get(instalaciones.get(nombre_tabla), {}))
+                retencion.update(self.retencion_particular.get(nombre_tabla, {}))
+                if nombre_tabla in pendientes:
+                    retencion['dias_datos'] = 0
+                try:
+                    self._aplicar_tabla(cursor, nombre_tabla, particionada, retencion, ahora)
+                    conexion_db.commit()
+                except Exception as err:
+                    conexion_db.rollback()
+                    comunicacion_mosquitto_log.error('[ERROR]: Error al aplicar la retencion de {}: {}'.format(nombre_tabla, err))
+        finally:
+            conexion_db.close()
+
+    def _consolidar_pendientes(self, conexion_db, cursor):
+        '''
+        Consolida el histórico de las tablas de agregados anotadas en TABLA_AGREGADOS_PENDIENTES, por tramos y con un
+        commit por tramo, para que ningún bloqueo dure más que un tramo. Devuelve las tablas de dispositivo que
+        siguen teniendo agregados pendientes (por error o porque se ha detenido la ejecución).
+        '''
+        cursor.execute('SELECT to_regclass(%s) IS NOT NULL;', (TABLA_AGREGADOS_PENDIENTES,))
+        if not cursor.fetchall()[0][0]:
+            return set()
+        cursor.execute('SELECT tabla_agregado, desde, hasta FROM {} ORDER BY tabla_agregado;'.format(TABLA_AGREGADOS_PENDIENTES))
+        consolidaciones = cursor.fetchall()
+        conexion_db.commit()
+        pendientes = set()
+        for tabla_agregado, desde, hasta in consolidaciones:
+            nombre_tabla, sufijo = tabla_agregado.rsplit('_', 1)
+            try:
+                if not self._consolidar_tabla(conexion_db, cursor, tabla_agregado, nombre_tabla, sufijo, desde, hasta):
+                    pendientes.add(nombre_tabla)
+            except Exception as err:
+                conexion_db.rollback()
+                pendientes.add(nombre_tabla)
+                comunicacion_mosquitto_log.error('[ERROR]: Error al consolidar el historico de {}: {}'.format(tabla_agregado, err))
+        return pendientes
+
+    def _consolidar_tabla(self, conexion_db, cursor, tabla_agregado, nombre_tabla, sufijo, desde, hasta):
+        ''' Consolida los datos de la tabla del dispositivo desde "desde" (o el más antiguo) hasta "hasta". Devuelve True si ha terminado. '''
+        cursor.execute("SELECT column_name FROM information_schema.columns WHERE table_schema='public' AND table_name=%s;", (nombre_tabla,))
+        variables = [fila[0] for fila in cursor.fetchall() if fila[0].startswith('variable_') and fila[0] != 'variable_momento']
+        # Sin "desde" no se ha consolidado nada: el primer tramo no tiene límite inferior (se cuentan también
+        # las muestras atrasadas anteriores a la más antigua de ahora, que la ingesta no ha sumado) y se hace
+        # aunque no haya datos anteriores a "hasta", por si llegan mientras tanto
+        inicio = desde
+        if desde is None:
+            cursor.execute('SELECT min(variable_momento) FROM {} WHERE variable_momento < %s;'.format(nombre_tabla), (hasta,))
+            desde = cursor.fetchall()[0][0]
+            desde = hasta if desde is None else int(desde)
+        while desde < hasta or inicio is None:
+            if self.detener.is_set():
+                return False
+            fin = min(desde + self.ms_tramo_consolidacion, hasta)
+            # Primero se mueve "desde": el UPDATE espera a las transacciones de ingesta que han leído la fila (FOR SHARE),
+            # así que la consolidación ve todas las muestras del tramo que la ingesta no ha sumado, y las que
+            # lleguen después (ya por debajo de "desde") las suma la ingesta
+            cursor.execute('UPDATE {} SET desde = %s WHERE tabla_agregado = %s;'.format(TABLA_AGREGADOS_PENDIENTES), (fin, tabla_agregado))
+            # Los cubos de los extremos pueden estar ya empezados (por el tramo anterior o por la ingesta): se combinan
+            cursor.execute(_sql_consolidar_agregado(nombre_tabla, sufijo, variables, desde=inicio, hasta=fin, combinar=True))
+            conexion_db.commit()
+            desde = inicio = fin
+        cursor.execute('DELETE FROM {} WHERE tabla_agregado = %s;'.format(TABLA_AGREGADOS_PENDIENTES), (tabla_agregado,))
+        conexion_db.commit()
+        comunicacion_mosquitto_log.info('Consolidado el historico de {}.'.format(tabla_agregado))
+        return True
+
+    def _aplicar_tabla(self, cursor, nombre_tabla, particionada, retencion, ahora):
+        if retencion['dias_datos'] > 0:
+            limite = ahora - int(retencion['dias_datos'] * MS_DIA)
+            cursor.execute("SELECT column_name FROM information_schema.columns WHERE table_schema='public' AND table_name=%s;", (nombre_tabla,))
+            variables = [fila[0] for fila in cursor.fetchall() if fila[0].startswith('variable_') and fila[0] != 'variable_momento']
+            if particionada:
+                self._eliminar_particiones(cursor, nombre_tabla, variables, limite)
+            else:
+                self._eliminar_filas(cursor, nombre_tabla, variables, limite)
+
+        for sufijo in AGREGADOS_HISTORICOS:
+            dias = retencion['dias_' + sufijo]
+            if dias > 0:
+                cursor.execute('SELECT to_regclass(%s) IS NOT NULL;', ('{}_{}'.format(nombre_tabla, sufijo),))
+                if cursor.fetchall()[0][0]:
+                    cursor.execute('DELETE FROM {}_{} WHERE cubo < %s;'.format(nombre_tabla, sufijo), (ahora - int(dias * MS_DIA),))
+
+    def _eliminar_particiones(self, cursor, nombre_tabla, variables, limite):
+        ''' Consolida y elimina las particiones que terminan antes del límite. '''
+        cursor.execute('SELECT h.relname FROM pg_inherits AS i JOIN pg_class AS h ON h.oid = i.inhrelid '
+            'WHERE i.inhparent = %s::regclass ORDER BY h.relname;', (nombre_tabla,))
+        for (nombre_particion,) in cursor.fetchall():
+            fin = _fin_particion(nombre_tabla, nombre_particion)
+            if fin is None or fin > limite:
+                continue
+            for sufijo in AGREGADOS_HISTORICOS:
+                cursor.execute(_sql_consolidar_agregado(nombre_tabla, sufijo, variables, tabla_origen=nombre_particion))
+            cursor.execute('DROP TABLE {};'.format(nombre_particion))
+            comunicacion_mosquitto_log.info('Retencion: eliminada la particion {}.'.format(nombre_particion))
+
+    def _eliminar_filas(self, cursor, nombre_tabla, variables, limite):
+        '''
+        Tablas sin particionar (anteriores al particionado): consolida y borra con un único DELETE las filas
+        anteriores al límite. Es más caro que eliminar particiones, pero solo afecta a las tablas antiguas.
+        '''
+        cursor.execute('SELECT min(variable_momento) FROM {};'.format(nombre_tabla))
+        primero = cursor.fetchall()[0][0]
+        if primero is None or primero >= limite:
+            return
+        # Solo se borran días completos, para no dejar cubos diarios a medias
+        limite -= limite % MS_DIA
+        for sufijo in AGREGADOS_HISTORICOS:
+            cursor.execute(_sql_consolidar_agregado(nombre_tabla, sufijo, variables, desde=primero, hasta=limite))
+        cursor.execute('DELETE FROM {} WHERE variable_momento < %s;'.format(nombre_tabla), (limite,))
+        comunicacion_mosquitto_log.info('Retencion: borradas {} filas de {}.'.format(cursor.rowcount, nombre_tabla))
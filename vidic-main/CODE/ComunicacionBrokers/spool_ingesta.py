@@ -0,0 +1,102 @@
+''' Spool en disco de los datos históricos que no se han podido escribir en la base de datos.
+
+Lo usa EscritorHistorico (almacenamiento_historico.py) mientras PostgreSQL no está disponible. Los lotes se
+añaden, en orden, a ficheros de segmento (000000000001.seg, 000000000002.seg, ...) de hasta "mb_segmento_spool" MB.
+Cada registro es un lote ({nombre_tabla: [muestras]}) codificado con msgpack, precedido de su longitud y su CRC32:
+un registro incompleto o corrupto (p.ej. por una caída a mitad de escritura) se detecta al leerlo y se descarta
+junto con el resto de su segmento. Cuando vuelve la base de datos, los segmentos se reenvían del más antiguo
+al más nuevo y se eliminan una vez confirmados (si el proceso cae justo entre el commit y el borrado, el
+segmento se reenvía otra vez al arrancar).
+'''
+import logging
+import os
+import struct
+import zlib
+
+import msgpack
+
+comunicacion_mosquitto_log = logging.getLogger('com_mosquitto.log')
+
+MB_SEGMENTO_SPOOL = 8
+# Cabecera de cada registro: longitud de los datos y CRC32 (enteros sin signo de 32 bits, little-endian)
+CABECERA_REGISTRO = struct.Struct('<II')
+EXTENSION_SEGMENTO = '.seg'
+
+
+class SpoolIngesta:
+    ''' Cola persistente de lotes en un directorio de segmentos. No es segura entre hilos: la usa un único escritor. '''
+
+    def __init__(self, directorio, mb_segmento_spool: float = MB_SEGMENTO_SPOOL):
+        os.makedirs(directorio, exist_ok=True)
+        self.directorio = directorio
+        self.tamanyo_segmento = int(float(mb_segmento_spool) * 2**20)
+        # Segmentos pendientes de reenviar, del más antiguo al más nuevo. Los que quedaran de una ejecución
+        # anterior no se amplían: los lotes nuevos van siempre a un segmento nuevo.
+        self.segmentos = sorted(os.path.join(directorio, nombre) for nombre in os.listdir(directorio) if nombre.endswith(EXTENSION_SEGMENTO))
+        self.bytes_pendientes = sum(os.path.getsize(ruta) for ruta in self.segmentos)
+        # Segmento abierto en el que se están añadiendo lotes (siempre el último de self.segmentos)
+        self.activo = None
+
+    def pendiente(self):
+        ''' Tamaño en bytes de los datos pendientes de reenviar. '''
+        return self.bytes_pendientes
+
+    def guardar(self, lotes):
+        ''' Añade un lote al final del spool. Vuelve cuando el lote está escrito en disco (fsync). '''
+        datos = msgpack.packb(lotes)
+        if self.activo is None or self.activo.tell() >= self.tamanyo_segmento:
+            self._nuevo_segmento()
+        self.activo.write(CABECERA_REGISTRO.pack(len(datos), zlib.crc32(datos)) + datos)
+        self.activo.flush()
+        os.fsync(self.activo.fileno())
+        self.bytes_pendientes += CABECERA_REGISTRO.size + len(datos)
+
+    def primer_segmento(self):
+        '''
+        Devuelve (ruta, lotes) del segmento más antiguo, o None si no hay nada pendiente.
+        Si es el segmento en el que se está escribiendo se cierra, y los lotes siguientes irán a uno nuevo.
+        '''
+        if not self.segmentos:
+            return None
+        ruta = self.segmentos[0]
+        if self.activo is not None and self.activo.name == ruta:
+            self._cerrar_activo()
+        return ruta, list(self._leer_segmento(ruta))
+
+    def eliminar_segmento(self, ruta):
+        ''' Elimina un segmento ya reenviado a la base de datos. '''
+        self.bytes_pendientes -= os.path.getsize(ruta)
+        os.remove(ruta)
+        self.segmentos.remove(ruta)
+
+    def cerrar(self):
+        self._cerrar_activo()
+
+    def _nuevo_segmento(self):
+        self._cerrar_activo()
+        numero = int(os.path.basename(self.segmentos[-1])[:-len(EXTENSION_SEGMENTO)]) + 1 if self.segmentos else 1
+        ruta = os.path.join(self.directorio, '{:012d}{}'.format(numero, EXTENSION_SEGMENTO))
+        self.activo = open(ruta, 'ab')
+        self.segmentos.append(ruta)
+
+    def _cerrar_activo(self):
+        if self.activo is not None:
+            self.activo.close()
+            self.activo = None
+
+    def _leer_segmento(self, ruta):
+        with open(ruta, 'rb') as fichero:
+            contenido = fichero.read()
+        posicion = 0
+        while posicion < len(contenido):
+            if posicion + CABECERA_REGISTRO.size > len(contenido):
+                comunicacion_mosquitto_log.error('[ERROR]: Registro incompleto al final del segmento {} del spool.'.format(ruta))
+                return
+            longitud, crc = CABECERA_REGISTRO.unpack_from(contenido, posicion)
+            posicion += CABECERA_REGISTRO.size
+            datos = contenido[posicion:posicion + longitud]
+            if len(datos) < longitud or zlib.crc32(datos) != crc:
+                comunicacion_mosquitto_log.error('[ERROR]: Registro corrupto en el segmento {} del spool: se descarta el resto del segmento.'.format(ruta))
+                return
+            posicion += longitud
+            yield msgpack.unpackb(datos)
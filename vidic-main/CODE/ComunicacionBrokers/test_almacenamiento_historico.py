@@ -0,0 +1,117 @@
+import psycopg2
+import pytest
+
+import almacenamiento_historico
+from almacenamiento_historico import AGREGADOS_HISTORICOS, EscritorHistorico, _acumular_agregados
+
+
+class _CursorFalso:
+    def __init__(self, conexion):
+        self.conexion = conexion
+
+    def execute(self, sql, parametros=None):
+        self.conexion.sentencias.append(sql)
+
+
+class _ConexionFalsa:
+    ''' Conexión sin base de datos: registra las sentencias y puede fallar al confirmar. '''
+
+    def __init__(self, error_commit=None):
+        self.closed = 0
+        self.error_commit = error_commit
+        self.sentencias = []
+        self.confirmadas = 0
+
+    def cursor(self):
+        return _CursorFalso(self)
+
+    def commit(self):
+        if self.error_commit is not None:
+            raise self.error_commit
+        self.confirmadas += 1
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+@pytest.fixture
+def escritor(monkeypatch, tmp_path):
+    ''' Escritor con spool, sin volcado periódico, cuyas tablas "se escriben" sin base de datos. '''
+    def crear(conexion, fallo_tabla=None):
+        monkeypatch.setattr(almacenamiento_historico, '_iniciar_conexion_db', lambda: (conexion, conexion.cursor()))
+        escritor = EscritorHistorico(segundos_lote=3600, directorio_spool=str(tmp_path))
+        escritas = []
+        def copiar(nombre_tabla, muestras):
+            if nombre_tabla == fallo_tabla:
+                raise ValueError('valor no valido en COPY')
+            escritas.append(nombre_tabla)
+        monkeypatch.setattr(escritor, '_preparar_tabla', lambda nombre_tabla, muestras: None)
+        monkeypatch.setattr(escritor, '_copiar_muestras', copiar)
+        monkeypatch.setattr(escritor, '_volcar_agregados', lambda nombre_tabla, agregados: None)
+        monkeypatch.setattr(escritor, '_consolidaciones_pendientes', lambda nombre_tabla: {})
+        return escritor, escritas
+    return crear
+
+
+def _payload(id_dispositivo, momento):
+    return {'timestamp': momento, 'datos': {'id_dispositivo': id_dispositivo, 'datos': {'a': 1.5}}}
+
+
+def test_fallo_de_una_tabla_solo_descarta_esa_tabla(escritor):
+    conexion = _ConexionFalsa()
+    escritor, escritas = escritor(conexion, fallo_tabla='dispositivo_2')
+    for id_dispositivo in (1, 2, 3):
+        escritor.almacenar(_payload(id_dispositivo, 1000))
+    escritor.volcar()
+    assert escritas == ['dispositivo_1', 'dispositivo_3']
+    assert 'ROLLBACK TO SAVEPOINT lote_tabla;' in conexion.sentencias
+    assert conexion.confirmadas == 1
+    assert escritor.spool.pendiente() == 0
+    escritor.cerrar()
+
+
+def test_fallo_al_confirmar_conserva_los_lotes_en_el_spool(escritor):
+    conexion = _ConexionFalsa(error_commit=psycopg2.IntegrityError('restriccion diferida'))
+    escritor, _ = escritor(conexion)
+    escritor.almacenar(_payload(1, 1000))
+    escritor.volcar()
+    assert escritor.spool.pendiente() > 0
+    # Un nuevo volcado que tampoco puede confirmar no elimina el segmento
+    escritor.volcar()
+    assert escritor.spool.primer_segmento()[1] == [{'dispositivo_1': [{'a': 1.5, 'momento': 1000}]}]
+    # Cuando se puede confirmar, se reenvía y se elimina
+    conexion.error_commit = None
+    escritor.volcar()
+    assert escritor.spool.pendiente() == 0
+    escritor.cerrar()
+
+
+def test_acumular_agregados_alinea_los_cubos():
+    agregados = {}
+    momentos = [60 * 1000 * 5 + 1, 60 * 1000 * 5 + 59999, 60 * 1000 * 6, 3600 * 1000 * 30 + 7]
+    for valor, momento in enumerate(momentos):
+        _acumular_agregados(agregados, momento, {'a': valor, 'texto': 'x', 'momento': momento})
+    for sufijo, ancho in AGREGADOS_HISTORICOS.items():
+        assert all(cubo % ancho == 0 for cubo in agregados[sufijo])
+        assert sum(cubo['variables']['a'][0] for cubo in agregados[sufijo].values()) == len(momentos)
+    assert sorted(agregados['1m']) == [300000, 360000, 108000000]
+    # [cuenta, suma, minimo, maximo, momento_primero, primero, momento_ultimo, ultimo]
+    assert agregados['1m'][300000]['variables']['a'] == [2, 1, 0, 1, 300001, 0, 359999, 1]
+    assert agregados['1h'][0]['momento_primero'] == 300001 and agregados['1h'][0]['momento_ultimo'] == 360000
+    assert 'texto' not in agregados['1d'][0]['variables']
+
+
+def test_acumular_agregados_omite_las_muestras_pendientes_de_consolidar():
+    hora = 3600 * 1000
+    # 1h: consolidación empezada, ya va por la hora 10; 1m: sin empezar; 1d: sin consolidación pendiente
+    consolidaciones = {'1h': (10 * hora, 20 * hora), '1m': (None, 20 * hora)}
+    agregados = {}
+    for momento in (5 * hora, 15 * hora, 25 * hora):
+        _acumular_agregados(agregados, momento, {'a': 1.0, 'momento': momento}, consolidaciones)
+    # Las muestras ya por debajo de "desde" las suma la ingesta; las de [desde, hasta), la consolidación
+    assert sorted(agregados['1h']) == [5 * hora, 25 * hora]
+    assert sorted(agregados['1m']) == [25 * hora]
+    assert sum(cubo['variables']['a'][0] for cubo in agregados['1d'].values()) == 3
@@ -0,0 +1,230 @@
+import asyncio
+import json
+import random
+import time
+
+import msgpack
+from jose import jwt
+
+from pasarela_websocket import ALGORITMO_JWT, PasarelaWebSocket, _ClientePasarela
+
+CLAVE = 'clave-de-prueba'
+
+
+class _WebSocketFalso:
+    ''' Conexión de un cliente: autenticación con "token", después las "peticiones" y se cierra. '''
+
+    def __init__(self, token, peticiones):
+        self.autenticacion = json.dumps({'accion': 'autenticar', 'token': token})
+        self.peticiones = peticiones
+        self.enviados = []
+        self.cierre = None
+
+    async def recv(self):
+        return self.autenticacion
+
+    async def send(self, mensaje):
+        self.enviados.append(mensaje)
+
+    async def close(self, codigo, motivo=''):
+        self.cierre = codigo
+
+    async def __aiter__(self):
+        for peticion in self.peticiones:
+            yield peticion
+        # Da tiempo a la tarea de envío a vaciar la cola del cliente
+        for _ in range(10):
+            await asyncio.sleep(0)
+
+
+def _pasarela(instalaciones):
+    pasarela = PasarelaWebSocket(None, CLAVE, publicaciones_por_segundo=0)
+    pasarela.consultas = []
+
+    def _instalacionesUsuario(usuario):
+        pasarela.consultas.append(usuario)
+        return frozenset(instalaciones)
+    pasarela._instalacionesUsuario = _instalacionesUsuario
+    return pasarela
+
+
+def _token(usuario):
+    return jwt.encode({'sub': usuario, 'exp': time.time() + 60}, CLAVE, algorithm=ALGORITMO_JWT)
+
+
+def _suscribir(topic):
+    return json.dumps({'accion': 'suscribir', 'topic': topic})
+
+
+def test_solo_se_suscribe_a_dispositivos_de_sus_instalaciones():
+    pasarela = _pasarela({'1'})
+    pasarela.ultimos_valores['1.5'] = msgpack.packb({'timestamp': 1, 'datos': {'a': 1}})
+    pasarela.ultimos_valores['2.7'] = msgpack.packb({'timestamp': 1, 'datos': {'b': 2}})
+    websocket = _WebSocketFalso(_token('ana'), [_suscribir('1.5'), _suscribir('2.7'), _suscribir('12.7')])
+    asyncio.run(pasarela._atenderCliente(websocket))
+
+    assert pasarela.consultas == ['ana']
+    assert websocket.cierre is None
+    autenticado, dato, *rechazos = websocket.enviados
+    assert json.loads(autenticado) == {'accion': 'autenticado'}
+    assert msgpack.unpackb(dato)[0] == '1.5'
+    # La instalación 12 tampoco es suya aunque empiece por "1"
+    assert [json.loads(rechazo) for rechazo in rechazos] == [{'accion': 'no_autorizado', 'topic': '2.7'},
+        {'accion': 'no_autorizado', 'topic': '12.7'}]
+    # Al desconectarse no queda ninguna suscripción
+    assert pasarela.suscripciones == {}
+
+
+def test_suscripcion_rechazada_no_recibe_datos():
+    pasarela = _pasarela(set())
+    cliente = _ClientePasarela(None, 10)
+    cliente.instalaciones = frozenset({'1'})
+    pasarela._procesarPeticion(cliente, _suscribir('2.7'))
+    assert cliente.topics == set() and '2.7' not in pasarela.suscripciones
+    pasarela._repartir('2.7', msgpack.packb({'timestamp': 1, 'datos': {'b': 2}}))
+    assert json.loads(cliente.cola.get_nowait()) == {'accion': 'no_autorizado', 'topic': '2.7'}
+    assert cliente.cola.empty()
+
+
+def test_token_no_valido_se_cierra_sin_consultar_la_base_de_datos():
+    pasarela = _pasarela({'1'})
+    websocket = _WebSocketFalso(jwt.encode({'sub': 'ana'}, 'otra-clave', algorithm=ALGORITMO_JWT), [_suscribir('1.5')])
+    asyncio.run(pasarela._atenderCliente(websocket))
+    assert websocket.cierre == 4401
+    assert pasarela.consultas == []
+    assert websocket.enviados == []
+
+
+def test_error_al_leer_las_instalaciones_cierra_la_conexion():
+    pasarela = _pasarela(set())
+
+    def _fallo(usuario):
+        raise RuntimeError('sin base de datos')
+    pasarela._instalacionesUsuario = _fallo
+    websocket = _WebSocketFalso(_token('ana'), [_suscribir('1.5')])
+    asyncio.run(pasarela._atenderCliente(websocket))
+    assert websocket.cierre == 1011
+    assert websocket.enviados == []
+
+
+def _payload(timestamp, datos):
+    return msgpack.packb({'timestamp': timestamp, 'datos': {'id_dispositivo': '5', 'datos': datos}})
+
+
+def _cliente_suscrito(pasarela, topic, deltas=True):
+    cliente = _ClientePasarela(None, 100)
+    cliente.instalaciones = frozenset({topic.split('.')[0]})
+    cliente.deltas = deltas
+    pasarela._procesarPeticion(cliente, _suscribir(topic))
+    return cliente
+
+
+def _mensajes(cliente):
+    mensajes = []
+    while not cliente.cola.empty():
+        mensajes.append(msgpack.unpackb(cliente.cola.get_nowait()))
+    return mensajes
+
+
+def test_deltas_entre_fotogramas_completos():
+    pasarela = _pasarela(set())
+    pasarela.segundos_keyframe = 30
+    cliente = _cliente_suscrito(pasarela, '1.5')
+    envios = [
+        (0, {'a': 1, 'b': 2}),
+        (1, {'a': 1, 'b': 3}),
+        (2, {'a': 1, 'b': 3, 'c': 4}),
+        # Desaparece una variable: fotograma completo
+        (3, {'a': 2, 'c': 4}),
+        (4, {'a': 2, 'c': 4}),
+        # Pasados segundos_keyframe desde el último fotograma completo
+        (40, {'a': 2, 'c': 5}),
+    ]
+    for ahora, datos in envios:
+        pasarela._enviarDato(cliente, '1.5', _payload(ahora * 1000, datos), ahora, {})
+    mensajes = [payload for (topic, payload) in _mensajes(cliente)]
+    assert mensajes == [
+        {'timestamp': 0, 'datos': {'id_dispositivo': '5', 'datos': {'a': 1, 'b': 2}}},
+        {'timestamp': 1000, 'delta': {'b': 3}},
+        {'timestamp': 2000, 'delta': {'c': 4}},
+        {'timestamp': 3000, 'datos': {'id_dispositivo': '5', 'datos': {'a': 2, 'c': 4}}},
+        {'timestamp': 4000, 'delta': {}},
+        {'timestamp': 40000, 'datos': {'id_dispositivo': '5', 'datos': {'a': 2, 'c': 5}}},
+    ]
+
+
+def test_los_deltas_reconstruyen_los_datos():
+    ''' Aplicando los deltas como conexionPasarela.js se obtiene siempre el último dato. '''
+    aleatorio = random.Random(1)
+    pasarela = _pasarela(set())
+    cliente = _cliente_suscrito(pasarela, '1.5')
+    datos = {}
+    reconstruido = None
+    for ahora in range(200):
+        datos = {variable: aleatorio.randrange(3) for variable in 'abcdef' if variable in datos or aleatorio.random() < 0.3}
+        if aleatorio.random() < 0.1:
+            datos.pop(aleatorio.choice('abcdef'), None)
+        pasarela._enviarDato(cliente, '1.5', _payload(ahora, datos), ahora, {})
+        for (topic, mensaje) in _mensajes(cliente):
+            if 'delta' in mensaje:
+                reconstruido = dict(reconstruido, **mensaje['delta'])
+            else:
+                reconstruido = mensaje['datos']['datos']
+        assert reconstruido == datos
+
+
+def test_fotograma_completo_compartido_sin_deltas():
+    pasarela = _pasarela(set())
+    clientes = [_cliente_suscrito(pasarela, '1.5', deltas=False) for _ in range(3)]
+    payload = _payload(0, {'a': 1})
+    pasarela._repartir('1.5', payload)
+    pasarela._repartir('1.5', _payload(1, {'a': 1}))
+    enviados = [cliente.cola.get_nowait() for cliente in clientes]
+    # Se envía el payload recibido sin decodificarlo, el mismo objeto para todos los clientes
+    assert msgpack.unpackb(enviados[0]) == ['1.5', msgpack.unpackb(payload)]
+    assert all(mensaje is enviados[0] for mensaje in enviados)
+    # Sin deltas, el segundo dato también es un fotograma completo
+    assert all(msgpack.unpackb(cliente.cola.get_nowait())[1]['datos'] == {'id_dispositivo': '5', 'datos': {'a': 1}} for cliente in clientes)
+
+
+def test_limite_por_segundo_retiene_solo_el_ultimo_dato():
+    pasarela = _pasarela(set())
+    cliente = _cliente_suscrito(pasarela, '1.5', deltas=False)
+    cliente.intervalo_minimo = 3600
+    for timestamp in range(5):
+        pasarela._repartir('1.5', _payload(timestamp, {'a': timestamp}))
+    assert [mensaje[1]['timestamp'] for mensaje in _mensajes(cliente)] == [0]
+    assert msgpack.unpackb(cliente.pendientes['1.5'])['timestamp'] == 4
+    assert cliente in pasarela.clientes_con_pendientes
+
+
+def test_expulsar_con_varios_pendientes_no_detiene_la_pasarela():
+    pasarela = _pasarela(set())
+    cliente = _ClientePasarela(_WebSocketFalso(None, []), 1)
+    cliente.instalaciones = frozenset({'1'})
+    for topic in ('1.1', '1.2'):
+        pasarela._procesarPeticion(cliente, _suscribir(topic))
+        cliente.enviados[topic] = {'datos': None, 'keyframe': 0, 'envio': float('-inf')}
+        cliente.pendientes[topic] = _payload(1, {'a': 1})
+    pasarela.clientes_con_pendientes.add(cliente)
+    # La cola (tamaño 1) está llena: el primer envío pendiente expulsa al cliente
+    cliente.cola.put_nowait(b'')
+
+    async def _revisar():
+        tarea = asyncio.ensure_future(pasarela._vaciarPendientes())
+        await asyncio.sleep(0.3)
+        assert not tarea.done()
+        tarea.cancel()
+    asyncio.run(_revisar())
+
+    assert cliente.expulsado and cliente.websocket.cierre == 4408
+    assert cliente.enviados == {} and cliente.pendientes == {}
+    assert pasarela.clientes_con_pendientes == set() and pasarela.suscripciones == {}
+
+
+def test_cliente_expulsado_no_recupera_estado_de_envio():
+    pasarela = _pasarela(set())
+    cliente = _cliente_suscrito(pasarela, '1.5')
+    cliente.expulsado = True
+    pasarela._enviarDato(cliente, '1.5', _payload(0, {'a': 0}), 0, {})
+    assert cliente.enviados == {} and cliente.cola.empty()
@@ -0,0 +1,67 @@
+import os
+
+from spool_ingesta import CABECERA_REGISTRO, SpoolIngesta
+
+
+def _lote(indice):
+    return {'dispositivo_1': [{'a': indice, 'momento': 1000 + indice}]}
+
+
+def test_reenvio_en_orden_y_eliminacion(tmp_path):
+    spool = SpoolIngesta(str(tmp_path), mb_segmento_spool=0.0001)
+    for indice in range(20):
+        spool.guardar(_lote(indice))
+    # Segmentos de ~100 bytes: los lotes se reparten en varios
+    assert len(spool.segmentos) > 1
+    leidos = []
+    while spool.primer_segmento() is not None:
+        ruta, lotes = spool.primer_segmento()
+        leidos.extend(lotes)
+        spool.eliminar_segmento(ruta)
+    assert leidos == [_lote(indice) for indice in range(20)]
+    assert spool.pendiente() == 0
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_los_segmentos_de_una_ejecucion_anterior_se_conservan(tmp_path):
+    spool = SpoolIngesta(str(tmp_path))
+    spool.guardar(_lote(1))
+    spool.cerrar()
+    spool = SpoolIngesta(str(tmp_path))
+    assert spool.pendiente() > 0
+    spool.guardar(_lote(2))
+    # El segmento anterior no se amplía: el lote nuevo va a un segmento posterior
+    assert [os.path.basename(ruta) for ruta in spool.segmentos] == ['000000000001.seg', '000000000002.seg']
+    assert spool.primer_segmento()[1] == [_lote(1)]
+
+
+def test_registro_corrupto_descarta_el_resto_del_segmento(tmp_path):
+    spool = SpoolIngesta(str(tmp_path))
+    for indice in range(3):
+        spool.guardar(_lote(indice))
+    ruta = spool.segmentos[0]
+    spool.cerrar()
+    with open(ruta, 'r+b') as fichero:
+        contenido = bytearray(fichero.read())
+        longitud = CABECERA_REGISTRO.unpack_from(contenido, 0)[0]
+        # Se cambia un byte de los datos del segundo registro: su CRC ya no coincide
+        contenido[2 * CABECERA_REGISTRO.size + longitud] ^= 0xff
+        fichero.seek(0)
+        fichero.write(contenido)
+    assert SpoolIngesta(str(tmp_path)).primer_segmento()[1] == [_lote(0)]
+
+
+def test_registro_incompleto_al_final(tmp_path):
+    spool = SpoolIngesta(str(tmp_path))
+    spool.guardar(_lote(0))
+    spool.guardar(_lote(1))
+    ruta = spool.segmentos[0]
+    spool.cerrar()
+    with open(ruta, 'rb') as fichero:
+        primer_registro = CABECERA_REGISTRO.size + CABECERA_REGISTRO.unpack_from(fichero.read(), 0)[0]
+    # Caída a mitad de escritura: datos del último registro truncados...
+    os.truncate(ruta, os.path.getsize(ruta) - 3)
+    assert SpoolIngesta(str(tmp_path)).primer_segmento()[1] == [_lote(0)]
+    # ... o su cabecera incompleta
+    os.truncate(ruta, primer_registro + 3)
+    assert SpoolIngesta(str(tmp_path)).primer_segmento()[1] == [_lote(0)]
@@ -0,0 +1,149 @@
+''' Tubería de ingesta del módulo de entrada (moduloMqtt-tr.py).
+
+Los mensajes de Mosquitto pasan por tres etapas separadas por colas acotadas, de forma que el bucle de
+red de paho (on_message) nunca espera a PostgreSQL:
+    recepción    -> on_message solo encola (topic, payload, momento de llegada); no decodifica ni escribe.
+    decodificación y reparto -> un hilo pasa el payload al canal de tiempo real del Crossbar
+                    (canal_tiempo_real.py) sin volver a codificarlo, decodifica el msgpack y reparte la
+                    muestra a la cola del trabajador de persistencia de su dispositivo.
+    persistencia -> "trabajadores_persistencia" hilos, cada uno con su EscritorHistorico (y su conexión).
+                    Cada dispositivo va siempre al mismo trabajador: se conserva el orden de sus muestras
+                    y su tabla solo la modifica un escritor. Con spool configurado (directorio_spool en la
+                    sección HISTORICO), cada trabajador usa su subdirectorio proceso_M/persistencia_N.
+Si una cola se llena (p.ej. la base de datos no da abasto), los mensajes de esa etapa se descartan y se
+cuentan en el log en lugar de bloquear la etapa anterior.
+
+Configuración (sección INGESTA de inMQTT.ini): tamanyo_cola, trabajadores_persistencia
+'''
+import datetime
+import logging
+import os
+import queue
+import threading
+import time
+import zlib
+
+import msgpack
+
+from almacenamiento_historico import EscritorHistorico
+
+comunicacion_mosquitto_log = logging.getLogger('com_mosquitto.log')
+
+TAMANYO_COLA = 10000
+TRABAJADORES_PERSISTENCIA = 2
+# Mínimo de segundos entre dos avisos en el log de mensajes descartados por la misma cola
+SEGUNDOS_AVISO_DESCARTES = 10
+# Cabecera msgpack del mensaje de tiempo real {'timestamp': ms, 'datos': <payload del dispositivo>}: un mapa de
+# dos elementos y la clave 'timestamp'. El payload que llega de Mosquitto ya es msgpack y se copia tal cual.
+CABECERA_TIEMPO_REAL = b'\x82' + msgpack.packb('timestamp')
+CLAVE_DATOS_TIEMPO_REAL = msgpack.packb('datos')
+
+
+def _payload_tiempo_real(momento, payload):
+    ''' Devuelve el msgpack de {'timestamp': momento, 'datos': payload} sin decodificar el payload. '''
+    return CABECERA_TIEMPO_REAL + msgpack.packb(momento) + CLAVE_DATOS_TIEMPO_REAL + payload
+
+
+class TuberiaIngesta:
+    '''
+    Etapas de decodificación, reparto y persistencia de los mensajes recibidos de Mosquitto.
+    Los hilos se crean al instanciarla: debe crearse dentro del proceso que los va a usar (después del fork).
+    '''
+
+    def __init__(self, emisor_tiempo_real, parametros_historico, tamanyo_cola: int = TAMANYO_COLA,
+            trabajadores_persistencia: int = TRABAJADORES_PERSISTENCIA):
+        self.emisor_tiempo_real = emisor_tiempo_real
+        self.cola_recepcion = queue.Queue(maxsize=int(tamanyo_cola))
+        self.colas_persistencia = [queue.Queue(maxsize=int(tamanyo_cola)) for _ in range(int(trabajadores_persistencia))]
+        # Mensajes descartados por cola llena: etapa -> [total, total en el último aviso, momento del último aviso]
+        self.descartes = {}
+        self.cerrojo_descartes = threading.Lock()
+        self.hilos = [threading.Thread(target=self._decodificar_y_repartir, name='decodificacion-ingesta', daemon=True)]
+        directorio_spool = parametros_historico.get('directorio_spool')
+        if directorio_spool:
+            self._comprobar_spool(directorio_spool)
+        for indice, cola in enumerate(self.colas_persistencia):
+            if directorio_spool:
+                parametros_historico = dict(parametros_historico, directorio_spool=os.path.join(directorio_spool, 'persistencia_{}'.format(indice)))
+            escritor = EscritorHistorico(**parametros_historico)
+            self.hilos.append(threading.Thread(target=self._persistir, args=(cola, escritor), name='persistencia-ingesta-{}'.format(indice), daemon=True))
+        for hilo in self.hilos:
+            hilo.start()
+
+    def recibir(self, topic, payload):
+        ''' Etapa de recepción: se llama desde on_message y nunca bloquea. '''
+        momento = datetime.datetime.now(datetime.timezone.utc).timestamp() * 1000.0
+        try:
+            self.cola_recepcion.put_nowait((topic, payload, momento))
+        except queue.Full:
+            self._descartar('recepcion')
+
+    def cerrar(self):
+        ''' Procesa lo que quede en las colas, vuelca los lotes pendientes y cierra las conexiones. '''
+        self.cola_recepcion.put(None)
+        for hilo in self.hilos:
+            hilo.join(timeout=30)
+
+    def _comprobar_spool(self, directorio_spool):
+        ''' Avisa de los spools de trabajadores que ya no existen (p.ej. si se ha reducido "trabajadores_persistencia"). '''
+        if not os.path.isdir(directorio_spool):
+            return
+        for nombre in sorted(os.listdir(directorio_spool)):
+            sufijo = nombre[len('persistencia_'):]
+            if nombre.startswith('persistencia_') and sufijo.isdigit() and int(sufijo) >= len(self.colas_persistencia) \
+                    and os.listdir(os.path.join(directorio_spool, nombre)):
+                comunicacion_mosquitto_log.error('[ERROR]: El spool {} tiene datos pendientes pero no hay trabajador que lo reenvie: '
+                    'aumentar trabajadores_persistencia.'.format(os.path.join(directorio_spool, nombre)))
+
+    def _descartar(self, etapa):
+        with self.cerrojo_descartes:
+            contador = self.descartes.setdefault(etapa, [0, 0, 0.0])
+            contador[0] += 1
+            ahora = time.monotonic()
+            if ahora - contador[2] < SEGUNDOS_AVISO_DESCARTES:
+                return
+            nuevos, contador[1], contador[2] = contador[0] - contador[1], contador[0], ahora
+        comunicacion_mosquitto_log.error('[ERROR]: Cola de {} llena: {} mensajes descartados ({} en total).'.format(etapa, nuevos, contador[0]))
+
+    def _decodificar_y_repartir(self):
+        while True:
+            try:
+                # Sin mensajes nuevos también hay que enviar el último lote del canal de tiempo real
+                mensaje = self.cola_recepcion.get(timeout=self.emisor_tiempo_real.segundos_lote)
+            except queue.Empty:
+                self.emisor_tiempo_real.vaciar()
+                continue
+            if mensaje is None:
+                self.emisor_tiempo_real.vaciar()
+                for cola in self.colas_persistencia:
+                    cola.put(None)
+                return
+            topic, payload, momento = mensaje
+            try:
+                topic = topic.split("/")    # [VIDIC, id_instalcion, id_dispositivo]
+                id_instalacion = topic[1]
+                id_dispositivo = topic[2]
+                new_payload = {'timestamp': momento, 'datos': msgpack.loads(payload)}
+                self.emisor_tiempo_real.enviar(id_instalacion + '.' + id_dispositivo, _payload_tiempo_real(momento, payload))
+            except Exception as err:
+                comunicacion_mosquitto_log.error('[ERROR]: Error al decodificar el payload de Mosquitto: {}'.format(err))
+                continue
+            # Reparto estable por dispositivo (crc32 no depende del proceso, a diferencia de hash())
+            cola = self.colas_persistencia[zlib.crc32(id_dispositivo.encode()) % len(self.colas_persistencia)]
+            try:
+                cola.put_nowait(new_payload)
+            except queue.Full:
+                self._descartar('persistencia')
+
+    def _persistir(self, cola, escritor):
+        try:
+            while True:
+                new_payload = cola.get()
+                if new_payload is None:
+                    return
+                try:
+                    escritor.almacenar(new_payload)
+                except Exception as err:
+                    comunicacion_mosquitto_log.error('[ERROR]: Error al almacenar el payload: {}'.format(err))
+        finally:
+            escritor.cerrar()
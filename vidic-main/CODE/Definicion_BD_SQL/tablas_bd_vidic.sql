@@ -81,3 +81,13 @@ CREATE TABLE dashboard (
 		opciones       TEXT,
 		FOREIGN KEY (instalacion_id) REFERENCES instalacion (id) ON DELETE CASCADE ON UPDATE CASCADE
 );
+
+
+-- Las tablas de datos de los dispositivos (dispositivo_N), sus particiones (dispositivo_N_pAAAAMM o
+-- dispositivo_N_pAAAAMMDD) y sus tablas de agregados (dispositivo_N_1m, _1h y _1d) las crea y mantiene
+-- el módulo de entrada (ComunicacionBrokers/almacenamiento_historico.py). El borrado de los datos antiguos
+-- se configura en la sección RETENCION de ComunicacionBrokers/inMQTT.ini (retencion_historico.py).
+-- La tabla agregados_pendientes (tablas de agregados cuyo histórico falta por consolidar) también la crea el
+-- módulo de entrada cuando la necesita, y retencion_historico.py la vacía.
+-- variable_momento es BIGINT (ms desde epoch); las tablas creadas con NUMERIC se convierten con
+-- ComunicacionBrokers/migrar_momento.py.
@@ -8,6 +8,9 @@ de la DLL snap7.dll (que debe estar accesible en el path).
 
 Para comunicación Modbus/TCP, no hay ninguna dependencia externa.
 
+Si está instalado el paquete "numpy" (opcional), los bloques grandes de registros
+se decodifican de forma vectorizada (ver leer_array_valores y leer_lista_valores).
+
 Requiere el paquete "pywin32".
 '''
 import logging
@@ -29,6 +32,13 @@ import re
 import math
 # Diccionarios que mantienen orden inserción
 from collections import OrderedDict
+# Extracción de bytes en un orden precalculado (planes de lectura)
+from operator import itemgetter
+# Decodificación vectorizada de bloques de registros (opcional)
+try:
+    import numpy
+except ImportError:
+    numpy = None
 # Generador de números aleatorios enteros
 from random import randint
 # Librerías de sistema
@@ -73,6 +83,10 @@ log = logging.getLogger(__name__)
 # Usamos logging.DEBUG - 3 para dejar margen a niveles de depuración por debajo
 DEBUG_CLIENTE_PLC = logging.DEBUG - 3
 
+# Número mínimo de valores a partir del cual _convertir_registros_a_valores decodifica
+# con numpy (si está instalado); con menos valores no compensa crear los arrays.
+MIN_VALORES_NUMPY = 32
+
 # Usamos la librería asyncua para poder comunicarnos con dispositivos a través del
 # protocolo OPC-UA. En este caso usamos un módulo síncrono para realizar las 
 # comunicaciones.
@@ -294,6 +308,21 @@ CARACTER_TIPO_DATOS = {
 }
 
 
+class _RangoCompilado:
+    ''' Plan de lectura precalculado de un rango de registros de un mapa (ver ClientePLC._compilar_rango).
+    "formato" es un struct.Struct que decodifica de una vez todos los valores de "campos"; los
+    "campos_sueltos" se solapan con otro campo (p.ej. un byte dentro de un word) y se decodifican
+    aparte. Cada campo es una tupla (desplazamiento, formato_campo, conversion, variables), con
+    variables = [(posicion, nombre_variable, mascara_bit)] (mascara_bit = None si no es booleano).
+    '''
+    __slots__ = ('direccion_min', 'direccion_max', 'num_registros', 'formato', 'campos', 'campos_sueltos')
+
+    def __init__(self, rango: Tuple[int, int, int], formato: struct.Struct, campos: List[tuple], campos_sueltos: List[tuple]):
+        (self.direccion_min, self.direccion_max, self.num_registros) = rango
+        self.formato = formato
+        self.campos = campos
+        self.campos_sueltos = campos_sueltos
+
 
 class ClientePLC:
     ''' Objeto cliente para comunicación con PLCs o dispositivos Modbus.
@@ -351,7 +380,8 @@ class ClientePLC:
         # Modbus está limitado a 123 registros por lectura. Siemens, aunque tiene
         # un límite de tamaño de PDU entre 240 a 960 bytes, al acceder con la
         # librería Snap7 no importa; la propia librería divide la llamada en
-        # fragmentos más pequeños.
+        # fragmentos más pequeños. (ClientePLCSiemens lo limita de todas formas
+        # para poder agrupar varias lecturas en una PDU.)
         self.max_registros_por_lectura = 65535
         # Order de los bytes (endianess) que usa el dispositivo.
         # Se usan los caracteres de las cadenas de formato de la función
@@ -423,6 +453,26 @@ class ClientePLC:
         # }
         # (siempre será una lista de tuplas, cada una corresponde a una lectura)
         self._rango_direcciones = {None: OrderedDict()}
+        # Coste estimado de cada lectura, con el que _rango_posiciones decide qué rangos leer de
+        # cada mapa: tiempo fijo de cada petición al dispositivo (ida y vuelta) y tiempo por cada
+        # registro leído. Con los valores por defecto, antes que hacer una petición más compensa
+        # leer hasta 200 registros que no tienen variables. Deben ajustarse antes de mapear_variables.
+        self.segundos_por_peticion = 0.01
+        self.segundos_por_registro = 0.00005
+        # Direcciones que el dispositivo no permite leer (hay servidores Modbus que dan error al
+        # leer registros que no tienen definidos): diccionario {
+        #   'nombre_area': [(primera_direccion, ultima_direccion)]
+        # }
+        # Los rangos de lectura de los mapas de esa área nunca incluyen esas direcciones.
+        self.direcciones_no_legibles = {}
+        # Plan de lectura compilado de cada mapa a partir de los tres diccionarios anteriores
+        # (lo genera mapear_variables): diccionario{
+        #   nombre_mapa:diccionario{
+        #       'nombre_area': [_RangoCompilado]
+        #   }
+        # }
+        # con un elemento por cada rango de _rango_direcciones.
+        self._plan_lectura = {None: OrderedDict()}
         self._DIRECCION_MIN = 0
         self._DIRECCION_MAX = 1
         self._NUM_REGISTROS = 2
@@ -581,46 +631,105 @@ class ClientePLC:
         return (direccion_registro, indice_bit)
 
 
-    def _rango_posiciones(self, lista_posiciones: Dict[Union[int, float], TipoDatos]) -> List[Tuple[int, int, int]]:
+    def _rango_posiciones(self, lista_posiciones: Dict[Union[int, float], TipoDatos], area: Optional[str]=None) -> List[Tuple[int, int, int]]:
         ''' Devuelve una lista de tuplas (direccion_minima, direccion_maxima, numero_registros)
         que se necesitan para leer el mapa de variables que se pasa como parámetro.
         Si se devuelve más de una tupla, es porque hay que leer los valores en más de una
-        llamada, por la limitación del dispositivo.
+        llamada, por la limitación del dispositivo o porque sale más barato.
+        Las lecturas se eligen con el mínimo coste estimado: cada una cuesta "segundos_por_peticion"
+        más "segundos_por_registro" por cada registro leído (incluidos los que no tienen variables),
+        no puede pasar de "max_registros_por_lectura" registros ni incluir direcciones de
+        "direcciones_no_legibles" del área.
+        direccion_maxima es la dirección en que comienza el último valor de la lectura.
         @param lista_posiciones: dict {posicion:tipo} de las variables.
+        @param area (str, opcional): nombre del área, para excluir sus direcciones no legibles.
         '''
-        def num_registros_posicion(posicion):
-            return self._bytes_tipo_datos[lista_posiciones[posicion]] // self.bytes_por_registro
+        huecos = self.direcciones_no_legibles.get(area, ())
+        # Registros [inicio, fin) que ocupa cada valor, ordenados por inicio
+        tramos = sorted(
+            (math.trunc(posicion), math.trunc(posicion) + self._bytes_tipo_datos[lista_posiciones[posicion]] // self.bytes_por_registro)
+            for posicion in lista_posiciones
+        )
+        for (inicio, fin) in tramos:
+            if self._incluye_hueco(huecos, inicio, fin):
+                raise PLCError('La dirección {} del área {} no se puede leer (direcciones_no_legibles)'.format(inicio, area))
+
+        # Separar los valores en segmentos: se corta donde hay direcciones no legibles entre dos valores,
+        # o tantos registros sin variables que leerlos cuesta más que una petición adicional. Ninguna
+        # lectura de coste mínimo cruza esos cortes, así que cada segmento se resuelve por separado.
+        segmentos = []
+        fin_segmento = None
+        for tramo in tramos:
+            registros_sin_variables = tramo[0] - fin_segmento if segmentos else 0
+            if not segmentos or (registros_sin_variables > 0 and (
+                    registros_sin_variables * self.segundos_por_registro >= self.segundos_por_peticion
+                    or self._incluye_hueco(huecos, fin_segmento, tramo[0]))):
+                segmentos.append([tramo])
+                fin_segmento = tramo[1]
+            else:
+                segmentos[-1].append(tramo)
+                fin_segmento = max(fin_segmento, tramo[1])
+
+        resultado = []
+        for segmento in segmentos:
+            # Si todo el segmento cabe en una lectura, leerlo de una vez es lo más barato
+            # (juntar dos lecturas contiguas siempre ahorra una petición a cambio de menos registros)
+            if max(tramo[1] for tramo in segmento) - segmento[0][0] <= self.max_registros_por_lectura:
+                resultado.append(self._rango_tramos(segmento))
+            else:
+                resultado.extend(self._rango_tramos(grupo) for grupo in self._agrupar_tramos(segmento))
+        log.log(DEBUG_CLIENTE_PLC, '   _rango_posiciones(%s): %s', area, resultado)
+        return resultado
 
-        def _min_max_num(minimo, maximo):
-            # Por si las direcciones son de bit, truncamos:
-            direccion_min = math.trunc(minimo)
-            direccion_max = math.trunc(maximo)
-            # Hay que contar con el número de registros que conforman el último valor
-            return(direccion_min, direccion_max, direccion_max - direccion_min + num_registros_posicion(maximo))
+    @staticmethod
+    def _incluye_hueco(huecos: List[Tuple[int, int]], inicio: int, fin: int) -> bool:
+        ''' Devuelve True si alguno de los "huecos" (primera, ultima) de direcciones no legibles
+        se solapa con los registros [inicio, fin).
+        '''
+        return any(primera < fin and ultima >= inicio for (primera, ultima) in huecos)
 
-        # Para leer en una sola llamada todos los valores, calculamos el número de registros
-        # que hay entre la direcciones más baja a leer y la más alta
-        direcciones = sorted(lista_posiciones.keys())
-        direccion_min = direcciones[0]
-        direccion_max = direcciones[-1]
-        (registro_min, registro_max, num_registros) = _min_max_num(direccion_min, direccion_max)
-        log.log(DEBUG_CLIENTE_PLC, '   _rango_posiciones: (%s,%s,%s)', registro_min, registro_max, num_registros)
-        if num_registros > self.max_registros_por_lectura:
-            indice_corte = ultimo_corte = 0
-            resultado = []
-            while indice_corte < len(direcciones):
-                # Contar con el número de registros que conforman la posición de corte.
-                if math.trunc(direcciones[indice_corte]) + num_registros_posicion(direcciones[indice_corte]) \
-                        > math.trunc(direcciones[ultimo_corte]) + self.max_registros_por_lectura:
-                    resultado.append(_min_max_num(direcciones[ultimo_corte], direcciones[indice_corte - 1]))
-                    ultimo_corte = indice_corte
-                indice_corte += 1
-            if indice_corte > ultimo_corte:
-                resultado.append(_min_max_num(direcciones[ultimo_corte], direcciones[indice_corte - 1]))
-            log.log(DEBUG_CLIENTE_PLC, resultado)
-            return resultado
-        else:
-            return [(registro_min, registro_max, num_registros)]
+    @staticmethod
+    def _rango_tramos(tramos: List[Tuple[int, int]]) -> Tuple[int, int, int]:
+        ''' Tupla (direccion_minima, direccion_maxima, numero_registros) de la lectura que cubre
+        los tramos [inicio, fin) de registros indicados, ordenados por inicio.
+        '''
+        return (tramos[0][0], tramos[-1][0], max(tramo[1] for tramo in tramos) - tramos[0][0])
+
+    def _agrupar_tramos(self, tramos: List[Tuple[int, int]]) -> List[List[Tuple[int, int]]]:
+        ''' Reparte los tramos [inicio, fin) de registros (ordenados por inicio) en grupos
+        consecutivos, uno por lectura, con el mínimo coste total y sin pasar de
+        max_registros_por_lectura registros en cada lectura (programación dinámica).
+        Genera PLCError si algún valor ocupa más de max_registros_por_lectura registros.
+        '''
+        num_tramos = len(tramos)
+        # coste[j]: coste mínimo de leer los j primeros tramos;
+        # corte[j]: posición (desde 1) del primer tramo de la última lectura de esa solución
+        coste = [0.0] + [math.inf] * num_tramos
+        corte = [0] * (num_tramos + 1)
+        for j in range(1, num_tramos + 1):
+            fin = tramos[j - 1][1]
+            for i in range(j, 0, -1):
+                fin = max(fin, tramos[i - 1][1])
+                num_registros = fin - tramos[i - 1][0]
+                # Empezar la lectura en un tramo anterior solo puede alargarla
+                if num_registros > self.max_registros_por_lectura:
+                    break
+                coste_lectura = coste[i - 1] + self.segundos_por_peticion + self.segundos_por_registro * num_registros
+                if coste_lectura < coste[j]:
+                    coste[j] = coste_lectura
+                    corte[j] = i
+        # Sin solución solo si algún valor no cabe por sí solo en una lectura
+        if math.isinf(coste[num_tramos]):
+            inicio, fin = next(tramo for tramo in tramos if tramo[1] - tramo[0] > self.max_registros_por_lectura)
+            raise PLCError('El valor de la dirección {} ocupa {} registros y no se puede leer: cada lectura es de '
+                           'como mucho {} registros (max_registros_por_lectura)'.format(inicio, fin - inicio, self.max_registros_por_lectura))
+        grupos = []
+        j = num_tramos
+        while j > 0:
+            grupos.append(tramos[corte[j] - 1:j])
+            j = corte[j] - 1
+        grupos.reverse()
+        return grupos
 
     @staticmethod
     def separar_direccion(direccion):
@@ -724,7 +833,7 @@ class ClientePLC:
         # Calcular el rango de direcciones de cada área, para almacenar el comienzo y número de registros
         # que se necesitan leer en cada una
         for area in mapa_direcciones:
-            rango_direcciones[area] = self._rango_posiciones(mapa_direcciones[area])
+            rango_direcciones[area] = self._rango_posiciones(mapa_direcciones[area], area)
         return (mapa_direcciones, mapa_variables, rango_direcciones)
 
     def mapear_variables(self, variables: Dict[str, str], nombre_mapa: Optional[str]=None) -> None:
@@ -748,9 +857,128 @@ class ClientePLC:
             self._mapa_direcciones[nombre_mapa].update(mapa_direcciones)
             self._mapa_variables[nombre_mapa].update(mapa_variables)
             self._rango_direcciones[nombre_mapa].update(rango_direcciones)
+        # Compilar el plan de lectura del mapa completo, para que cada lectura del mapa solo tenga
+        # que leer los rangos y decodificar cada uno con una sola llamada a unpack_from
+        self._plan_lectura[nombre_mapa] = OrderedDict(
+            (area, [
+                self._compilar_rango(rango, self._mapa_direcciones[nombre_mapa][area], self._mapa_variables[nombre_mapa][area])
+                for rango in self._rango_direcciones[nombre_mapa][area]
+            ])
+            for area in self._mapa_direcciones[nombre_mapa]
+        )
         log.log(DEBUG_CLIENTE_PLC, '   _mapa_variables=%s', self._mapa_variables)
         log.log(DEBUG_CLIENTE_PLC, '<- ClientePLC.mapear_variables()')
 
+    def _permutacion_bytes(self, num_bytes: int) -> List[int]:
+        ''' Devuelve el orden en que hay que tomar los bytes de un valor de 4 u 8 bytes tal como
+        lo devuelve el dispositivo para deshacer la inversión de palabras y/o de bytes
+        (invertir_palabras, invertir_bytes); equivale al reordenamiento que hace _bytes_a_valor.
+        '''
+        permutacion = list(range(num_bytes))
+        if self.invertir_palabras:
+            permutacion = [permutacion[(num_bytes // 2 - 1 - indice // 2) * 2 + indice % 2] for indice in range(num_bytes)]
+        if self.invertir_bytes:
+            permutacion = [permutacion[indice ^ 1] for indice in range(num_bytes)]
+        return permutacion
+
+    def _compilar_rango(self, rango: Tuple[int, int, int], lista_posiciones: Dict[Union[int, float], TipoDatos],
+            nombres_variables: Dict[Union[int, float], str]) -> _RangoCompilado:
+        ''' Precalcula la decodificación de uno de los rangos (direccion_min, direccion_max, num_registros)
+        de un área: desplazamiento en bytes y máscara de bit de cada variable del rango, y un único
+        struct.Struct con todos sus valores (con bytes de relleno en los huecos).
+        Los valores de 4 y 8 bytes de dispositivos que invierten palabras o bytes se extraen en bruto
+        y se reordenan con una permutación precalculada antes de convertirlos.
+        @param rango: tupla (direccion_min, direccion_max, num_registros), como en _rango_posiciones
+        @param lista_posiciones: dict {posicion:tipo} de las variables del área
+        @param nombres_variables: dict {posicion:nombre} de las variables del área
+        '''
+        # El formato nativo '@' alinea los valores añadiendo relleno; '=' usa el mismo orden sin alinear
+        orden = '=' if self.orden_bytes == '@' else self.orden_bytes
+        # (desplazamiento, tipo) -> variables que se obtienen de ese valor
+        # (varios booleanos del mismo registro comparten el valor y se distinguen por la máscara)
+        variables_campo = {}
+        for posicion in lista_posiciones:
+            tipo = lista_posiciones[posicion]
+            if tipo == TipoDatos.booleano:
+                (direccion_registro, indice_bit) = self._separar_direccion_bit(posicion)
+                mascara = 1 << indice_bit
+            else:
+                direccion_registro = int(posicion)
+                mascara = None
+            if rango[self._DIRECCION_MIN] <= direccion_registro <= rango[self._DIRECCION_MAX]:
+                desplazamiento = (direccion_registro - rango[self._DIRECCION_MIN]) * self.bytes_por_registro
+                variables_campo.setdefault((desplazamiento, tipo), []).append((posicion, nombres_variables[posicion], mascara))
+
+        formato = orden
+        fin_campo_anterior = 0
+        campos = []
+        campos_sueltos = []
+        for (desplazamiento, tipo) in sorted(variables_campo):
+            caracter_formato = self._cadena_formato_tipo_datos[tipo]
+            num_bytes = struct.calcsize(orden + caracter_formato)
+            conversion = None
+            if num_bytes in (4, 8) and (self.invertir_palabras or self.invertir_bytes):
+                conversion = (itemgetter(*self._permutacion_bytes(num_bytes)), struct.Struct(orden + caracter_formato))
+                caracter_formato = '{}s'.format(num_bytes)
+            campo = (desplazamiento, struct.Struct(orden + caracter_formato), conversion, variables_campo[(desplazamiento, tipo)])
+            if desplazamiento < fin_campo_anterior:
+                campos_sueltos.append(campo)
+                continue
+            if desplazamiento > fin_campo_anterior:
+                formato += '{}x'.format(desplazamiento - fin_campo_anterior)
+            formato += caracter_formato
+            fin_campo_anterior = desplazamiento + num_bytes
+            campos.append(campo)
+        log.log(DEBUG_CLIENTE_PLC, '   _compilar_rango(%s): formato=%s, %s campos sueltos', rango, formato, len(campos_sueltos))
+        return _RangoCompilado(rango, struct.Struct(formato), campos, campos_sueltos)
+
+    def _decodificar_rango(self, rango: _RangoCompilado, registros: bytes) -> List[Tuple[Union[int, float], str, Any]]:
+        ''' Decodifica los registros leídos de un rango compilado con _compilar_rango.
+        Si la respuesta es más corta que el rango, se decodifica campo a campo y los valores
+        incompletos se devuelven como None (igual que _bytes_a_valor).
+        @return: lista de tuplas (posicion, nombre_variable, valor)
+        '''
+        try:
+            valores = list(zip(rango.formato.unpack_from(registros), rango.campos))
+            campos_sueltos = rango.campos_sueltos
+        except struct.error:
+            valores = []
+            campos_sueltos = rango.campos + rango.campos_sueltos
+        for campo in campos_sueltos:
+            try:
+                valores.append((campo[1].unpack_from(registros, campo[0])[0], campo))
+            except struct.error:
+                valores.append((None, campo))
+        resultado = []
+        for (valor, (_, _, conversion, variables)) in valores:
+            if conversion is not None and valor is not None:
+                valor = conversion[1].unpack(bytes(conversion[0](valor)))[0]
+            for (posicion, nombre_variable, mascara) in variables:
+                if mascara is not None and valor is not None:
+                    resultado.append((posicion, nombre_variable, valor & mascara != 0))
+                else:
+                    resultado.append((posicion, nombre_variable, valor))
+        return resultado
+
+    def _leer_plan(self, nombre_mapa: Optional[str]=None, offset: Optional[int]=0):
+        ''' Lee del dispositivo los rangos del plan de lectura del mapa y devuelve (generador)
+        tuplas (area, posicion, nombre_variable, valor) con los valores decodificados.
+        Los rangos de todas las áreas se piden juntos con leer_multiples_areas, para que los
+        dispositivos que lo permiten los lean con el mínimo número de intercambios.
+        '''
+        rangos = [
+            (area, rango)
+            for area in self._plan_lectura[nombre_mapa]
+            for rango in self._plan_lectura[nombre_mapa][area]
+        ]
+        lecturas = [
+            (area, rango.direccion_min + offset * rango.num_registros, rango.num_registros)
+            for (area, rango) in rangos
+        ]
+        for ((area, rango), registros) in zip(rangos, self.leer_multiples_areas(lecturas)):
+            for (posicion, nombre_variable, valor) in self._decodificar_rango(rango, registros):
+                yield (area, posicion, nombre_variable, valor)
+
     def leer_valor(self, direccion: Union[int, float, str], tipo: Optional[TipoDatos]=None) -> Any:
         ''' Lee un valor individual de un cierto tipo en la dirección indicada.
         @param direccion: Dirección del valor en el mapa del PLC. Se puede usar un valor numérico (int o float)
@@ -770,32 +998,125 @@ class ClientePLC:
         return self._bytes_a_valor(respuesta, tipo, indice_bit)
 
 
-    def leer_array_valores(self, direccion: int, tipo: TipoDatos, numero_valores: int) -> List[Any]:
+    def leer_array_valores(self, direccion: int, tipo: TipoDatos, numero_valores: int, como_array: bool=False) -> List[Any]:
         ''' Lee un grupo consecutivo de valores del tipo indicado y a partir de la dirección indicada.
             Es más eficiente que leer varios valores individuales con la función leer_valor;
             la lectura de datos del PLC se hace en una sola llamada, y del resultado se
             extraen los valores solicitados.
         @param direccion: Dirección del primer valor en el mapa del PLC.
         @param tipo: Valor TipoDatos del tipo de los datos a leer
-        @return: lista con los valores leidos, en el tipo indicado.
+        @param como_array (bool, opcional): si True, se devuelve un array numpy en lugar de una
+            lista, decodificado de una vez en lugar de valor a valor. Requiere numpy.
+        @return: lista (o array numpy) con los valores leidos, en el tipo indicado.
         '''
         num_registros = numero_valores * self._bytes_tipo_datos[tipo] // self.bytes_por_registro
         respuesta = self.leer_registros(direccion, num_registros)
+        return self._convertir_array_valores(respuesta, tipo, numero_valores, como_array)
+
+    def _convertir_array_valores(self, registros: bytes, tipo: TipoDatos, numero_valores: int, como_array: bool=False) -> List[Any]:
+        ''' Convierte los registros leídos por leer_array_valores en la lista (o el array numpy,
+        si "como_array" es True) de "numero_valores" valores consecutivos del tipo indicado.
+        '''
+        num_bytes = self._bytes_tipo_datos[tipo]
+        if como_array:
+            if numpy is None:
+                raise PLCError('Para leer los valores como array es necesario el paquete numpy')
+            if len(registros) < numero_valores * num_bytes:
+                raise PLCErrorComunicacion('Se han recibido menos bytes que los solicitados')
+            valores = self._decodificar_numpy(registros, range(0, numero_valores * num_bytes, num_bytes), tipo)
+            # Igual que _bytes_a_valor sin indice_bit: los booleanos se leen del bit 0
+            return valores & 1 != 0 if tipo == TipoDatos.booleano else valores
         array_valores_leidos = []
         for indice in range(numero_valores):
-            indice_byte = indice * self._bytes_tipo_datos[tipo]
-            indice_byte_siguiente = indice_byte + self._bytes_tipo_datos[tipo]
-            array_valores_leidos.append(self._bytes_a_valor(respuesta[indice_byte:indice_byte_siguiente], tipo))
-
+            indice_byte = indice * num_bytes
+            indice_byte_siguiente = indice_byte + num_bytes
+            array_valores_leidos.append(self._bytes_a_valor(registros[indice_byte:indice_byte_siguiente], tipo))
         return array_valores_leidos
 
+    def _decodificar_numpy(self, registros: bytes, desplazamientos, tipo: TipoDatos):
+        ''' Decodifica con numpy, de una vez, los valores del tipo indicado que empiezan en cada uno de
+        los "desplazamientos" (en bytes) de "registros". Los bytes de todos los valores se reúnen en
+        una matriz (un valor por fila) aplicando como índice de columnas la inversión de palabras y/o
+        bytes del dispositivo, y la matriz se interpreta con el dtype del tipo y el orden de bytes
+        del dispositivo.
+        @return: array numpy con un valor por desplazamiento.
+        '''
+        orden = '=' if self.orden_bytes == '@' else self.orden_bytes
+        tipo_numpy = numpy.dtype(orden + self._cadena_formato_tipo_datos[tipo])
+        if tipo_numpy.itemsize in (4, 8) and (self.invertir_palabras or self.invertir_bytes):
+            columnas = self._permutacion_bytes(tipo_numpy.itemsize)
+        else:
+            columnas = list(range(tipo_numpy.itemsize))
+        bytes_registros = numpy.frombuffer(registros, dtype=numpy.uint8)
+        indices = numpy.asarray(desplazamientos, dtype=numpy.intp)[:, None] + numpy.asarray(columnas, dtype=numpy.intp)
+        return numpy.ascontiguousarray(bytes_registros[indices]).view(tipo_numpy).reshape(-1)
+
+    def _agrupar_por_tipo(self, direccion_inicial: int, direccion_final: int, lista_valores: Dict[Union[int, float], TipoDatos], num_bytes_registros: int):
+        ''' Agrupa por tipo de datos las direcciones de "lista_valores" que están entre "direccion_inicial"
+        y "direccion_final", para decodificarlas con _decodificar_numpy.
+        @return: (grupos, incompletas): grupos = {tipo: (direcciones, desplazamientos, indices_bit)};
+            incompletas = direcciones del rango cuyo valor no cabe en los "num_bytes_registros" leídos.
+        '''
+        grupos = {}
+        incompletas = []
+        for direccion in lista_valores:
+            tipo = lista_valores[direccion]
+            if tipo == TipoDatos.booleano:
+                (direccion_registro, indice_bit) = self._separar_direccion_bit(direccion)
+            else:
+                direccion_registro = direccion
+                indice_bit = 0
+            if direccion_inicial <= direccion_registro <= direccion_final:
+                indice_byte = (direccion_registro - direccion_inicial) * self.bytes_por_registro
+                if indice_byte + self._bytes_tipo_datos[tipo] > num_bytes_registros:
+                    incompletas.append(direccion)
+                    continue
+                grupo = grupos.setdefault(tipo, ([], [], []))
+                grupo[0].append(direccion)
+                grupo[1].append(indice_byte)
+                grupo[2].append(indice_bit)
+        return (grupos, incompletas)
+
+    def _decodificar_grupos(self, registros: bytes, grupos: Dict[TipoDatos, Tuple[list, list, list]]):
+        ''' Decodifica con _decodificar_numpy cada grupo devuelto por _agrupar_por_tipo, aplicando a los
+        booleanos la máscara de su bit. Devuelve (generador) tuplas (tipo, direcciones, valores).
+        '''
+        for tipo, (direcciones, desplazamientos, indices_bit) in grupos.items():
+            valores = self._decodificar_numpy(registros, desplazamientos, tipo)
+            if tipo == TipoDatos.booleano:
+                valores = valores & numpy.asarray([1 << indice_bit for indice_bit in indices_bit], dtype=valores.dtype) != 0
+            yield (tipo, direcciones, valores)
+
+    def _convertir_registros_a_columnas(self, registros: bytes, direccion_inicial: int, direccion_final: int, lista_valores: Dict[Union[int, float], TipoDatos]) -> Dict[TipoDatos, Tuple[Any, Any]]:
+        ''' Como _convertir_registros_a_valores, pero decodifica con numpy todos los valores de cada
+        tipo a la vez y devuelve un diccionario de columnas {tipo: (direcciones, valores)}, con dos
+        arrays numpy del mismo tamaño. Los valores que no caben en "registros" no se incluyen.
+        '''
+        (grupos, _) = self._agrupar_por_tipo(direccion_inicial, direccion_final, lista_valores, len(registros))
+        return {
+            tipo: (numpy.asarray(direcciones), valores)
+            for (tipo, direcciones, valores) in self._decodificar_grupos(registros, grupos)
+        }
+
     def _convertir_registros_a_valores(self, registros: bytes, direccion_inicial: int, direccion_final: int, lista_valores: Dict[Union[int, float], TipoDatos]) -> Dict[int, Any]:
         ''' Convierte un array de bytes en un diccionario {direccion: valor}, tomando las
         direcciones y los tipos de los valores de "lista_valores". "direccion_inicial" y
         "direccion_final" son las direcciones reales del primer y último byte del array.
+        Con numpy instalado y al menos MIN_VALORES_NUMPY valores, los valores se decodifican
+        por columnas (_convertir_registros_a_columnas) en lugar de uno a uno.
         '''
         log.log(DEBUG_CLIENTE_PLC, '-> _convertir_registros_a_valores(registros=%s, direccion_inicial=%s, direccion_final=%s, lista_valores=%s)', registros, direccion_inicial, direccion_final, lista_valores)
         lista_valores_leidos = {}
+        # El tipo byte se decodifica como bytes ("c"), que numpy no trata igual que struct: se deja en el camino valor a valor
+        if numpy is not None and len(lista_valores) >= MIN_VALORES_NUMPY and TipoDatos.byte not in lista_valores.values():
+            (grupos, incompletas) = self._agrupar_por_tipo(direccion_inicial, direccion_final, lista_valores, len(registros))
+            for (_, direcciones, valores) in self._decodificar_grupos(registros, grupos):
+                # tolist() devuelve tipos Python (int, float, bool), igual que struct.unpack
+                lista_valores_leidos.update(zip(direcciones, valores.tolist()))
+            # Igual que _bytes_a_valor, los valores que no se han recibido completos valen None
+            lista_valores_leidos.update((direccion, None) for direccion in incompletas)
+            log.log(DEBUG_CLIENTE_PLC, '<- _convertir_registros_a_valores: %s', lista_valores_leidos)
+            return lista_valores_leidos
         for direccion in lista_valores:
             tipo = lista_valores[direccion]
             if tipo == TipoDatos.booleano:
@@ -810,25 +1131,48 @@ class ClientePLC:
         log.log(DEBUG_CLIENTE_PLC, '<- _convertir_registros_a_valores: %s', lista_valores_leidos)
         return lista_valores_leidos
 
-    def leer_lista_valores(self, lista_valores: Dict[Union[int, float], TipoDatos]) -> Dict[int, Any]:
+    def _unir_columnas(self, columnas_rangos: List[Dict[TipoDatos, Tuple[Any, Any]]]) -> Dict[TipoDatos, Tuple[Any, Any]]:
+        ''' Une en un solo diccionario de columnas {tipo: (direcciones, valores)} las columnas
+        decodificadas de cada rango leído.
+        '''
+        por_tipo = {}
+        for columnas in columnas_rangos:
+            for tipo, columna in columnas.items():
+                por_tipo.setdefault(tipo, []).append(columna)
+        return {
+            tipo: (numpy.concatenate([columna[0] for columna in lista]), numpy.concatenate([columna[1] for columna in lista]))
+            for tipo, lista in por_tipo.items()
+        }
+
+    def leer_lista_valores(self, lista_valores: Dict[Union[int, float], TipoDatos], como_columnas: bool=False) -> Dict[int, Any]:
         ''' Lee una lista de valores, cada uno del tipo indicado y en la dirección indicada.
             Es más eficiente que leer varios valores individuales con la función leer_valor;
             la lectura de datos del PLC se hace en el mínimo de llamadas posible, y del resultado
             se extraen los valores solicitados.
         @param lista_valores: diccionario direccion:TipoDatos que describen las direcciones a
             leer y el tipo de dato de cada dirección.
+        @param como_columnas (bool, opcional): si True, se devuelve un diccionario de columnas
+            {tipo: (direcciones, valores)}, con dos arrays numpy por tipo de datos. Requiere numpy.
         @return: diccionario direccion:valor con los valores leídos.
         '''
         log.log(DEBUG_CLIENTE_PLC, '   leer_lista_valores(%s)', lista_valores)
+        if como_columnas and numpy is None:
+            raise PLCError('Para leer los valores por columnas es necesario el paquete numpy')
         # Para leer en una sola llamada todos los valores, calculamos el o los rangos de registros
         # que hay entre la direcciones más baja a leer y la más alta (si el dispositivo tiene un
         # límite en el número de registros consecutivos que se puede leer, _rango_posiciones
         # devolverá todos los rangos que hay que leer por separado).
         rangos = self._rango_posiciones(lista_valores)
         respuesta = {}
+        columnas_rangos = []
         for rango in rangos:
             registros = self.leer_registros(direccion=rango[self._DIRECCION_MIN], num_registros=rango[self._NUM_REGISTROS])
-            respuesta.update(self._convertir_registros_a_valores(registros, rango[self._DIRECCION_MIN], rango[self._DIRECCION_MAX], lista_valores))
+            if como_columnas:
+                columnas_rangos.append(self._convertir_registros_a_columnas(registros, rango[self._DIRECCION_MIN], rango[self._DIRECCION_MAX], lista_valores))
+            else:
+                respuesta.update(self._convertir_registros_a_valores(registros, rango[self._DIRECCION_MIN], rango[self._DIRECCION_MAX], lista_valores))
+        if como_columnas:
+            return self._unir_columnas(columnas_rangos)
         log.log(DEBUG_CLIENTE_PLC, '   %s', respuesta)
         return respuesta
 
@@ -844,22 +1188,9 @@ class ClientePLC:
         @return: diccionario {'area': diccionario {direccion: valor}}
         '''
         log.log(DEBUG_CLIENTE_PLC, '-> leer_mapa_direcciones(%s)', nombre_mapa)
-        respuesta = {}
-        for area in self._mapa_direcciones[nombre_mapa]:
-            respuesta[area] = {}
-            for rango in self._rango_direcciones[nombre_mapa][area]:
-                log.log(DEBUG_CLIENTE_PLC, '   area=%s, _rango_direcciones[area]=%s', area, rango)
-                registros = self.leer_area(
-                    area,
-                    direccion=rango[self._DIRECCION_MIN] + offset * rango[self._NUM_REGISTROS],
-                    num_registros=rango[self._NUM_REGISTROS]
-                )
-                respuesta[area].update(
-                    self._convertir_registros_a_valores(
-                        registros, rango[self._DIRECCION_MIN], rango[self._DIRECCION_MAX],
-                        self._mapa_direcciones[nombre_mapa][area]
-                    )
-                )
+        respuesta = {area: {} for area in self._plan_lectura[nombre_mapa]}
+        for (area, posicion, _, valor) in self._leer_plan(nombre_mapa, offset):
+            respuesta[area][posicion] = valor
         log.log(DEBUG_CLIENTE_PLC, '<- leer_mapa_direcciones()')
         return respuesta
 
@@ -877,13 +1208,12 @@ class ClientePLC:
         @return: diccionario {nombre_variable: valor}
         '''
         log.log(DEBUG_CLIENTE_PLC, '-> leer_mapa_variables(%s)', nombre_mapa)
-        respuesta = {}
-        valores = self.leer_mapa_direcciones(nombre_mapa, offset)
-        for area in valores:
-            respuesta.update(
-                {self._mapa_variables[nombre_mapa][area][posicion]:valores[area][posicion]
-                for posicion in self._mapa_variables[nombre_mapa][area]}
-            )
+        # El plan de lectura ya lleva el nombre de cada variable: no hace falta pasar por
+        # el diccionario {area: {direccion: valor}} de leer_mapa_direcciones
+        respuesta = {
+            nombre_variable: valor
+            for (_, _, nombre_variable, valor) in self._leer_plan(nombre_mapa, offset)
+        }
         log.log(DEBUG_CLIENTE_PLC, '<- leer_mapa_variables()')
         return respuesta
 
@@ -971,6 +1301,16 @@ class ClientePLC:
         # Redefinir en clases derivadas; cada tipo de PLC usa un método distinto
         raise NotImplementedError()
 
+    def leer_multiples_areas(self, lecturas: List[Tuple[str, int, int]]) -> List[bytes]:
+        ''' Lee varias zonas, de la misma o de distintas áreas del PLC.
+        Las clases derivadas que pueden hacerlo la redefinen para leerlas con menos
+        intercambios con el dispositivo; por defecto se lee cada zona con leer_area.
+        @param lecturas: lista de tuplas (area, direccion, num_registros), con el mismo formato
+            que los parámetros de leer_area.
+        @return: lista con el byte array leído de cada zona, en el mismo orden que "lecturas".
+        '''
+        return [self.leer_area(*lectura) for lectura in lecturas]
+
     def escribir_registros(self, valores: bytes, direccion: int, num_registros: int=1):
         ''' Escribe en el PLC los valores en los registros a partir del indicado.
         @param valores: byte array con los valores a escribir. La longitud de valores
@@ -1100,6 +1440,21 @@ class ParametroS7(IntEnum):
 #     0x00008000: 'evcReserved_00008000',
 # }
 
+class _ElementoDatosS7(ctypes.Structure):
+    ''' Estructura TS7DataItem de snap7: cada uno de los elementos (área, DB, dirección, cantidad
+    y buffer de datos) de las funciones Cli_ReadMultiVars y Cli_WriteMultiVars. "Result" lo
+    rellena la librería con el código de error de cada elemento.
+    '''
+    _fields_ = [
+        ('Area', ctypes.c_int),
+        ('WordLen', ctypes.c_int),
+        ('Result', ctypes.c_int),
+        ('DBNumber', ctypes.c_int),
+        ('Start', ctypes.c_int),
+        ('Amount', ctypes.c_int),
+        ('pdata', ctypes.c_void_p),
+    ]
+
 class ClientePLCSiemens(ClientePLC):
     ''' Objeto cliente para comunicación con PLCs de Siemens serie 7.
         Internamente se usan funciones de la librería Snap7, que debe estar
@@ -1202,6 +1557,19 @@ class ClientePLCSiemens(ClientePLC):
     # que definimos una variable de clase.
     __snap7dll = None
 
+    # Máximo número de elementos en una llamada a Cli_ReadMultiVars o Cli_WriteMultiVars
+    # (MaxVars en snap7)
+    MAX_ELEMENTOS_MULTIPLES = 20
+    # Longitud de PDU más pequeña que negocian los PLC S7 (S7-300); los 1200/1500 usan 480 o 960
+    LONGITUD_PDU_MINIMA = 240
+    # Tamaños (en bytes) con los que se comprueba si una lectura o escritura múltiple cabe en
+    # la PDU negociada con el PLC: cabecera S7 de la petición o respuesta (incluidos código de
+    # función y número de elementos), cada elemento en la petición, y cabecera de los datos de
+    # cada elemento (los datos de cada elemento ocupan además un número par de bytes)
+    __bytes_cabecera_multiples = 14
+    __bytes_elemento_peticion = 12
+    __bytes_cabecera_datos = 4
+
 
     def __init__(self, ip: Optional[str]=None, puerto: Optional[int]=None, rack: Optional[int]=None, slot: Optional[int]=None):
         ''' Constructor. Crea el objeto para comunicar con el PLC, pero no
@@ -1229,6 +1597,16 @@ class ClientePLCSiemens(ClientePLC):
         self.numero_db = None
         self.rack = rack
         self.slot = slot
+        # Los rangos de lectura de los mapas y de leer_lista_valores se leen agrupados con
+        # Cli_ReadMultiVars (ver leer_multiples_areas), varios en cada intercambio con el PLC.
+        # Cada rango se limita a lo que cabe como elemento en la PDU más pequeña (S7-300) y su
+        # coste fijo es solo lo que ocupa ese elemento en la petición y la respuesta. Cada
+        # intercambio tarda como mínimo pausa_entre_accesos, que se reparte entre los bytes de la PDU.
+        self.max_registros_por_lectura = ClientePLCSiemens.LONGITUD_PDU_MINIMA \
+            - ClientePLCSiemens.__bytes_cabecera_multiples - ClientePLCSiemens.__bytes_cabecera_datos
+        self.segundos_por_registro = max(self.segundos_por_peticion, self.pausa_entre_accesos) / ClientePLCSiemens.LONGITUD_PDU_MINIMA
+        self.segundos_por_peticion = (ClientePLCSiemens.__bytes_elemento_peticion + ClientePLCSiemens.__bytes_cabecera_datos) \
+            * self.segundos_por_registro
 
         # Inicialización de la librería Snap7: se hace una sola vez.
         # Si no se encuentra la librería, se genera una excepción.
@@ -1506,6 +1884,25 @@ class ClientePLCSiemens(ClientePLC):
                 self.mutex_acceso.release()
         log.log(DEBUG_CLIENTE_PLC, '<- ClientePLCSiemens.desconectar()')
 
+    def __separar_area(self, area: Union[int, str], id_adicional: Optional[int]=None) -> Tuple[str, int]:
+        ''' Separa el nombre de área que reciben leer_area y escribir_area en el tipo de área
+        ('db', 'mk', ...) y el número del DB (0 si el área no es un DB).
+        '''
+        # Si el área es numérica, se asume que es el DB con número indicado.
+        if isinstance(area, int):
+            return ('db', area)
+        area = area.lower()
+        # Si el área empieza por "db", debe llevar a continuación el número del DB,
+        # o bien debe venir el número del DB en el parámetro id_adicional.
+        if area.startswith('db'):
+            try:
+                return ('db', int(area[2:]))
+            except Exception as e:
+                if id_adicional is None:
+                    raise PLCError('Número del DB no indicado en área ({}) ni en parámetro adicional ({}): {}'.format(area, id_adicional, e))
+                return ('db', id_adicional)
+        return (area, 0)
+
     def leer_area(self, area: Union[int, str], direccion: int, num_registros: int, id_adicional: Optional[int]=None) -> bytes:
         ''' Lee bytes de una de las áreas del PLC, a partir de la dirección indicada.
         @param area: Nombre del área de la que leer. Posibles valores:
@@ -1530,24 +1927,7 @@ class ClientePLCSiemens(ClientePLC):
         '''
         log.log(DEBUG_CLIENTE_PLC, '-> ClientePLCSiemens.leer_area(%s,%s,%s,%s)', area, direccion, num_registros, id_adicional)
 
-        # Si el área es numérica, se asume que es el DB con número indicado.
-        if isinstance(area, int):
-            numero_db = area
-            area = 'db'
-        else:
-            area = area.lower()
-            # Si el área empieza por "db", debe llevar a continuación el número del DB,
-            # o bien debe venir el número del DB en el parámetro id_adicional.
-            if area.startswith('db'):
-                try:
-                    numero_db = int(area[2:])
-                    area = 'db'
-                except Exception as e:
-                    if id_adicional is None:
-                        raise PLCError('Número del DB no indicado en área ({}) ni en parámetro adicional ({}): {}'.format(area, id_adicional, e))
-                    numero_db = id_adicional
-            else:
-                numero_db = 0
+        (area, numero_db) = self.__separar_area(area, id_adicional)
 
         # Creamos un buffer para almacenar los bytes necesarios
         tipo_datos_area = ClientePLCSiemens.__tipo_datos_area[area]
@@ -1678,14 +2058,16 @@ class ClientePLCSiemens(ClientePLC):
 
 
     def leer_array_valores(self, direccion: int, tipo: TipoDatos, numero_valores: int,
-            numero_db: Optional[int]=None) -> List[Any]:
+            numero_db: Optional[int]=None, como_array: bool=False) -> List[Any]:
         ''' Lee un grupo consecutivo de valores del tipo indicado y a partir de la dirección
             indicada. Es más eficiente que leer varios valores individuales con la función
             leer_valor; la lectura de datos del PLC se hace en una sola llamada, y del resultado
             se extraen los valores solicitados.
         @param direccion: Dirección del primer valor en el mapa del PLC.
         @param tipo: Valor TipoDatos del tipo de los datos a leer
-        @return: lista con los valores leidos, en el tipo indicado.
+        @param como_array (bool, opcional): si True, se devuelve un array numpy (ver
+            ClientePLC.leer_array_valores). Requiere numpy.
+        @return: lista (o array numpy) con los valores leidos, en el tipo indicado.
 
         NOTA: Internamente llama al método "leer_area".
         '''
@@ -1695,21 +2077,13 @@ class ClientePLCSiemens(ClientePLC):
             numero_db = self.numero_db
         else:
             raise PLCError('No se ha especificado el número del DB a leer')
-        ## Copiado de ClientePLC.leer_array_valores
         num_registros = numero_valores * self._bytes_tipo_datos[tipo] // self.bytes_por_registro
         respuesta = self.leer_area('db', direccion, num_registros, numero_db)
-        array_valores_leidos = []
-        for indice in range(numero_valores):
-            indice_byte = indice * self._bytes_tipo_datos[tipo]
-            indice_byte_siguiente = indice_byte + self._bytes_tipo_datos[tipo]
-            array_valores_leidos.append(
-                self._bytes_a_valor(respuesta[indice_byte:indice_byte_siguiente], tipo)
-            )
-        return array_valores_leidos
+        return self._convertir_array_valores(respuesta, tipo, numero_valores, como_array)
 
 
     def leer_lista_valores(self, lista_valores: Dict[Union[int, float], TipoDatos],
-            numero_db: Optional[int]=None) -> Dict[int, Any]:
+            numero_db: Optional[int]=None, como_columnas: bool=False) -> Dict[int, Any]:
         ''' Lee una lista de valores, cada uno del tipo indicado y en la dirección indicada,
             dentro de un DB del PLC.
             Es más eficiente que leer varios valores individuales con la función leer_valor;
@@ -1721,10 +2095,14 @@ class ClientePLCSiemens(ClientePLC):
             indicarlo al menos en la primera lectura que se haga, en esta u otra función
             de lectura de valores del PLC; en lecturas posteriores, si no se especifica,
             se usa el último valor pasado en llamadas anteriores.
+        @param como_columnas (bool, opcional): si True, se devuelve un diccionario de columnas
+            {tipo: (direcciones, valores)} (ver ClientePLC.leer_lista_valores). Requiere numpy.
         @return: diccionario direccion:valor con los valores leídos.
 
-        NOTA: Internamente llama al método "leer_area".
+        NOTA: Internamente llama al método "leer_multiples_areas".
         '''
+        if como_columnas and numpy is None:
+            raise PLCError('Para leer los valores por columnas es necesario el paquete numpy')
         if numero_db:
             self.numero_db = numero_db
         elif self.numero_db is not None:
@@ -1736,15 +2114,24 @@ class ClientePLCSiemens(ClientePLC):
         )
         # Para leer en una sola llamada todos los valores, calculamos el número de registros
         # que hay entre la direcciones más baja a leer y la más alta
-        rangos = self._rango_posiciones(lista_valores)
+        # Los rangos se leen con leer_multiples_areas, agrupados en el mínimo de intercambios con el PLC
+        rangos = self._rango_posiciones(lista_valores, 'db{}'.format(numero_db))
+        lecturas = self.leer_multiples_areas([
+            ('db{}'.format(numero_db), rango[self._DIRECCION_MIN], rango[self._NUM_REGISTROS]) for rango in rangos
+        ])
         respuesta = {}
-        for rango in rangos:
-            registros = self.leer_area(
-                'db', rango[self._DIRECCION_MIN], rango[self._NUM_REGISTROS], numero_db
-            )
-            respuesta.update(self._convertir_registros_a_valores(
-                registros, rango[self._DIRECCION_MIN], rango[self._DIRECCION_MAX], lista_valores)
-            )
+        columnas_rangos = []
+        for (rango, registros) in zip(rangos, lecturas):
+            if como_columnas:
+                columnas_rangos.append(self._convertir_registros_a_columnas(
+                    registros, rango[self._DIRECCION_MIN], rango[self._DIRECCION_MAX], lista_valores)
+                )
+            else:
+                respuesta.update(self._convertir_registros_a_valores(
+                    registros, rango[self._DIRECCION_MIN], rango[self._DIRECCION_MAX], lista_valores)
+                )
+        if como_columnas:
+            return self._unir_columnas(columnas_rangos)
         log.log(DEBUG_CLIENTE_PLC, '   %s', respuesta)
         return respuesta
 
@@ -1768,23 +2155,7 @@ class ClientePLCSiemens(ClientePLC):
         @param id_adicional: número del DB, si se lee del área "db". No hay que indicarlo
             si se especifica el número del DB en el nombre del área.
         '''
-        # Si el área es numérica, se asume que es el DB con número indicado.
-        if isinstance(area, int):
-            numero_db = area
-            area = 'db'
-        else:
-            area = area.lower()
-            # Si el área empieza por "db", debe llevar a continuación el número del DB.
-            if area.startswith('db'):
-                try:
-                    numero_db = int(area[2:])
-                    area = 'db'
-                except Exception as e:
-                    if id_adicional is None:
-                        raise PLCError('Número del DB no indicado en área ({}) ni en parámetro adicional ({}): {}'.format(area, id_adicional, e))
-                    numero_db = id_adicional
-            else:
-                numero_db = 0
+        (area, numero_db) = self.__separar_area(area, id_adicional)
 
         log.log(DEBUG_CLIENTE_PLC, '-> ClientePLCSiemens.escribir_area(%s, %s, %s, %s)',
             area, valores, direccion, num_registros
@@ -1976,6 +2347,180 @@ class ClientePLCSiemens(ClientePLC):
         self.escribir_area(valor_bytes, 'mk', direccion, num_registros=1)
 
 
+    def longitud_pdu(self) -> int:
+        ''' Devuelve la longitud de PDU (en bytes) negociada con el PLC al conectar.
+        Si no está conectado, devuelve 0.
+        '''
+        requerida = ctypes.c_int(0)
+        negociada = ctypes.c_int(0)
+        self.__snap7dll.Cli_GetPduLength.argtypes = [
+            CTYPES_HANDLE, ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_int)
+        ]
+        self.__snap7dll.Cli_GetPduLength.restype = ctypes.c_int
+        codigo_resultado = self.__snap7dll.Cli_GetPduLength(
+            self.__objetoS7, ctypes.byref(requerida), ctypes.byref(negociada)
+        )
+        if codigo_resultado:
+            self.__generar_excepcion(codigo_resultado)
+        return negociada.value
+
+    def __lotes_multiples(self, tamanyos: List[Optional[int]], longitud_pdu: int, escritura: bool) -> Tuple[List[List[int]], List[int]]:
+        ''' Reparte en lotes los elementos de una lectura o escritura múltiple, de forma que cada
+        lote tenga como mucho MAX_ELEMENTOS_MULTIPLES elementos y su petición y su respuesta
+        quepan en la PDU negociada.
+        @param tamanyos: bytes de datos de cada elemento; None si el elemento no se puede
+            incluir en una operación múltiple.
+        @param longitud_pdu: longitud de PDU negociada con el PLC.
+        @param escritura: True si es una escritura (los datos van en la petición) o False si es
+            una lectura (los datos van en la respuesta).
+        @return: (lotes, sueltos): lotes = lista de listas de índices de elementos; sueltos =
+            índices de los elementos que no caben solos en una PDU (hay que leerlos o escribirlos
+            por separado con leer_area o escribir_area, que Snap7 fragmenta).
+        '''
+        lotes = []
+        sueltos = []
+        bytes_peticion = bytes_respuesta = ClientePLCSiemens.__bytes_cabecera_multiples
+        for indice, tamanyo in enumerate(tamanyos):
+            if tamanyo is None:
+                sueltos.append(indice)
+                continue
+            bytes_datos = ClientePLCSiemens.__bytes_cabecera_datos + tamanyo + tamanyo % 2
+            if escritura:
+                # En la respuesta de una escritura, solo va el código de resultado de cada elemento
+                peticion_elemento = ClientePLCSiemens.__bytes_elemento_peticion + bytes_datos
+                respuesta_elemento = 1
+            else:
+                peticion_elemento = ClientePLCSiemens.__bytes_elemento_peticion
+                respuesta_elemento = bytes_datos
+            if ClientePLCSiemens.__bytes_cabecera_multiples + max(peticion_elemento, respuesta_elemento) > longitud_pdu:
+                sueltos.append(indice)
+                continue
+            if not lotes or len(lotes[-1]) >= ClientePLCSiemens.MAX_ELEMENTOS_MULTIPLES \
+                    or bytes_peticion + peticion_elemento > longitud_pdu \
+                    or bytes_respuesta + respuesta_elemento > longitud_pdu:
+                lotes.append([])
+                bytes_peticion = bytes_respuesta = ClientePLCSiemens.__bytes_cabecera_multiples
+            lotes[-1].append(indice)
+            bytes_peticion += peticion_elemento
+            bytes_respuesta += respuesta_elemento
+        return (lotes, sueltos)
+
+    def __elementos_multiples(self, zonas: List[Tuple[Union[int, str], int, int]]) -> Tuple[list, List[Optional[int]]]:
+        ''' Prepara las zonas (area, direccion, num_registros) de una lectura o escritura múltiple.
+        @return: (elementos, tamanyos): elementos = tuplas (codigo_area, numero_db, direccion,
+            num_registros, tipo_datos_area) para _ElementoDatosS7; tamanyos = bytes de cada zona,
+            o None si no se puede incluir en una operación múltiple.
+        '''
+        elementos = []
+        tamanyos = []
+        for (area, direccion, num_registros) in zonas:
+            (area, numero_db) = self.__separar_area(area)
+            tipo_datos_area = ClientePLCSiemens.__tipo_datos_area[area]
+            elementos.append((ClientePLCSiemens.__nombre_area[area], numero_db, direccion, num_registros, tipo_datos_area))
+            # En las operaciones múltiples, los bits se leen o escriben de uno en uno
+            if tipo_datos_area == ClientePLCSiemens.__TipoDatoS7.Bit and num_registros != 1:
+                tamanyos.append(None)
+            else:
+                tamanyos.append(ClientePLCSiemens.__longitud_tipo_s7[tipo_datos_area] * num_registros)
+        return (elementos, tamanyos)
+
+    def __llamar_multiples(self, nombre_funcion: str, elementos: ctypes.Array) -> None:
+        ''' Llama a la función Cli_ReadMultiVars o Cli_WriteMultiVars ("nombre_funcion") de Snap7
+        con el array de _ElementoDatosS7 indicado, y genera la excepción que corresponda si falla
+        la llamada o alguno de los elementos.
+        '''
+        funcion = getattr(self.__snap7dll, nombre_funcion)
+        mensaje_resultado = None
+        try:
+            if THREADSAFE:
+                if not self.mutex_acceso.acquire(timeout=self.timeout_acceso):
+                    raise Exception('No se ha conseguido acceso exclusivo para {}'.format(nombre_funcion))
+            try:
+                funcion.argtypes = [CTYPES_HANDLE, ctypes.POINTER(_ElementoDatosS7), ctypes.c_int]
+                funcion.restype = ctypes.c_int
+                log.log(DEBUG_CLIENTE_PLC, '   %s(__objetoS7, %s elementos)', nombre_funcion, len(elementos))
+                hora_comienzo_lecturas = time.perf_counter()
+                codigo_resultado = funcion(self.__objetoS7, elementos, len(elementos))
+                tiempo_lectura = (time.perf_counter() - hora_comienzo_lecturas)
+                log.log(DEBUG_CLIENTE_PLC, '  -> codigo_resultado=%s; tiempo_lectura=%s', codigo_resultado, tiempo_lectura)
+                pausa_restante = self.pausa_entre_accesos - tiempo_lectura
+                if pausa_restante > 0:
+                    time.sleep(pausa_restante)
+            finally:
+                if THREADSAFE:
+                    self.mutex_acceso.release()
+        except Exception as e:
+            codigo_resultado = 0
+            mensaje_resultado = 'ClientePLCSiemens.{}: {}: {}'.format(nombre_funcion, e.__class__.__name__, e)
+        if codigo_resultado or mensaje_resultado:
+            self.__generar_excepcion(codigo_resultado, mensaje_resultado)
+        # La llamada puede ir bien aunque falle alguno de los elementos (p.ej. un DB que no existe)
+        for elemento in elementos:
+            if elemento.Result:
+                self.__generar_excepcion(elemento.Result)
+
+    def leer_multiples_areas(self, lecturas: List[Tuple[Union[int, str], int, int]]) -> List[bytes]:
+        ''' Lee varias zonas, de la misma o de distintas áreas del PLC, con el mínimo número
+        de intercambios con el PLC: las zonas se agrupan en llamadas a Cli_ReadMultiVars de hasta
+        MAX_ELEMENTOS_MULTIPLES elementos, cuya petición y respuesta caben en la PDU negociada.
+        Las zonas que no caben solas en una PDU se leen por separado con leer_area.
+        @param lecturas: lista de tuplas (area, direccion, num_registros), con el mismo formato
+            que los parámetros de leer_area.
+        @return: lista con el byte array leído de cada zona, en el mismo orden que "lecturas".
+        '''
+        log.log(DEBUG_CLIENTE_PLC, '-> ClientePLCSiemens.leer_multiples_areas(%s)', lecturas)
+        if self.conectar_automaticamente and not self._conectado:
+            self.conectar()
+            time.sleep(self.pausa_entre_accesos)
+        (elementos, tamanyos) = self.__elementos_multiples(lecturas)
+        # Sin conexión no hay PDU negociada: todo se lee con leer_area, que generará el error
+        (lotes, sueltos) = self.__lotes_multiples(tamanyos, self.longitud_pdu() if self._conectado else 0, escritura=False)
+        resultado = [None] * len(lecturas)
+        for lote in lotes:
+            elementos_s7 = (_ElementoDatosS7 * len(lote))()
+            for (elemento_s7, indice) in zip(elementos_s7, lote):
+                (elemento_s7.Area, elemento_s7.DBNumber, elemento_s7.Start, elemento_s7.Amount, elemento_s7.WordLen) = elementos[indice]
+                # Buffer para almacenar los bytes que lee la función
+                resultado[indice] = (ctypes.c_char * tamanyos[indice])()
+                elemento_s7.pdata = ctypes.cast(resultado[indice], ctypes.c_void_p)
+            self.__llamar_multiples('Cli_ReadMultiVars', elementos_s7)
+        for indice in sueltos:
+            resultado[indice] = self.leer_area(*lecturas[indice])
+        log.log(DEBUG_CLIENTE_PLC, '<- ClientePLCSiemens.leer_multiples_areas(): %s lotes, %s sueltos', len(lotes), len(sueltos))
+        return resultado
+
+    def escribir_multiples_areas(self, escrituras: List[Tuple[bytes, Union[int, str], int, int]]) -> None:
+        ''' Escribe varias zonas, de la misma o de distintas áreas del PLC, con el mínimo número
+        de intercambios con el PLC (llamadas a Cli_WriteMultiVars; ver leer_multiples_areas).
+        @param escrituras: lista de tuplas (valores, area, direccion, num_registros), con el mismo
+            formato que los parámetros de escribir_area.
+        '''
+        log.log(DEBUG_CLIENTE_PLC, '-> ClientePLCSiemens.escribir_multiples_areas(%s)', escrituras)
+        (elementos, tamanyos) = self.__elementos_multiples([escritura[1:] for escritura in escrituras])
+        # Los valores deben venir en un array de bytes que se escribirá directamente
+        for ((valores, _, _, num_registros), elemento) in zip(escrituras, elementos):
+            if not isinstance(valores, bytes):
+                raise PLCError('Los valores a escribir deben pasarse en un array de bytes')
+            if len(valores) != ClientePLCSiemens.__longitud_tipo_s7[elemento[4]] * num_registros:
+                raise PLCError('La longitud del array con los datos no se corresponde con el número de registros a escribir')
+        if self.conectar_automaticamente and not self._conectado:
+            self.conectar()
+            time.sleep(self.pausa_entre_accesos)
+        (lotes, sueltos) = self.__lotes_multiples(tamanyos, self.longitud_pdu() if self._conectado else 0, escritura=True)
+        for lote in lotes:
+            elementos_s7 = (_ElementoDatosS7 * len(lote))()
+            # Los buffers deben existir hasta que termine la llamada
+            buffers = []
+            for (elemento_s7, indice) in zip(elementos_s7, lote):
+                (elemento_s7.Area, elemento_s7.DBNumber, elemento_s7.Start, elemento_s7.Amount, elemento_s7.WordLen) = elementos[indice]
+                buffers.append((ctypes.c_char * tamanyos[indice]).from_buffer_copy(escrituras[indice][0]))
+                elemento_s7.pdata = ctypes.cast(buffers[-1], ctypes.c_void_p)
+            self.__llamar_multiples('Cli_WriteMultiVars', elementos_s7)
+        for indice in sueltos:
+            self.escribir_area(*escrituras[indice])
+        log.log(DEBUG_CLIENTE_PLC, '<- ClientePLCSiemens.escribir_multiples_areas(): %s lotes, %s sueltos', len(lotes), len(sueltos))
+
+
 #############################################################################
 
 class ClientePLCModbus(ClientePLC):
@@ -2027,7 +2572,8 @@ class ClientePLCModbus(ClientePLC):
         4: 'Fallo del dispositivo'}
 
     def __init__(self, ip: Optional[str]=None, puerto: Optional[int]=None, direccion_dispositivo: Optional[int]=None,
-            invertir_palabras: Optional[bool]=True, invertir_bytes: Optional[bool]=False) -> None:
+            invertir_palabras: Optional[bool]=True, invertir_bytes: Optional[bool]=False,
+            max_peticiones_en_curso: Optional[int]=1) -> None:
         ''' Constructor. Crea el objeto para comunicar con el dispositivo, pero no
         intenta conectar con él.
         @param ip (str): dirección IPv4 del dispositivo
@@ -2049,6 +2595,10 @@ class ClientePLCModbus(ClientePLC):
             No es frecuente, por lo que por defecto es False.
             Si invertir_palabras e invertir_bytes son ambos True, AB CD se almacena DC BA,
             AB CD EF GH como HG FE DC BA.
+        @param max_peticiones_en_curso (int, opcional): número máximo de peticiones que se
+            envían al dispositivo sin esperar a recibir sus respuestas (ver leer_multiples_areas).
+            El estándar Modbus TCP lo permite, pero muchos dispositivos (y pasarelas a Modbus RTU)
+            solo atienden una petición a la vez, por lo que por defecto es 1.
         '''
         if puerto is None:
             puerto = 502
@@ -2058,7 +2608,10 @@ class ClientePLCModbus(ClientePLC):
         # Los registros ModBus son de 2 bytes
         self.bytes_por_registro = 2
         # Por tanto, hay que redefinir los tamaños de los tipos
-        # que en la clase base son de 1 byte...
+        # que en la clase base son de 1 byte... (en copias propias del objeto:
+        # los diccionarios son de la clase y los comparten los clientes de otros tipos)
+        self._bytes_tipo_datos = dict(self._bytes_tipo_datos)
+        self._cadena_formato_tipo_datos = dict(self._cadena_formato_tipo_datos)
         self._bytes_tipo_datos[TipoDatos.booleano] = 2
         self._bytes_tipo_datos[TipoDatos.byte] = 2
         #... y los caracteres de formato correspondientes
@@ -2083,19 +2636,26 @@ class ClientePLCModbus(ClientePLC):
         # Identificador del esclavo Modbus a leer; por defecto 0
         self.id_esclavo = direccion_dispositivo
 
+        # Peticiones que se pueden enviar seguidas por el socket antes de recibir la primera respuesta
+        self.max_peticiones_en_curso = max_peticiones_en_curso
+        # Identificador de transacción MBAP de la última petición; cada petición usa el siguiente,
+        # y las respuestas se asocian a su petición por este identificador
+        self.__id_transaccion = randint(0, 65535)
+
 
-    def __cabecera_mbap(self, id_esclavo: int, longitud_pdu: int) -> bytes:
+    def __cabecera_mbap(self, id_esclavo: int, longitud_pdu: int) -> Tuple[int, bytes]:
         ''' Devuelve un byte array con la cabecera del mensaje Modbus TCP.
 
         @param id_esclavo (byte): Número de esclavo; 0 = broadcast.
         @param longitud_pdu: Número de bytes del PDU (para calcular longitud total mensaje).
-        @return: Byte array de 7 bytes con la cabecera MBAP.
+        @return: Tupla (id_transaccion, cabecera), con el identificador de transacción usado
+            y el byte array de 7 bytes con la cabecera MBAP.
         '''
-        # Como identificador de transacción, generamos un número entero aleatorio
-        # de 16 bits (2^16 = 65536). Ojo: el número no puede ser 65536, ya serían 17 bit
-        id_transaccion = randint(0, 65535)
+        # El identificador de transacción es un entero de 16 bits que se incrementa en cada
+        # petición. Ojo: el número no puede ser 65536, ya serían 17 bit
+        self.__id_transaccion = (self.__id_transaccion + 1) % 65536
 
-        return struct.pack('>HHHB', id_transaccion, 0, longitud_pdu + 1, id_esclavo)
+        return (self.__id_transaccion, struct.pack('>HHHB', self.__id_transaccion, 0, longitud_pdu + 1, id_esclavo))
 
     def __mensaje_error(self, codigo_error: int) -> str:
         mensaje = 'Error modbus {}'.format(codigo_error)
@@ -2103,6 +2663,80 @@ class ClientePLCModbus(ClientePLC):
             mensaje += ': ' + ClientePLCModbus.__codigos_excepcion[codigo_error]
         return mensaje
 
+    def __recibir_bytes(self, num_bytes: int) -> bytes:
+        ''' Lee del socket exactamente num_bytes bytes. '''
+        datos = bytearray()
+        while len(datos) < num_bytes:
+            recibido = self.__socket.recv(num_bytes - len(datos))
+            if not recibido:
+                raise PLCErrorComunicacion('El dispositivo ha cerrado la conexión')
+            datos += recibido
+        return bytes(datos)
+
+    def __recibir_trama(self) -> Tuple[int, bytes]:
+        ''' Lee del socket una trama Modbus TCP completa, usando la longitud indicada en su
+        cabecera MBAP.
+        @return: Tupla (id_transaccion, trama), con la trama completa incluida la cabecera.
+        '''
+        cabecera = self.__recibir_bytes(7)
+        (id_transaccion, _, longitud, _) = struct.unpack('>HHHB', cabecera)
+        # La longitud incluye el id de esclavo, que ya se ha leído con la cabecera
+        if longitud < 2:
+            raise PLCErrorComunicacion('Trama Modbus no válida: longitud {}'.format(longitud))
+        return (id_transaccion, cabecera + self.__recibir_bytes(longitud - 1))
+
+    def __transacciones(self, peticiones: List[Tuple[int, bytes]]) -> List[bytes]:
+        ''' Envía al dispositivo las peticiones y devuelve sus tramas de respuesta.
+        Se envían sin esperar las respuestas hasta tener "max_peticiones_en_curso" pendientes;
+        cada respuesta se asocia a su petición por el identificador de transacción, y se descartan
+        las que no corresponden a ninguna pendiente (p.ej. la respuesta tardía de una petición
+        que dio timeout). Si hay un error con peticiones pendientes, sus respuestas (o el resto
+        de una trama recibida a medias) podrían llegar después y mezclarse con las de la
+        siguiente llamada, así que se abre una conexión nueva aunque desconectar_si_error_comunicacion
+        sea False. Debe llamarse con el mutex de acceso adquirido.
+        @param peticiones: lista de tuplas (id_transaccion, adu).
+        @return: lista con la trama de respuesta de cada petición, en el mismo orden.
+        '''
+        respuestas = [None] * len(peticiones)
+        # Peticiones enviadas pendientes de respuesta: {id_transaccion: indice en "peticiones"}
+        pendientes = {}
+        siguiente = 0
+        try:
+            while siguiente < len(peticiones) or pendientes:
+                while siguiente < len(peticiones) and len(pendientes) < max(1, self.max_peticiones_en_curso):
+                    (id_transaccion, adu) = peticiones[siguiente]
+                    self.__socket.sendall(adu)
+                    pendientes[id_transaccion] = siguiente
+                    siguiente += 1
+                (id_transaccion, datos) = self.__recibir_trama()
+                log.log(DEBUG_CLIENTE_PLC, '   -> id_transaccion = %s; datos = %s; len = %s', id_transaccion, datos, len(datos))
+                if id_transaccion not in pendientes:
+                    log.warning('ClientePLCModbus: descartada respuesta con id de transacción no esperado (%s)', id_transaccion)
+                    continue
+                respuestas[pendientes.pop(id_transaccion)] = datos
+        except Exception as e:
+            if self.__socket is None:
+                mensaje = 'El dispositivo está desconectado'
+            else:
+                mensaje = str(e)
+            # Interpretamos cualquier error como de comunicación, ya que se
+            # deberá a las llamadas al socket
+            if self.desconectar_si_error_comunicacion:
+                try:
+                    self.desconectar()
+                    time.sleep(self.pausa_entre_accesos)
+                except Exception:
+                    pass
+            elif pendientes and self.__socket is not None:
+                log.warning('ClientePLCModbus: se reabre la conexión tras un error con %s peticiones pendientes', len(pendientes))
+                try:
+                    self.desconectar()
+                    self.conectar()
+                except Exception:
+                    pass
+            raise PLCErrorComunicacion(mensaje)
+        return respuestas
+
 
     def conectar(self, ip: Optional[str]=None, direccion_dispositivo: Optional[int]=None) -> None:
         '''
@@ -2190,6 +2824,70 @@ class ClientePLCModbus(ClientePLC):
                 self.ip, self.puerto, self.id_esclavo
             )
 
+    def __peticion_lectura(self, area: str, direccion: int, num_registros: int, id_adicional: Optional[int]=None) -> Tuple[int, bytes]:
+        ''' Comprueba los parámetros de una lectura (ver leer_area) y construye su petición.
+        @return: Tupla (id_transaccion, adu) con el mensaje Modbus TCP a enviar.
+        '''
+        if None in [direccion, num_registros]:
+            raise PLCErrorModbus(3)
+        if num_registros > 123:
+            raise PLCErrorModbus(3)
+        if area is None:
+            area = 'hr'
+        elif not area[0:2] in ClientePLCModbus.__nombre_area_lectura:
+            raise PLCErrorModbus(3)
+        try:
+            num_dispositivo_area = int(area[2:])
+        except ValueError:
+            num_dispositivo_area = None
+        area = area[0:2]
+        try:
+            if id_adicional is not None:
+                self.id_esclavo = id_adicional
+            pdu = struct.pack(
+                '>BHH', ClientePLCModbus.__nombre_area_lectura[area],
+                direccion, num_registros
+            )
+            ###log.log(DEBUG_CLIENTE_PLC, '   pdu = %s', pdu)
+            (id_transaccion, cabecera) = self.__cabecera_mbap(
+                num_dispositivo_area if num_dispositivo_area else self.id_esclavo,
+                len(pdu)
+            )
+            ###log.log(DEBUG_CLIENTE_PLC, '   adu = %s', cabecera + pdu)
+        except Exception as e:
+            log.error(
+                'ClientePLCModbus.leer_area(%s,%s,%s,%s): %s',
+                area, direccion, num_registros, id_adicional, e
+            )
+            # Si no se puede construir el PDU o el ADU, devolver error en
+            # los datos pasados a la función
+            raise PLCErrorModbus(3, str(e))
+        return (id_transaccion, cabecera + pdu)
+
+    def __datos_lectura(self, adu: bytes, datos: bytes) -> bytes:
+        ''' Comprueba la respuesta "datos" a la petición de lectura "adu" y devuelve los
+        bytes leídos, sin cabecera.
+        '''
+        # Extraemos el código de función devuelto; si no es un código de función Modbus,
+        # es que se ha producido un error. Si es así, generamos una excepción con el
+        # código de error.
+        codigo_funcion = datos[7]
+        if codigo_funcion not in ClientePLCModbus.__numeros_funcion_modbus:
+            codigo_error = datos[8] if len(datos) > 8 else None
+            raise PLCErrorModbus(codigo_error, self.__mensaje_error(codigo_error))
+        # Si no se reciben al menos los bytes solicitados, dar error de comunicación:
+        # 2 bytes por registro, o un bit por registro en las áreas de bits
+        (codigo_peticion, _, num_registros) = struct.unpack('>BHH', adu[7:12])
+        if codigo_peticion in (ClientePLCModbus.READ_COILS, ClientePLCModbus.READ_DISCRETE_INPUTS):
+            bytes_esperados = (num_registros + 7) // 8
+        else:
+            bytes_esperados = num_registros * self.bytes_por_registro
+        # Quitamos cabecera (7 bytes), id funcion (1 byte) y num.registros (1 byte)
+        respuesta = datos[9:]
+        if len(respuesta) < bytes_esperados:
+            raise PLCErrorComunicacion('Se han recibido menos bytes que los solicitados')
+        return respuesta
+
     def leer_area(self, area: str, direccion: int, num_registros: int, id_adicional: Optional[int]=None) -> bytes:
         ''' Lee bytes de una de las áreas del dispositivo, a partir de la
         dirección indicada.
@@ -2225,7 +2923,9 @@ class ClientePLCModbus(ClientePLC):
 
         NOTA: Hay servidores Modbus que dan error si se intenta leer un número
         de registro que no tienen definido; en estos casos, hay que separar la
-        lectura en tramos de registros contiguos que sí sean accesibles.
+        lectura en tramos de registros contiguos que sí sean accesibles. Los mapas
+        de variables lo hacen automáticamente si se indican esos registros en
+        "direcciones_no_legibles" antes de llamar a mapear_variables.
         '''
         ###TODO: No funciona tipo datos booleano, ¿real, entero largo ni real largo?
         log.log(
@@ -2233,85 +2933,47 @@ class ClientePLCModbus(ClientePLC):
             '-> ClientePLCModbus.leer_area(%s,%s,%s,%s)',
             area, direccion, num_registros, id_adicional
         )
-        if None in [direccion, num_registros]:
-            raise PLCErrorModbus(3)
-        if num_registros > 123:
-            raise PLCErrorModbus(3)
-        if area is None:
-            area = 'hr'
-        elif not area[0:2] in ClientePLCModbus.__nombre_area_lectura:
-            raise PLCErrorModbus(3)
-        try:
-            num_dispositivo_area = int(area[2:])
-        except ValueError:
-            num_dispositivo_area = None
-        area = area[0:2]
-
         try:
             if THREADSAFE:
                 self.mutex_acceso.acquire()
             if self.conectar_automaticamente and not self._conectado:
                 self.conectar()
                 time.sleep(self.pausa_entre_accesos)
-            try:
-                if id_adicional is not None:
-                    self.id_esclavo = id_adicional
-                pdu = struct.pack(
-                    '>BHH', ClientePLCModbus.__nombre_area_lectura[area],
-                    direccion, num_registros
-                )
-                ###log.log(DEBUG_CLIENTE_PLC, '   pdu = %s', pdu)
-                adu = self.__cabecera_mbap(
-                    num_dispositivo_area if num_dispositivo_area else self.id_esclavo,
-                    len(pdu)
-                ) + pdu
-                ###log.log(DEBUG_CLIENTE_PLC, '   adu = %s', adu)
-            except Exception as e:
-                log.error(
-                    'ClientePLCModbus.leer_area(%s,%s,%s,%s): %s',
-                    area, direccion, num_registros, id_adicional, e
-                )
-                # Si no se puede construir el PDU o el ADU, devolver error en
-                # los datos pasados a la función
-                raise PLCErrorModbus(3, str(e))
-            try:
-                self.__socket.send(adu)
-                datos = self.__socket.recv(512)
-                log.log(DEBUG_CLIENTE_PLC, '   -> datos = %s; len = %s', datos, len(datos))
-                # Si no se reciben al menos los bytes solicitados, dar error de comunicación
-                if len(datos) < (num_registros - 1) * self.bytes_por_registro + len(adu) - 1:
-                    raise PLCErrorComunicacion('Se han recibido menos bytes que los solicitados')
-            except Exception as e:
-                if self.__socket is None:
-                    mensaje = 'El dispositivo está desconectado'
-                else:
-                    mensaje = str(e)
-                # Interpretamos cualquier error como de comunicación, ya que se
-                # deberá a la llamada a "socket.send"
-                if self.desconectar_si_error_comunicacion:
-                    try:
-                        self.desconectar()
-                        time.sleep(self.pausa_entre_accesos)
-                    except Exception:
-                        pass
-                raise PLCErrorComunicacion(mensaje)
-
-            # Extraemos el código de función devuelto; si no es un código de función Modbus,
-            # es que se ha producido un error. Si es así, generamos una excepción con el
-            # código de error.
-            # El [0] es porque unpack devuelve una tupla, aunque se pida un solo valor
-            codigo_funcion = struct.unpack('>B', datos[7:8])[0]
-            if codigo_funcion not in ClientePLCModbus.__numeros_funcion_modbus:
-                codigo_error = struct.unpack('>B', datos[8:9])[0]
-                raise PLCErrorModbus(self.__mensaje_error(codigo_error))
-            # Quitamos cabecera (7 bytes), id funcion (1 byte) y num.registros (1 byte)
-            respuesta = datos[9:]
+            peticion = self.__peticion_lectura(area, direccion, num_registros, id_adicional)
+            respuesta = self.__datos_lectura(peticion[1], self.__transacciones([peticion])[0])
             log.log(DEBUG_CLIENTE_PLC, '   %s', respuesta)
             return respuesta
         finally:
             if THREADSAFE:
                 self.mutex_acceso.release()
 
+    def leer_multiples_areas(self, lecturas: List[Tuple[str, int, int]]) -> List[bytes]:
+        ''' Lee varias zonas, de la misma o de distintas áreas (o esclavos) del dispositivo.
+        Las peticiones se envían seguidas por la misma conexión, con hasta "max_peticiones_en_curso"
+        pendientes de respuesta a la vez: si el dispositivo las admite, leer todas las zonas tarda
+        aproximadamente un intercambio en lugar de uno por zona. Con max_peticiones_en_curso = 1
+        equivale a llamar a leer_area para cada zona.
+        @param lecturas: lista de tuplas (area, direccion, num_registros), con el mismo formato
+            que los parámetros de leer_area.
+        @return: lista con el byte array leído de cada zona, en el mismo orden que "lecturas".
+        '''
+        log.log(DEBUG_CLIENTE_PLC, '-> ClientePLCModbus.leer_multiples_areas(%s)', lecturas)
+        try:
+            if THREADSAFE:
+                self.mutex_acceso.acquire()
+            if self.conectar_automaticamente and not self._conectado:
+                self.conectar()
+                time.sleep(self.pausa_entre_accesos)
+            # Se comprueban todas las peticiones antes de enviar ninguna
+            peticiones = [self.__peticion_lectura(*lectura) for lectura in lecturas]
+            return [
+                self.__datos_lectura(adu, datos)
+                for ((_, adu), datos) in zip(peticiones, self.__transacciones(peticiones))
+            ]
+        finally:
+            if THREADSAFE:
+                self.mutex_acceso.release()
+
 
     def leer_registros(self, direccion: int, num_registros: int, id_adicional: Optional[int]=None) -> bytes:
         ''' Función Modbus 3: Read holding registers.
@@ -2365,34 +3027,15 @@ class ClientePLCModbus(ClientePLC):
             )
             for valor in valores:
                 pdu += struct.pack('>B' if valor >= 0 else '>b', valor)
-            adu = self.__cabecera_mbap(self.id_esclavo, len(pdu)) + pdu
-
-            try:
-                bytes_enviados = self.__socket.send(adu)
-                if bytes_enviados < len(adu):
-                    raise Exception('No se han enviado todos los bytes al dispositivo')
-                datos = self.__socket.recv(1024)
-            except Exception as e:
-                if self.__socket is None:
-                    mensaje = 'El dispositivo está desconectado'
-                else:
-                    mensaje = str(e)
-                # Interpretamos cualquier error como de comunicación, ya que se
-                # deberá a la llamada a "socket.send"
-                if self.desconectar_si_error_comunicacion:
-                    try:
-                        self.desconectar()
-                        time.sleep(self.pausa_entre_accesos)
-                    except Exception:
-                        pass
-                raise PLCErrorComunicacion(mensaje)
+            (id_transaccion, cabecera) = self.__cabecera_mbap(self.id_esclavo, len(pdu))
+            datos = self.__transacciones([(id_transaccion, cabecera + pdu)])[0]
             # Extraemos el código de la función, para comprobar si se ha devuelto un error.
             # Si es así, generamos una excepción con el código de error.
             # El [0] es porque unpack devuelve una tupla, aunque se pida un solo valor
             codigo_funcion = struct.unpack('>B', datos[7:8])[0]
             if codigo_funcion not in ClientePLCModbus.__numeros_funcion_modbus:
                 codigo_error = struct.unpack('>B', datos[8:9])[0]
-                raise PLCErrorModbus(self.__mensaje_error(codigo_error))
+                raise PLCErrorModbus(codigo_error, self.__mensaje_error(codigo_error))
             log.log(DEBUG_CLIENTE_PLC, '   escrito')
         finally:
             if THREADSAFE:
@@ -0,0 +1,501 @@
+import ctypes
+import itertools
+import math
+import random
+import socket
+import struct
+
+import pytest
+
+from cliente_plc import (ClientePLC, ClientePLCModbus, ClientePLCSiemens, PLCError, PLCErrorComunicacion, PLCErrorModbus,
+    PLCErrorSiemens, TipoDatos)
+
+
+def _coste(cliente, rangos):
+    return sum(cliente.segundos_por_peticion + cliente.segundos_por_registro * rango[2] for rango in rangos)
+
+
+def _coste_minimo_fuerza_bruta(cliente, tramos, huecos):
+    ''' Prueba todas las formas de cortar los tramos en lecturas consecutivas. '''
+    mejor = math.inf
+    for cortes in itertools.product((False, True), repeat=len(tramos) - 1):
+        grupos = [[tramos[0]]]
+        for corte, tramo in zip(cortes, tramos[1:]):
+            if corte:
+                grupos.append([tramo])
+            else:
+                grupos[-1].append(tramo)
+        rangos = [cliente._rango_tramos(grupo) for grupo in grupos]
+        if any(rango[2] > cliente.max_registros_por_lectura or cliente._incluye_hueco(huecos, rango[0], rango[0] + rango[2])
+               for rango in rangos):
+            continue
+        mejor = min(mejor, _coste(cliente, rangos))
+    return mejor
+
+
+@pytest.mark.parametrize('semilla', range(200))
+def test_rango_posiciones_coste_minimo(semilla):
+    aleatorio = random.Random(semilla)
+    cliente = ClientePLC()
+    cliente.max_registros_por_lectura = aleatorio.choice((10, 30, 123))
+    cliente.segundos_por_peticion = aleatorio.choice((0.01, 0.001))
+    cliente.segundos_por_registro = aleatorio.choice((0.00005, 0.0002, 0.001))
+    tipos = (TipoDatos.entero, TipoDatos.real, TipoDatos.real_doble)
+    posiciones = {aleatorio.randrange(0, 200): aleatorio.choice(tipos) for _ in range(aleatorio.randint(1, 10))}
+    tramos = sorted((posicion, posicion + cliente._bytes_tipo_datos[tipo]) for posicion, tipo in posiciones.items())
+    huecos = []
+    if aleatorio.random() < 0.5:
+        inicio = aleatorio.randrange(0, 200)
+        huecos = [(inicio, inicio + aleatorio.randrange(0, 5))]
+        if any(cliente._incluye_hueco(huecos, *tramo) for tramo in tramos):
+            huecos = []
+    cliente.direcciones_no_legibles = {'db1': huecos}
+
+    rangos = cliente._rango_posiciones(posiciones, 'db1')
+
+    for (inicio, fin) in tramos:
+        assert any(rango[0] <= inicio <= rango[1] and fin <= rango[0] + rango[2] for rango in rangos)
+    for rango in rangos:
+        assert rango[2] <= cliente.max_registros_por_lectura
+        assert not cliente._incluye_hueco(huecos, rango[0], rango[0] + rango[2])
+    assert _coste(cliente, rangos) == pytest.approx(_coste_minimo_fuerza_bruta(cliente, tramos, huecos))
+
+
+def test_agrupar_tramos_respeta_el_maximo_por_lectura():
+    cliente = ClientePLC()
+    cliente.max_registros_por_lectura = 10
+    # Juntar los cuatro valores costaría 12 registros: hacen falta dos lecturas
+    assert cliente._agrupar_tramos([(0, 4), (4, 6), (6, 8), (8, 12)]) == [[(0, 4), (4, 6), (6, 8)], [(8, 12)]]
+
+
+@pytest.mark.parametrize('variables', [
+    {'v1': 'db1.dr0'},
+    {'v1': 'db1.i0', 'v2': 'db1.dr2', 'v3': 'db1.i20'},
+])
+def test_valor_mas_largo_que_una_lectura_genera_error(variables):
+    cliente = ClientePLC()
+    cliente.max_registros_por_lectura = 4
+    # Un real doble ocupa 8 registros de 1 byte: no se puede leer, y antes se perdía sin avisar
+    with pytest.raises(PLCError, match='max_registros_por_lectura'):
+        cliente.mapear_variables(variables)
+
+
+# Bits de los booleanos de prueba: el bit 10 se escribiría x.1, igual que el bit 1
+BITS = [bit for bit in range(16) if bit != 10]
+
+
+def _posiciones_aleatorias(cliente, aleatorio, num_variables=40, num_registros=80):
+    ''' dict {posicion:tipo} con valores que se pueden solapar (p.ej. un byte dentro de un word). '''
+    tipos = [tipo for tipo in TipoDatos if tipo in cliente._bytes_tipo_datos]
+    posiciones = {}
+    for _ in range(num_variables):
+        tipo = aleatorio.choice(tipos)
+        direccion = aleatorio.randrange(0, num_registros)
+        if tipo == TipoDatos.booleano:
+            bit = aleatorio.choice(BITS if cliente.bytes_por_registro == 2 else BITS[:8])
+            posiciones[direccion + (bit / 10 if bit < 10 else bit / 100)] = tipo
+        else:
+            posiciones[direccion] = tipo
+    return posiciones
+
+
+def _decodificacion_anterior(cliente, rango, posiciones, registros):
+    ''' Decodificación valor a valor con _bytes_a_valor, como antes del plan de lectura compilado. '''
+    resultado = {}
+    for posicion, tipo in posiciones.items():
+        (direccion_registro, indice_bit) = cliente._separar_direccion_bit(posicion)
+        if not rango[0] <= direccion_registro <= rango[1]:
+            continue
+        desplazamiento = (direccion_registro - rango[0]) * cliente.bytes_por_registro
+        array_bytes = registros[desplazamiento:desplazamiento + cliente._bytes_tipo_datos[tipo]]
+        resultado[posicion] = cliente._bytes_a_valor(array_bytes, tipo, indice_bit)
+    return resultado
+
+
+def _mismo_valor(valor, esperado):
+    if isinstance(valor, float) and isinstance(esperado, float) and math.isnan(valor):
+        return math.isnan(esperado)
+    return type(valor) is type(esperado) and valor == esperado
+
+
+def _comprobar_equivalencia(cliente, semilla):
+    aleatorio = random.Random(semilla)
+    posiciones = _posiciones_aleatorias(cliente, aleatorio)
+    nombres = {posicion: 'v{}'.format(indice) for indice, posicion in enumerate(posiciones)}
+    for rango in cliente._rango_posiciones(posiciones):
+        plan = cliente._compilar_rango(rango, posiciones, nombres)
+        registros = bytes(aleatorio.randrange(256) for _ in range(rango[2] * cliente.bytes_por_registro))
+        # Respuesta completa y respuesta más corta que el rango (valores incompletos = None)
+        for recibidos in (registros, registros[:aleatorio.randrange(len(registros))]):
+            decodificados = {posicion: valor for (posicion, _, valor) in cliente._decodificar_rango(plan, recibidos)}
+            esperados = _decodificacion_anterior(cliente, rango, posiciones, recibidos)
+            assert decodificados.keys() == esperados.keys()
+            for posicion in esperados:
+                assert _mismo_valor(decodificados[posicion], esperados[posicion]), (posicion, posiciones[posicion])
+
+
+# Códigos de área y bytes de cada "WordLen" de Snap7
+AREA_PE, AREA_MK, AREA_DB = 0x81, 0x83, 0x84
+BYTES_WORDLEN_S7 = {0x01: 1, 0x02: 1, 0x04: 2, 0x06: 4, 0x08: 4, 0x1C: 2, 0x1D: 2}
+
+
+class _FuncionSnap7Falsa:
+    ''' Función de la librería simulada (admite que se le asignen argtypes y restype). '''
+
+    def __init__(self, implementacion):
+        self.implementacion = implementacion
+
+    def __call__(self, *args):
+        return self.implementacion(*args)
+
+
+class _Snap7Falsa:
+    ''' Librería Snap7 simulada: cada byte de un área vale (dirección + número de DB) % 256. Guarda en
+    "llamadas" las lecturas y escrituras hechas, como (función, [(area, db, inicio, cantidad), ...]), y
+    devuelve "error_elemento" en el Result de los elementos múltiples que empiezan en "direcciones_error".
+    '''
+
+    def __init__(self, longitud_pdu=240, direcciones_error=(), error_elemento=0x00C00000):
+        self.longitud_pdu = longitud_pdu
+        self.direcciones_error = direcciones_error
+        self.error_elemento = error_elemento
+        self.memoria = {}
+        self.llamadas = []
+        for nombre in ('Cli_Create', 'Cli_Destroy', 'Cli_GetPduLength', 'Cli_ErrorText',
+                'Cli_ReadArea', 'Cli_WriteArea', 'Cli_ReadMultiVars', 'Cli_WriteMultiVars'):
+            setattr(self, nombre, _FuncionSnap7Falsa(getattr(self, '_' + nombre)))
+
+    def zona(self, area, numero_db):
+        return self.memoria.setdefault((area, numero_db), bytearray((direccion + numero_db) % 256 for direccion in range(4096)))
+
+    def leer(self, area, numero_db, inicio, cantidad, wordlen):
+        zona = self.zona(area, numero_db)
+        if wordlen == 0x01:
+            # Bits: la dirección va en bits y se devuelve un byte por bit
+            return bytes((zona[bit // 8] >> bit % 8) & 1 for bit in range(inicio, inicio + cantidad))
+        return bytes(zona[inicio:inicio + cantidad * BYTES_WORDLEN_S7[wordlen]])
+
+    def escribir(self, area, numero_db, inicio, cantidad, wordlen, datos):
+        zona = self.zona(area, numero_db)
+        if wordlen == 0x01:
+            for (bit, valor) in zip(range(inicio, inicio + cantidad), datos):
+                zona[bit // 8] = zona[bit // 8] & ~(1 << bit % 8) | (valor & 1) << bit % 8
+        else:
+            zona[inicio:inicio + len(datos)] = datos
+
+    def _Cli_Create(self):
+        return 1
+
+    def _Cli_Destroy(self, objeto):
+        return 0
+
+    def _Cli_GetPduLength(self, objeto, requerida, negociada):
+        negociada._obj.value = self.longitud_pdu
+        return 0
+
+    def _Cli_ErrorText(self, codigo, texto, longitud):
+        texto.value = b'Error simulado'
+        return 0
+
+    def _Cli_ReadArea(self, objeto, area, numero_db, inicio, cantidad, wordlen, datos):
+        self.llamadas.append(('Cli_ReadArea', [(area, numero_db, inicio, cantidad)]))
+        leidos = self.leer(area, numero_db, inicio, cantidad, wordlen)
+        ctypes.memmove(datos, leidos, len(leidos))
+        return 0
+
+    def _Cli_WriteArea(self, objeto, area, numero_db, inicio, cantidad, wordlen, valores):
+        self.llamadas.append(('Cli_WriteArea', [(area, numero_db, inicio, cantidad)]))
+        self.escribir(area, numero_db, inicio, cantidad, wordlen, valores)
+        return 0
+
+    def _multiples(self, nombre_funcion, elementos, num_elementos):
+        self.llamadas.append((nombre_funcion, [(e.Area, e.DBNumber, e.Start, e.Amount) for e in elementos[:num_elementos]]))
+        for elemento in elementos[:num_elementos]:
+            if elemento.Start in self.direcciones_error:
+                elemento.Result = self.error_elemento
+            elif nombre_funcion == 'Cli_ReadMultiVars':
+                leidos = self.leer(elemento.Area, elemento.DBNumber, elemento.Start, elemento.Amount, elemento.WordLen)
+                ctypes.memmove(elemento.pdata, leidos, len(leidos))
+            else:
+                datos = ctypes.string_at(elemento.pdata, elemento.Amount * BYTES_WORDLEN_S7[elemento.WordLen])
+                self.escribir(elemento.Area, elemento.DBNumber, elemento.Start, elemento.Amount, elemento.WordLen, datos)
+        return 0
+
+    def _Cli_ReadMultiVars(self, objeto, elementos, num_elementos):
+        return self._multiples('Cli_ReadMultiVars', elementos, num_elementos)
+
+    def _Cli_WriteMultiVars(self, objeto, elementos, num_elementos):
+        return self._multiples('Cli_WriteMultiVars', elementos, num_elementos)
+
+
+def _cliente_siemens(snap7=None):
+    # ClientePLCSiemens "conectado" a la librería Snap7 simulada, sin cargar la DLL
+    snap7 = snap7 or _Snap7Falsa()
+    anterior = ClientePLCSiemens._ClientePLCSiemens__snap7dll
+    ClientePLCSiemens._ClientePLCSiemens__snap7dll = snap7
+    try:
+        cliente = ClientePLCSiemens()
+    finally:
+        ClientePLCSiemens._ClientePLCSiemens__snap7dll = anterior
+    cliente._ClientePLCSiemens__snap7dll = snap7
+    cliente._conectado = True
+    cliente.pausa_entre_accesos = 0
+    return cliente
+
+
+@pytest.mark.parametrize('semilla', range(25))
+def test_plan_compilado_equivale_a_bytes_a_valor_siemens(semilla):
+    _comprobar_equivalencia(_cliente_siemens(), semilla)
+
+
+@pytest.mark.parametrize('invertir_bytes', [False, True])
+@pytest.mark.parametrize('invertir_palabras', [False, True])
+@pytest.mark.parametrize('semilla', range(25))
+def test_plan_compilado_equivale_a_bytes_a_valor_modbus(semilla, invertir_palabras, invertir_bytes):
+    cliente = ClientePLCModbus(invertir_palabras=invertir_palabras, invertir_bytes=invertir_bytes)
+    _comprobar_equivalencia(cliente, semilla)
+
+
+@pytest.mark.parametrize('invertir_bytes', [False, True])
+@pytest.mark.parametrize('invertir_palabras', [False, True])
+@pytest.mark.parametrize('num_bytes', [4, 8])
+def test_permutacion_bytes_deshace_valor_a_bytes(num_bytes, invertir_palabras, invertir_bytes):
+    cliente = ClientePLCModbus(invertir_palabras=invertir_palabras, invertir_bytes=invertir_bytes)
+    tipo = TipoDatos.entero_sin_signo_largo if num_bytes == 4 else TipoDatos.entero_sin_signo_largo_doble
+    valor = int.from_bytes(bytes(range(1, num_bytes + 1)), 'big')
+    en_dispositivo = cliente._valor_a_bytes(valor, tipo)
+    assert bytes(en_dispositivo[indice] for indice in cliente._permutacion_bytes(num_bytes)) == valor.to_bytes(num_bytes, 'big')
+
+
+def test_cliente_modbus_no_cambia_los_tipos_de_otros_clientes():
+    ClientePLCModbus()
+    cliente = _cliente_siemens()
+    assert cliente._bytes_tipo_datos[TipoDatos.booleano] == 1
+    assert cliente._cadena_formato_tipo_datos[TipoDatos.byte] == 'c'
+
+
+# Una lectura múltiple cabe en la PDU si 14 (cabecera) + 12 por elemento en la petición y
+# 14 + 4 (cabecera de datos) + datos rellenados a un número par de bytes por elemento en la respuesta no la superan.
+# En una escritura, los 12 + 4 + datos van en la petición y la respuesta lleva 1 byte por elemento.
+@pytest.mark.parametrize('escritura, num_bytes, multiple', [
+    (False, 221, True), (False, 222, True), (False, 223, False), (False, 400, False),
+    (True, 209, True), (True, 210, True), (True, 211, False),
+])
+def test_siemens_elemento_que_no_cabe_en_la_pdu_va_suelto(escritura, num_bytes, multiple):
+    snap7 = _Snap7Falsa(longitud_pdu=240)
+    cliente = _cliente_siemens(snap7)
+    if escritura:
+        cliente.escribir_multiples_areas([(bytes(num_bytes), 'db1', 0, num_bytes)])
+        assert snap7.leer(AREA_DB, 1, 0, num_bytes, 0x02) == bytes(num_bytes)
+        funcion = 'Cli_WriteMultiVars' if multiple else 'Cli_WriteArea'
+    else:
+        assert bytes(cliente.leer_multiples_areas([('db1', 0, num_bytes)])[0]) == snap7.leer(AREA_DB, 1, 0, num_bytes, 0x02)
+        funcion = 'Cli_ReadMultiVars' if multiple else 'Cli_ReadArea'
+    assert snap7.llamadas == [(funcion, [(AREA_DB, 1, 0, num_bytes)])]
+
+
+@pytest.mark.parametrize('escritura, tamanyos, lotes', [
+    (False, [109, 108], [[0, 1]]),      # 14 + (4 + 110) + (4 + 108) = 240
+    (False, [109, 109], [[0], [1]]),    # 14 + (4 + 110) + (4 + 110) = 242
+    (True, [96, 97], [[0, 1]]),         # 14 + (16 + 96) + (16 + 98) = 240
+    (True, [97, 97], [[0], [1]]),       # 14 + (16 + 98) + (16 + 98) = 242
+])
+def test_siemens_relleno_de_bytes_impares_en_el_lote(escritura, tamanyos, lotes):
+    cliente = _cliente_siemens()
+    assert cliente._ClientePLCSiemens__lotes_multiples(tamanyos, 240, escritura) == (lotes, [])
+
+
+@pytest.mark.parametrize('escritura, longitud_pdu, num_bytes, tamanyos_lotes', [
+    (False, 240, 2, [18, 18, 4]),       # petición: 14 + 12 por elemento
+    (False, 480, 2, [20, 20]),          # MaxVars
+    (True, 240, 2, [12, 12, 12, 4]),    # petición: 14 + (12 + 4 + 2) por elemento
+    (True, 480, 2, [20, 20]),
+    (False, 240, 100, [2] * 20),        # respuesta: 14 + (4 + 100) por elemento
+    (False, 480, 100, [4] * 10),
+    (True, 240, 100, [1] * 40),         # petición: 14 + (12 + 4 + 100) por elemento
+    (True, 480, 100, [4] * 10),
+])
+def test_siemens_lotes_segun_pdu_y_maximo_de_elementos(escritura, longitud_pdu, num_bytes, tamanyos_lotes):
+    snap7 = _Snap7Falsa(longitud_pdu=longitud_pdu)
+    cliente = _cliente_siemens(snap7)
+    zonas = [('db2', num_bytes * indice, num_bytes) for indice in range(40)]
+    if escritura:
+        valores = [bytes([indice]) * num_bytes for indice in range(40)]
+        cliente.escribir_multiples_areas([(valor,) + zona for (valor, zona) in zip(valores, zonas)])
+        assert b''.join(valores) == snap7.leer(AREA_DB, 2, 0, 40 * num_bytes, 0x02)
+    else:
+        leidos = cliente.leer_multiples_areas(zonas)
+        assert b''.join(map(bytes, leidos)) == snap7.leer(AREA_DB, 2, 0, 40 * num_bytes, 0x02)
+    assert [len(elementos) for (_, elementos) in snap7.llamadas] == tamanyos_lotes
+    assert [elemento for (_, elementos) in snap7.llamadas for elemento in elementos] \
+        == [(AREA_DB, 2, num_bytes * indice, num_bytes) for indice in range(40)]
+
+
+def test_siemens_lectura_multiple_en_el_orden_pedido_con_zonas_sueltas():
+    snap7 = _Snap7Falsa(longitud_pdu=240)
+    cliente = _cliente_siemens(snap7)
+    # Entre las zonas hay una demasiado grande para la PDU y una de varios bits, que se leen con leer_area
+    lecturas = [('db1', 0, 10), ('db2', 0, 300), ('mk', 17, 3), ('db3', 5, 7), ('mk', 9, 1), ('pe', 4, 2)]
+    leidos = cliente.leer_multiples_areas(lecturas)
+    assert [bytes(valor) for valor in leidos] == [
+        snap7.leer(AREA_DB, 1, 0, 10, 0x02), snap7.leer(AREA_DB, 2, 0, 300, 0x02), snap7.leer(AREA_MK, 0, 17, 3, 0x01),
+        snap7.leer(AREA_DB, 3, 5, 7, 0x02), snap7.leer(AREA_MK, 0, 9, 1, 0x01), snap7.leer(AREA_PE, 0, 4, 2, 0x02),
+    ]
+    assert snap7.llamadas == [
+        ('Cli_ReadMultiVars', [(AREA_DB, 1, 0, 10), (AREA_DB, 3, 5, 7), (AREA_MK, 0, 9, 1), (AREA_PE, 0, 4, 2)]),
+        ('Cli_ReadArea', [(AREA_DB, 2, 0, 300)]),
+        ('Cli_ReadArea', [(AREA_MK, 0, 17, 3)]),
+    ]
+
+
+def test_siemens_escritura_multiple_de_varios_bits_va_suelta():
+    snap7 = _Snap7Falsa(longitud_pdu=240)
+    cliente = _cliente_siemens(snap7)
+    cliente.escribir_multiples_areas([(b'\x01\x00\x01', 'mk', 16, 3), (b'\x00', 'mk', 9, 1), (b'\xaa\xbb', 'db1', 4, 2)])
+    assert snap7.leer(AREA_MK, 0, 16, 3, 0x01) == b'\x01\x00\x01'
+    assert snap7.leer(AREA_MK, 0, 9, 1, 0x01) == b'\x00'
+    assert snap7.leer(AREA_DB, 1, 4, 2, 0x02) == b'\xaa\xbb'
+    assert snap7.llamadas == [
+        ('Cli_WriteMultiVars', [(AREA_MK, 0, 9, 1), (AREA_DB, 1, 4, 2)]),
+        ('Cli_WriteArea', [(AREA_MK, 0, 16, 3)]),
+    ]
+
+
+@pytest.mark.parametrize('escritura', [False, True])
+def test_siemens_error_en_un_elemento_de_la_operacion_multiple(escritura):
+    # La llamada a Snap7 va bien, pero el PLC rechaza uno de los elementos (p.ej. un DB que no existe)
+    snap7 = _Snap7Falsa(direcciones_error=(8,))
+    cliente = _cliente_siemens(snap7)
+    with pytest.raises(PLCErrorSiemens):
+        if escritura:
+            cliente.escribir_multiples_areas([(bytes(4), 'db1', 0, 4), (bytes(4), 'db1', 8, 4)])
+        else:
+            cliente.leer_multiples_areas([('db1', 0, 4), ('db1', 8, 4)])
+    assert len(snap7.llamadas) == 1
+
+
+class _SocketModbusFalso:
+    ''' Dispositivo Modbus TCP simulado: cada holding register vale su dirección (o da la excepción
+    2 si está en "direcciones_error"). Las respuestas pendientes se entregan todas juntas, en orden
+    inverso y en trozos de "tamanyo_trozo" bytes; "adelantar" se entrega antes que ellas. Tras
+    "bytes_hasta_timeout" bytes entregados, recv da timeout.
+    '''
+
+    def __init__(self, tamanyo_trozo=3, adelantar=b'', direcciones_error=(), bytes_hasta_timeout=None):
+        self.tamanyo_trozo = tamanyo_trozo
+        self.direcciones_error = direcciones_error
+        self.bytes_hasta_timeout = bytes_hasta_timeout
+        self.buffer = bytearray(adelantar)
+        self.sin_responder = []
+        self.enviadas = []
+        self.max_en_curso = 0
+        self.cerrado = False
+
+    def sendall(self, adu):
+        self.enviadas.append(adu)
+        self.sin_responder.append(adu)
+        self.max_en_curso = max(self.max_en_curso, len(self.sin_responder))
+
+    def recv(self, num_bytes):
+        if not self.buffer:
+            self.buffer += b''.join(_respuesta_modbus(adu, self.direcciones_error) for adu in reversed(self.sin_responder))
+            self.sin_responder = []
+        if not self.buffer or self.bytes_hasta_timeout == 0:
+            raise socket.timeout('timed out')
+        num_bytes = min(num_bytes, self.tamanyo_trozo, len(self.buffer))
+        if self.bytes_hasta_timeout is not None:
+            num_bytes = min(num_bytes, self.bytes_hasta_timeout)
+            self.bytes_hasta_timeout -= num_bytes
+        trozo = bytes(self.buffer[:num_bytes])
+        del self.buffer[:num_bytes]
+        return trozo
+
+    def close(self):
+        self.cerrado = True
+
+
+def _respuesta_modbus(adu, direcciones_error=(), id_transaccion=None):
+    (id_peticion, _, _, id_esclavo) = struct.unpack('>HHHB', adu[:7])
+    (codigo_funcion, direccion, num_registros) = struct.unpack('>BHH', adu[7:12])
+    if direccion in direcciones_error:
+        pdu = struct.pack('>BB', codigo_funcion | 0x80, 2)
+    else:
+        pdu = struct.pack('>BB', codigo_funcion, 2 * num_registros) + _registros(direccion, num_registros)
+    if id_transaccion is None:
+        id_transaccion = id_peticion
+    return struct.pack('>HHHB', id_transaccion, 0, len(pdu) + 1, id_esclavo) + pdu
+
+
+def _registros(direccion, num_registros):
+    return struct.pack('>{}H'.format(num_registros), *range(direccion, direccion + num_registros))
+
+
+def _cliente_modbus(socket_falso, max_peticiones_en_curso=1):
+    cliente = ClientePLCModbus('127.0.0.1', max_peticiones_en_curso=max_peticiones_en_curso)
+    cliente._ClientePLCModbus__socket = socket_falso
+    cliente._conectado = True
+    return cliente
+
+
+LECTURAS = [('hr', 0, 10), ('hr', 100, 123), ('hr1', 300, 1), ('ir', 50, 7), ('hr', 1000, 60)]
+
+
+@pytest.mark.parametrize('tamanyo_trozo', [1, 5, 4096])
+@pytest.mark.parametrize('max_peticiones_en_curso', [1, 3, 10])
+def test_modbus_tramas_troceadas_y_desordenadas(tamanyo_trozo, max_peticiones_en_curso):
+    socket_falso = _SocketModbusFalso(tamanyo_trozo)
+    cliente = _cliente_modbus(socket_falso, max_peticiones_en_curso)
+    assert cliente.leer_multiples_areas(LECTURAS) == [_registros(direccion, num) for (_, direccion, num) in LECTURAS]
+    assert socket_falso.max_en_curso == min(max_peticiones_en_curso, len(LECTURAS))
+    # Cada petición con su propio id de transacción
+    assert len({struct.unpack('>H', adu[:2])[0] for adu in socket_falso.enviadas}) == len(LECTURAS)
+
+
+def test_modbus_descarta_respuestas_con_id_desconocido():
+    # Respuesta tardía de una petición anterior que dio timeout, con los mismos datos pedidos
+    cliente = _cliente_modbus(None)
+    (id_transaccion, adu) = cliente._ClientePLCModbus__peticion_lectura('hr', 0, 10)
+    tardia = _respuesta_modbus(adu, id_transaccion=id_transaccion)
+    socket_falso = _SocketModbusFalso(tamanyo_trozo=4, adelantar=tardia)
+    cliente._ClientePLCModbus__socket = socket_falso
+    assert cliente.leer_area('hr', 0, 10) == _registros(0, 10)
+    assert socket_falso.buffer == b''
+
+
+def test_modbus_respuesta_de_excepcion():
+    socket_falso = _SocketModbusFalso(direcciones_error=(100,))
+    cliente = _cliente_modbus(socket_falso, max_peticiones_en_curso=5)
+    with pytest.raises(PLCErrorModbus) as error:
+        cliente.leer_multiples_areas(LECTURAS)
+    assert error.value.codigo_error() == 2
+    # La conexión sigue sincronizada: la respuesta de excepción se ha leído entera
+    assert not socket_falso.cerrado
+    assert cliente.leer_area('hr', 0, 10) == _registros(0, 10)
+
+
+@pytest.mark.parametrize('bytes_hasta_timeout', [0, 5, 20])
+def test_modbus_reconecta_tras_timeout_con_peticiones_pendientes(bytes_hasta_timeout):
+    socket_falso = _SocketModbusFalso(bytes_hasta_timeout=bytes_hasta_timeout)
+    cliente = _cliente_modbus(socket_falso, max_peticiones_en_curso=3)
+    sockets_nuevos = []
+
+    def _conectar():
+        sockets_nuevos.append(_SocketModbusFalso())
+        cliente._ClientePLCModbus__socket = sockets_nuevos[-1]
+        cliente._conectado = True
+    cliente.conectar = _conectar
+    with pytest.raises(PLCErrorComunicacion):
+        cliente.leer_multiples_areas(LECTURAS)
+    # Las respuestas pendientes (y la trama a medias) se quedan en la conexión anterior
+    assert socket_falso.cerrado and len(sockets_nuevos) == 1
+    assert cliente.leer_multiples_areas(LECTURAS) == [_registros(direccion, num) for (_, direccion, num) in LECTURAS]
+
+
+def test_modbus_timeout_con_desconectar_si_error_comunicacion():
+    socket_falso = _SocketModbusFalso(bytes_hasta_timeout=5)
+    cliente = _cliente_modbus(socket_falso)
+    cliente.desconectar_si_error_comunicacion = True
+    cliente.pausa_entre_accesos = 0
+    with pytest.raises(PLCErrorComunicacion):
+        cliente.leer_area('hr', 0, 10)
+    assert socket_falso.cerrado and not cliente.conectado
@@ -1,15 +1,25 @@
 import autobahn from "autobahn";
+import msgpack5 from "msgpack5";
+import { Buffer } from "buffer";
+
+const msgpack = msgpack5();
 
 export default {
     conectar(url_server, usuario_crossbar) {
         try {
             let conexion = new autobahn.Connection({
                 url: url_server,
-                realm: usuario_crossbar
+                realm: usuario_crossbar,
+                // El módulo de entrada publica los datos de tiempo real en msgpack
+                serializers: [new autobahn.serializer.MsgpackSerializer()]
             })
             return conexion
         } catch (error) {
             return null
         }
+    },
+    decodificarPayload(payload) {
+        // payload: bytes msgpack de {'timestamp': ms, 'datos': {...}}, con los datos tal como los envía el dispositivo
+        return msgpack.decode(Buffer.from(payload))
     }
-}
\ No newline at end of file
+}
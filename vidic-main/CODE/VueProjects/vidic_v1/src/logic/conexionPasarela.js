@@ -0,0 +1,46 @@
+import msgpack5 from "msgpack5";
+import { Buffer } from "buffer";
+
+const msgpack = msgpack5();
+
+// Conexión con la pasarela WebSocket del módulo de entrada (alternativa al Crossbar,
+// ComunicacionBrokers/pasarela_websocket.py). Se autentica con el token de la API.
+export default {
+    conectar(url_server, topics, alRecibir, maximo_por_segundo) {
+        // alRecibir(topic, datosJson) se llama con cada dato de los topics ('id_instalacion.id_dispositivo') suscritos.
+        // maximo_por_segundo (opcional): datos por segundo y topic que se quieren recibir como mucho.
+        let conexion = new WebSocket(url_server);
+        // topic -> último dato completo, para aplicar los deltas que envía la pasarela
+        let ultimos = {};
+        conexion.binaryType = 'arraybuffer';
+        conexion.onopen = function() {
+            conexion.send(JSON.stringify({accion: 'autenticar', token: localStorage.getItem('access_token'),
+                deltas: true, maximo_por_segundo: maximo_por_segundo || 0}));
+        };
+        conexion.onmessage = function(evento) {
+            if (typeof evento.data === 'string') {
+                let respuesta = JSON.parse(evento.data);
+                if (respuesta['accion'] === 'autenticado') {
+                    for (let topic of topics) conexion.send(JSON.stringify({accion: 'suscribir', topic: topic}));
+                } else if (respuesta['accion'] === 'no_autorizado') {
+                    // El dispositivo no es de ninguna instalación del usuario
+                    console.log('Sin acceso a ' + respuesta['topic']);
+                }
+                return;
+            }
+            let [topic, datosJson] = msgpack.decode(Buffer.from(evento.data));
+            if ('delta' in datosJson) {
+                // Solo trae las variables que han cambiado: se completa con el último dato del topic
+                let anterior = ultimos[topic];
+                if (!anterior) return;
+                datosJson = {
+                    timestamp: datosJson['timestamp'],
+                    datos: Object.assign({}, anterior['datos'], {datos: Object.assign({}, anterior['datos']['datos'], datosJson['delta'])})
+                };
+            }
+            ultimos[topic] = datosJson;
+            alRecibir(topic, datosJson);
+        };
+        return conexion;
+    }
+}
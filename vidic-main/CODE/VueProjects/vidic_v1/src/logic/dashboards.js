@@ -13,7 +13,10 @@ export default {
     //     return axios.get('numero-dashboards?nombre_usuario=' + nombre_usuario)
     //     // return nombre_usuario === nombre_usuario
     // },
-    getDispositivo(id_dispositivo, fecha_inicio, fecha_fin) {
-        return axios.get('dispositivo?id_dispositivo=' + id_dispositivo + '&fecha_inicio=' + fecha_inicio + '&fecha_fin=' + fecha_fin)
+    getDispositivo(id_dispositivo, fecha_inicio, fecha_fin, resolucion) {
+        // resolucion (opcional): número máximo de puntos por variable que devuelve el servidor
+        let url = 'dispositivo?id_dispositivo=' + id_dispositivo + '&fecha_inicio=' + fecha_inicio + '&fecha_fin=' + fecha_fin
+        if (resolucion) url += '&resolucion=' + resolucion
+        return axios.get(url)
     }
 }
\ No newline at end of file
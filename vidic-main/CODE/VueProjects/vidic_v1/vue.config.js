@@ -1,4 +1,14 @@
 const { defineConfig } = require('@vue/cli-service')
+const webpack = require('webpack')
 module.exports = defineConfig({
-  transpileDependencies: true
+  transpileDependencies: true,
+  // msgpack5 (serializador msgpack de autobahn) usa Buffer, que webpack 5 ya no incluye en el navegador
+  configureWebpack: {
+    resolve: {
+      fallback: { buffer: require.resolve('buffer/') }
+    },
+    plugins: [
+      new webpack.ProvidePlugin({ Buffer: ['buffer', 'Buffer'] })
+    ]
+  }
 })